@@ -1,19 +1,41 @@
 # agent_core.py
+import asyncio
+import hashlib
 import os
 import json
-from typing import List, Dict, Any
+import time
+from typing import Awaitable, Callable, List, Dict, Any, Optional
 
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 
-from agent_system_prompt import AGENT_SYSTEM_PROMPT
+from conversation_summary import compact_history
+from keyword_filter import classify_keywords, normalize_text
+from plan_synthesizer import DraftCallback
+from relevance_classifier import classify_relevance
+from stream_json import ItemCallback
+from prompt_builder import SYSTEM_MESSAGE, build_prompt_messages, strip_static_prefix
+from tool_projection import encode_tool_result
 from tools.event_detail import get_event_detail_for_ai_tool
 from tools.epics import ai_generate_epics_for_event_tool
-from tools.tasks import ai_generate_tasks_for_epic_tool
+from tools.tasks import ai_generate_tasks_for_epic_tool, ai_generate_tasks_for_epics_tool
+from ttl_cache import TTLCache
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Async client: một worker uvicorn phục vụ được nhiều lượt chat cùng lúc
+# (không chặn event loop trong lúc chờ OpenAI / Node).
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Số tool_call tối đa chạy đồng thời trong 1 lượt (mỗi tool có thể gọi RAG + LLM con)
+MAX_PARALLEL_TOOL_CALLS = int(os.getenv("AGENT_MAX_PARALLEL_TOOL_CALLS", "4"))
+
+# Cache verdict relevance theo hash message đã chuẩn hoá: Node gửi lại history khi retry / regenerate
+# nên cùng một câu hỏi bị phân loại nhiều lần.
+RELEVANCE_CACHE_MAX_ENTRIES = int(os.getenv("RELEVANCE_CACHE_MAX_ENTRIES", "4096"))
+RELEVANCE_CACHE_TTL_SECONDS = float(os.getenv("RELEVANCE_CACHE_TTL_SECONDS", "3600"))
+_relevance_cache = TTLCache(max_entries=RELEVANCE_CACHE_MAX_ENTRIES, ttl_seconds=RELEVANCE_CACHE_TTL_SECONDS)
+_relevance_fast_path_hits = 0
 
 # ====== TOOLS DEFINITION CHO OPENAI ======
 TOOLS = [
@@ -70,6 +92,13 @@ TOOLS = [
                             "'ban nội dung', 'ban media design', ...). "
                             "Model có thể tự đề xuất nếu user không đưa đủ."
                         )
+                    },
+                    "bypassCache": {
+                        "type": "boolean",
+                        "description": (
+                            "Đặt true khi user muốn tạo lại / muốn phương án khác cho cùng sự kiện: "
+                            "bỏ qua cache và sinh plan mới. Mặc định false."
+                        )
                     }
                 },
                 "required": ["eventId", "eventDescription", "departments"]
@@ -123,71 +152,116 @@ TOOLS = [
                 ]
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "ai_generate_tasks_for_epics",
+            "description": (
+                "Bẻ NHIỀU EPIC của cùng một sự kiện thành task con trong MỘT lần gọi "
+                "(RAG một lần cho mỗi ban, các EPIC được sinh song song). "
+                "Dùng tool này thay vì gọi ai_generate_tasks_for_epic nhiều lần khi cần tạo task cho từ 2 EPIC trở lên. "
+                "Kết quả có type='tasks_plan_batch' với plans[] (mỗi phần tử là một tasks_plan)."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "eventId": {
+                        "type": "string",
+                        "description": "ObjectId của event chứa các EPIC"
+                    },
+                    "eventDescription": {
+                        "type": "string",
+                        "description": "Mô tả sự kiện (dùng cho RAG, giống khi sinh EPIC)"
+                    },
+                    "eventStartDate": {
+                        "type": "string",
+                        "description": "Ngày bắt đầu diễn ra sự kiện (D-Day), định dạng yyyy-mm-dd, mốc để tính offset_days_from_event."
+                    },
+                    "epics": {
+                        "type": "array",
+                        "description": "Danh sách EPIC cần sinh task",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "epicId": {
+                                    "type": "string",
+                                    "description": "TaskId của EPIC (taskType='epic') trong MongoDB"
+                                },
+                                "epicTitle": {
+                                    "type": "string",
+                                    "description": "Tiêu đề EPIC"
+                                },
+                                "department": {
+                                    "type": "string",
+                                    "description": "Tên phòng ban của EPIC"
+                                }
+                            },
+                            "required": ["epicId", "epicTitle", "department"]
+                        }
+                    }
+                },
+                "required": ["eventId", "eventDescription", "eventStartDate", "epics"]
+            }
+        }
     }
 ]
 
+# Tên các tool sự kiện: dùng để nhận biết hội thoại đã ở trong ngữ cảnh sự kiện
+EVENT_TOOL_NAMES = {tool["function"]["name"] for tool in TOOLS}
+
+# Loại kết quả tool được gom vào "plans" để FE preview & apply
+PLAN_TYPES = {"epics_plan", "tasks_plan"}
+# Kết quả gộp nhiều plan (ai_generate_tasks_for_epics) → được tách thành từng tasks_plan
+PLAN_BATCH_TYPES = {"tasks_plan_batch"}
+
+# Callback nhận tiến trình của 1 lượt agent (dùng cho endpoint streaming SSE):
+# await on_event(event_name, data)
+AgentEventCallback = Callable[[str, Dict[str, Any]], Awaitable[None]]
+
+
+def _is_plan(tool_result: Any) -> bool:
+    return isinstance(tool_result, dict) and tool_result.get("type") in PLAN_TYPES
+
+
+def _expand_plans(tool_result: Any) -> List[Dict[str, Any]]:
+    """Các plan trong 1 kết quả tool: plan đơn → [plan], batch → plans[] của nó, còn lại → []."""
+    if _is_plan(tool_result):
+        return [tool_result]
+    if isinstance(tool_result, dict) and tool_result.get("type") in PLAN_BATCH_TYPES:
+        return [plan for plan in tool_result.get("plans") or [] if _is_plan(plan)]
+    return []
+
+
+async def _emit(on_event: Optional[AgentEventCallback], event: str, data: Dict[str, Any]) -> None:
+    if on_event is not None:
+        await on_event(event, data)
+
 
 # ====== KIỂM TRA CÂU HỎI CÓ LIÊN QUAN ĐẾN SỰ KIỆN KHÔNG ======
-def is_event_related(message: str) -> bool:
+def _relevance_key(message: str) -> str:
+    """Hash của message đã chuẩn hoá (NFC, lowercase, gộp khoảng trắng)."""
+    normalized = " ".join(normalize_text(message).split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def _has_event_context(history_messages: List[Dict[str, Any]]) -> bool:
     """
-    Kiểm tra xem câu hỏi có liên quan đến tổ chức/quản lý sự kiện không.
-    Trả về True nếu liên quan, False nếu không liên quan.
+    Hội thoại đã được xác lập là về sự kiện: các lượt trước đã gọi tool sự kiện
+    (có message role=tool hoặc assistant.tool_calls trỏ tới tool trong TOOLS).
     """
-    if not message or not message.strip():
-        return False
-    
-    message_lower = message.lower().strip()
-    
-    # Từ khóa liên quan đến sự kiện
-    event_keywords = [
-        'sự kiện', 'su kien', 'event', 'tổ chức', 'to chuc',
-        'tạo sự kiện', 'tao su kien', 'create event',
-        'công việc', 'cong viec', 'task', 'epic', 'công việc lớn',
-        'ban', 'phòng ban', 'phong ban', 'department',
-        'thành viên', 'thanh vien', 'member',
-        'trưởng ban', 'truong ban', 'hod', 'hooc',
-        'lịch', 'lich', 'calendar', 'schedule',
-        'rủi ro', 'rui ro', 'risk',
-        'ngân sách', 'ngan sach', 'budget', 'chi phí', 'chi phi', 'expense',
-        'cột mốc', 'cot moc', 'milestone',
-        'địa điểm', 'dia diem', 'venue', 'location',
-        'ngày', 'ngay', 'date', 'thời gian', 'thoi gian',
-        'tổ chức sự kiện', 'to chuc su kien', 'organize event',
-        'quản lý sự kiện', 'quan ly su kien', 'manage event',
-        'myfevent', 'myf event'
-    ]
-    
-    # Từ khóa KHÔNG liên quan đến sự kiện (các câu hỏi chung chung)
-    non_event_keywords = [
-        '1+1', '2+2', 'tính toán', 'tinh toan', 'calculate', 'math',
-        'hdpe', 'nhựa', 'plastic', 'polyethylene',
-        'vui không', 'vui khong', 'khỏe không', 'khoe khong',
-        'kể chuyện', 'ke chuyen', 'tell story',
-        'lịch sử', 'lich su', 'history',
-        'địa lý', 'dia ly', 'geography',
-        'việt nam', 'viet nam', 'vietnam',
-        'học', 'hoc', 'learn', 'study',
-        'tin tức', 'tin tuc', 'news',
-        'thời tiết', 'thoi tiet', 'weather',
-        'ai là gì', 'ai la gi', 'what is ai',
-        'blockchain', 'crypto', 'bitcoin'
-    ]
-    
-    # Kiểm tra các từ khóa không liên quan trước (ưu tiên)
-    for keyword in non_event_keywords:
-        if keyword in message_lower:
-            # Nếu có từ khóa không liên quan, kiểm tra xem có từ khóa sự kiện không
-            # Nếu không có từ khóa sự kiện nào, thì không liên quan
-            has_event_keyword = any(ek in message_lower for ek in event_keywords)
-            if not has_event_keyword:
-                return False
-    
-    # Kiểm tra các từ khóa liên quan đến sự kiện
-    for keyword in event_keywords:
-        if keyword in message_lower:
+    for msg in history_messages or []:
+        if msg.get("role") == "tool" and msg.get("name") in EVENT_TOOL_NAMES:
             return True
-    
-    # Nếu không có từ khóa nào, dùng LLM để phân loại (fallback)
+        for tool_call in msg.get("tool_calls") or []:
+            function = tool_call.get("function") if isinstance(tool_call, dict) else None
+            if function and function.get("name") in EVENT_TOOL_NAMES:
+                return True
+    return False
+
+
+async def _llm_is_event_related(message: str) -> Optional[bool]:
+    """Phân loại bằng LLM; None nếu gọi lỗi."""
     try:
         classification_prompt = f"""Bạn là một hệ thống phân loại câu hỏi. Nhiệm vụ của bạn là xác định xem câu hỏi sau có liên quan đến TỔ CHỨC VÀ QUẢN LÝ SỰ KIỆN không.
 
@@ -210,7 +284,7 @@ Các câu hỏi KHÔNG LIÊN QUAN bao gồm:
 
 Trả lời CHỈ bằng một từ: "YES" nếu liên quan đến sự kiện, "NO" nếu không liên quan."""
         
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "Bạn là một hệ thống phân loại câu hỏi. Trả lời chỉ bằng YES hoặc NO."},
@@ -225,30 +299,332 @@ Trả lời CHỈ bằng một từ: "YES" nếu liên quan đến sự kiện,
         return result == "YES"
     except Exception as e:
         print(f"[AGENT] Error in is_event_related classification: {e}")
-        # Nếu lỗi, mặc định cho phép (để tránh chặn nhầm)
+        return None
+
+
+async def is_event_related(message: str, event_context: bool = False) -> bool:
+    """
+    Kiểm tra xem câu hỏi có liên quan đến tổ chức/quản lý sự kiện không.
+    Trả về True nếu liên quan, False nếu không liên quan.
+
+    - event_context=True: hội thoại đã dùng tool sự kiện → chỉ chạy keyword pre-filter
+      (vẫn chặn câu rõ ràng lạc đề), bỏ qua classifier / LLM.
+    - Verdict của classifier / LLM được cache theo hash message (trừ khi LLM lỗi);
+      keyword pass đủ rẻ nên luôn chạy lại (sửa config có hiệu lực ngay).
+    """
+    global _relevance_fast_path_hits
+    if not message or not message.strip():
+        return False
+
+    # Keyword (config/event_keywords.json) biên dịch thành 1 automaton, không phân biệt dấu:
+    # có keyword sự kiện → liên quan; chỉ có keyword không liên quan → từ chối.
+    verdict = classify_keywords(message)
+    if verdict is not None:
+        return verdict
+
+    if event_context:
+        _relevance_fast_path_hits += 1
+        print("[AGENT] is_event_related: conversation already uses event tools → skip classification")
         return True
 
+    key = _relevance_key(message)
+    cached = _relevance_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # Không khớp keyword → classifier cục bộ (mili-giây); chỉ gọi LLM khi độ tin cậy thấp
+    verdict = classify_relevance(message)
+    if verdict is not None:
+        print(f"[AGENT] is_event_related: local classifier → {verdict}")
+    else:
+        verdict = await _llm_is_event_related(message)
+        if verdict is None:
+            # Nếu lỗi, mặc định cho phép (để tránh chặn nhầm) và không cache
+            return True
+
+    _relevance_cache.set(key, verdict)
+    return verdict
+
+
+def get_relevance_cache_stats() -> Dict[str, Any]:
+    return {**_relevance_cache.stats(), "event_context_fast_path": _relevance_fast_path_hits}
+
 
 # ====== MAP TÊN TOOL → HÀM PYTHON THẬT ======
-def call_tool(name: str, arguments: Dict[str, Any], user_token: str) -> Dict[str, Any]:
+async def call_tool(
+    name: str,
+    arguments: Dict[str, Any],
+    user_token: str,
+    on_item: Optional[ItemCallback] = None,
+    on_draft: Optional[DraftCallback] = None,
+) -> Dict[str, Any]:
     """
     Map tên tool trong OpenAI function-calling → hàm Python tương ứng.
 
     - user_token: JWT (myFEvent) để Node client (tools/*.py) gọi backend Node.
+    - on_item: nhận từng epic / task ngay khi planner stream xong item đó.
+    - on_draft: nhận plan tổng hợp từ pattern KB (bản nháp) trước khi LLM planner chạy.
     """
     if name == "get_event_detail_for_ai":
-        return get_event_detail_for_ai_tool(arguments, user_token=user_token)
+        return await get_event_detail_for_ai_tool(arguments, user_token=user_token)
     if name == "ai_generate_epics_for_event":
-        return ai_generate_epics_for_event_tool(arguments, user_token=user_token)
+        return await ai_generate_epics_for_event_tool(
+            arguments, user_token=user_token, on_item=on_item, on_draft=on_draft
+        )
     if name == "ai_generate_tasks_for_epic":
-        return ai_generate_tasks_for_epic_tool(arguments, user_token=user_token)
+        return await ai_generate_tasks_for_epic_tool(
+            arguments, user_token=user_token, on_item=on_item, on_draft=on_draft
+        )
+    if name == "ai_generate_tasks_for_epics":
+        return await ai_generate_tasks_for_epics_tool(
+            arguments, user_token=user_token, on_item=on_item, on_draft=on_draft
+        )
     raise ValueError(f"Unknown tool name: {name}")
 
 
+# ====== THỰC THI 1 TOOL CALL (BAO GỒM XỬ LÝ LỖI) ======
+async def _execute_tool_call(
+    tool_call: Dict[str, Any],
+    user_token: str,
+    on_event: Optional[AgentEventCallback] = None,
+) -> Dict[str, Any]:
+    """
+    Chạy một tool_call của model và luôn trả về dict kết quả (không raise),
+    lỗi được đóng gói thành {"error": True, ...} để LLM đọc và giải thích cho user.
+
+    on_event: các planner báo từng epic / task ngay khi parse xong (event "plan_partial")
+              và bản nháp tổng hợp từ pattern KB (event "plan_draft").
+    """
+    tool_name = tool_call["function"]["name"]
+    raw_args = tool_call["function"].get("arguments") or "{}"
+    try:
+        tool_args = json.loads(raw_args)
+    except Exception:
+        tool_args = {}
+
+    print(f"[AGENT] calling tool {tool_name} with args={tool_args}")
+
+    try:
+        async def emit_partial(index: int, item: Dict[str, Any]) -> None:
+            await _emit(on_event, "plan_partial", {
+                "tool_call_id": tool_call.get("id"),
+                "name": tool_name,
+                "index": index,
+                "item": item,
+            })
+
+        on_item = emit_partial if on_event is not None else None
+
+        async def emit_draft(draft: Dict[str, Any]) -> None:
+            await _emit(on_event, "plan_draft", {
+                "tool_call_id": tool_call.get("id"),
+                "name": tool_name,
+                **draft,
+            })
+
+        on_draft = emit_draft if on_event is not None else None
+
+        tool_result = await call_tool(
+            tool_name, tool_args, user_token=user_token, on_item=on_item, on_draft=on_draft
+        )
+        print(f"[AGENT] tool {tool_name} success: {json.dumps(tool_result, ensure_ascii=False)[:200]}...")
+    except ValueError as e:
+        # ValueError từ tools thường chứa thông tin lỗi chi tiết
+        error_message = str(e)
+        error_type = "VALUE_ERROR"
+        
+        # Phân tích error message để xác định loại lỗi cụ thể
+        if "timeout" in error_message.lower() or "quá thời gian chờ" in error_message.lower():
+            error_type = "TIMEOUT_ERROR"
+            suggestion = "Kết nối đến backend quá thời gian chờ. Vui lòng thử lại sau hoặc kiểm tra kết nối mạng."
+        elif "connection" in error_message.lower() or "kết nối" in error_message.lower():
+            error_type = "CONNECTION_ERROR"
+            suggestion = "Không thể kết nối đến backend. Vui lòng kiểm tra xem backend có đang chạy không hoặc thử lại sau."
+        elif "authentication" in error_message.lower() or "401" in error_message or "xác thực" in error_message.lower():
+            error_type = "AUTHENTICATION_ERROR"
+            suggestion = "Token xác thực không hợp lệ hoặc đã hết hạn. Vui lòng đăng nhập lại."
+        elif "permission" in error_message.lower() or "403" in error_message or "quyền" in error_message.lower():
+            error_type = "PERMISSION_ERROR"
+            suggestion = "Bạn không có quyền thực hiện thao tác này. Vui lòng kiểm tra quyền của bạn."
+        elif "not found" in error_message.lower() or "404" in error_message or "không tìm thấy" in error_message.lower():
+            error_type = "NOT_FOUND_ERROR"
+            suggestion = "Không tìm thấy tài nguyên yêu cầu. Vui lòng kiểm tra lại ID hoặc thông tin đã cung cấp."
+        elif "missing" in error_message.lower() or "thiếu" in error_message.lower():
+            error_type = "MISSING_FIELD_ERROR"
+            suggestion = "Thiếu thông tin bắt buộc. Vui lòng kiểm tra lại các trường cần thiết."
+        elif "invalid" in error_message.lower() or "không hợp lệ" in error_message.lower():
+            error_type = "VALIDATION_ERROR"
+            suggestion = "Thông tin không hợp lệ. Vui lòng kiểm tra lại format hoặc giá trị đã nhập."
+        else:
+            # Tạo suggestion dựa trên tool name
+            if tool_name == "create_event":
+                suggestion = "Vui lòng kiểm tra lại: tên sự kiện, đơn vị tổ chức, ngày bắt đầu/kết thúc (format yyyy-mm-dd), địa điểm, và loại sự kiện (public/private)."
+            elif tool_name == "get_event_detail_for_ai":
+                suggestion = "Vui lòng kiểm tra lại eventId hoặc thử lại sau. Nếu vấn đề vẫn tiếp tục, có thể backend đang gặp sự cố."
+            elif tool_name == "ai_generate_tasks_for_epic":
+                suggestion = "Vui lòng kiểm tra lại các tham số đầu vào (eventId, epicId, department, eventDescription, eventStartDate) và thử lại."
+            elif tool_name == "ai_generate_epics_for_event":
+                if "không sinh được epic" in error_message.lower() or "epic nào" in error_message.lower():
+                    suggestion = "Sự kiện này chưa có ban nào tham gia. Bạn cần thêm ít nhất một ban vào sự kiện trước khi tạo công việc lớn."
+                else:
+                    suggestion = "Vui lòng kiểm tra lại các tham số đầu vào (eventId, eventDescription, departments) và thử lại."
+            else:
+                suggestion = "Vui lòng kiểm tra lại các tham số đầu vào và thử lại."
+        
+        print(f"[AGENT] tool {tool_name} error ({error_type}): {error_message}")
+        
+        # Trả về error message chi tiết để LLM có thể xử lý
+        # Format này giúp AI dễ đọc và hiển thị lỗi cho người dùng
+        tool_result = {
+            "error": True,
+            "error_type": error_type,
+            "error_message": error_message,
+            "suggestion": suggestion,
+            "tool_name": tool_name,
+            "tool_args": tool_args if 'tool_args' in locals() else {},
+            "message": f"Lỗi khi thực hiện {tool_name}: {error_message}. {suggestion}"
+        }
+    except Exception as e:
+        import traceback
+        error_detail = traceback.format_exc()
+        error_message = str(e)
+        error_type = type(e).__name__
+        
+        print(f"[AGENT] tool {tool_name} error ({error_type}):")
+        print(error_detail)
+        
+        # Tạo suggestion dựa trên tool name và error type
+        if tool_name == "create_event":
+            suggestion = "Vui lòng kiểm tra lại: tên sự kiện, đơn vị tổ chức, ngày bắt đầu/kết thúc (format yyyy-mm-dd), địa điểm, và loại sự kiện (public/private)."
+        elif tool_name == "get_event_detail_for_ai":
+            suggestion = "Vui lòng kiểm tra lại eventId hoặc thử lại sau. Nếu vấn đề vẫn tiếp tục, có thể backend đang gặp sự cố."
+        elif tool_name == "ai_generate_tasks_for_epic":
+            suggestion = "Vui lòng kiểm tra lại các tham số đầu vào (eventId, epicId, department, eventDescription, eventStartDate) và thử lại."
+        elif tool_name == "ai_generate_epics_for_event":
+            suggestion = "Vui lòng kiểm tra lại các tham số đầu vào (eventId, eventDescription, departments) và thử lại."
+        else:
+            suggestion = "Vui lòng kiểm tra lại các tham số đầu vào và thử lại."
+        
+        # Trả về error message chi tiết để LLM có thể xử lý
+        tool_result = {
+            "error": True,
+            "error_type": error_type,
+            "error_message": error_message,
+            "suggestion": suggestion,
+            "tool_name": tool_name,
+            "tool_args": tool_args if 'tool_args' in locals() else {},
+            "message": f"Lỗi không mong đợi khi thực hiện {tool_name}: {error_message}. {suggestion}"
+        }
+
+    return tool_result
+
+
+async def _execute_tool_calls(
+    tool_calls: List[Dict[str, Any]],
+    user_token: str,
+    on_event: Optional[AgentEventCallback] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Chạy song song các tool_call độc lập trong CÙNG một assistant message
+    (vd: model gọi ai_generate_tasks_for_epic cho 5 EPIC một lúc).
+
+    - Giới hạn số tool chạy đồng thời trong 1 lượt bằng MAX_PARALLEL_TOOL_CALLS.
+    - Kết quả trả về theo đúng thứ tự tool_calls để history luôn deterministic.
+    - on_event: báo tool_start / tool_finish / plan ngay khi từng tool chạy xong
+      (không đợi cả nhóm).
+    """
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_TOOL_CALLS)
+
+    async def _run(tool_call: Dict[str, Any]) -> Dict[str, Any]:
+        tool_name = tool_call["function"]["name"]
+        async with semaphore:
+            await _emit(on_event, "tool_start", {
+                "tool_call_id": tool_call.get("id"),
+                "name": tool_name,
+                "arguments": tool_call["function"].get("arguments"),
+            })
+            started = time.perf_counter()
+            result = await _execute_tool_call(tool_call, user_token=user_token, on_event=on_event)
+            await _emit(on_event, "tool_finish", {
+                "tool_call_id": tool_call.get("id"),
+                "name": tool_name,
+                "ok": not (isinstance(result, dict) and result.get("error")),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            })
+            for plan in _expand_plans(result):
+                await _emit(on_event, "plan", {"tool": tool_name, **plan})
+            return result
+
+    return await asyncio.gather(*(_run(tc) for tc in tool_calls))
+
+
+# ====== GỌI LLM (THƯỜNG / STREAMING) ======
+async def _complete(
+    prompt_messages: List[Dict[str, Any]],
+    on_event: Optional[AgentEventCallback] = None,
+):
+    """
+    Gọi chat completion cho 1 iteration, trả về (content, tool_calls dạng dict, usage).
+
+    Có on_event → dùng stream=True: mỗi delta nội dung được báo ngay qua event "token",
+    tool_calls được ghép lại từ các delta theo index.
+    """
+    if on_event is None:
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=prompt_messages,
+            tools=TOOLS,
+            tool_choice="auto",
+            timeout=60.0,  # Timeout 60s cho mỗi LLM call
+        )
+        msg = response.choices[0].message
+        tool_calls = [tc.model_dump() for tc in msg.tool_calls] if msg.tool_calls else []
+        return msg.content, tool_calls, getattr(response, "usage", None)
+
+    stream = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=prompt_messages,
+        tools=TOOLS,
+        tool_choice="auto",
+        timeout=60.0,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    content_parts: List[str] = []
+    tool_calls_by_index: Dict[int, Dict[str, Any]] = {}
+    usage = None
+    async for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content_parts.append(delta.content)
+            await _emit(on_event, "token", {"delta": delta.content})
+        for tc_delta in delta.tool_calls or []:
+            tool_call = tool_calls_by_index.setdefault(
+                tc_delta.index,
+                {"id": None, "type": "function", "function": {"name": "", "arguments": ""}},
+            )
+            if tc_delta.id:
+                tool_call["id"] = tc_delta.id
+            if tc_delta.function is not None:
+                if tc_delta.function.name:
+                    tool_call["function"]["name"] += tc_delta.function.name
+                if tc_delta.function.arguments:
+                    tool_call["function"]["arguments"] += tc_delta.function.arguments
+
+    tool_calls = [tool_calls_by_index[index] for index in sorted(tool_calls_by_index)]
+    return "".join(content_parts) or None, tool_calls, usage
+
+
 # ====== CORE LOOP CHO MỖI LƯỢT AGENT (WEB) ======
-def run_agent_turn(
+async def run_agent_turn(
     history_messages: List[Dict[str, Any]],
     user_token: str,
+    on_event: Optional[AgentEventCallback] = None,
 ) -> Dict[str, Any]:
     """
     Chạy 1 lượt agent cho web/app:
@@ -274,6 +650,10 @@ def run_agent_turn(
     Node sẽ:
       - Lưu lại lịch sử cần thiết vào Mongo (ConversationHistory),
       - Gửi assistant_reply lại cho frontend.
+
+    - on_event (tuỳ chọn, cho endpoint streaming):
+        await on_event(name, data) với name ∈ token / tool_start / tool_finish / plan.
+        Kết quả trả về không đổi.
     """
     # 0) KIỂM TRA CÂU HỎI CÓ LIÊN QUAN ĐẾN SỰ KIỆN KHÔNG (BẮT BUỘC)
     # Lấy tin nhắn user cuối cùng từ history
@@ -286,36 +666,39 @@ def run_agent_turn(
     
     # Nếu có tin nhắn user, kiểm tra xem có liên quan đến sự kiện không
     if last_user_message:
-        if not is_event_related(last_user_message):
+        if not await is_event_related(last_user_message, event_context=_has_event_context(history_messages)):
             # Câu hỏi không liên quan → trả về ngay lập tức với câu từ chối
             rejection_message = "Xin lỗi, tôi không thể giải đáp câu hỏi này. Tôi chỉ có thể hỗ trợ các câu hỏi liên quan đến việc tổ chức và quản lý sự kiện mà thôi."
             suggestion = "Bạn có muốn tôi giúp bạn tạo sự kiện mới hoặc quản lý sự kiện hiện có không?"
             
             # Build messages để lưu vào history
-            messages: List[Dict[str, Any]] = [
-                {"role": "system", "content": AGENT_SYSTEM_PROMPT},
-            ]
-            messages.extend(history_messages or [])
+            messages: List[Dict[str, Any]] = [SYSTEM_MESSAGE]
+            messages.extend(strip_static_prefix(history_messages or []))
             messages.append({
                 "role": "assistant",
                 "content": f"{rejection_message} {suggestion}"
             })
             
             print(f"[AGENT] Rejected non-event question: {last_user_message[:50]}...")
+            await _emit(on_event, "token", {"delta": f"{rejection_message} {suggestion}"})
             return {
                 "assistant_reply": f"{rejection_message} {suggestion}",
                 "messages": messages,
                 "plans": [],
             }
     
-    # 1) Build messages cho OpenAI: prepend system prompt
-    messages: List[Dict[str, Any]] = [
-        {"role": "system", "content": AGENT_SYSTEM_PROMPT},
-    ]
-    messages.extend(history_messages or [])
+    # 1) Build messages cho OpenAI: prepend system prompt (prefix tĩnh, giữ nguyên từng byte)
+    # Phần history cũ được nén thành tóm tắt (chạy nền) để context không phình mãi theo số lượt;
+    # `messages` trả về cho Node cũng là bản đã nén.
+    messages: List[Dict[str, Any]] = [SYSTEM_MESSAGE]
+    messages.extend(compact_history(strip_static_prefix(history_messages or [])))
 
     # Thu thập các "plan" mà tool trả về (epics_plan, tasks_plan, ...)
     collected_plans: List[Dict[str, Any]] = []
+    # Kết quả đầy đủ của các tool không phải plan (context chỉ nhận bản rút gọn)
+    collected_tool_results: List[Dict[str, Any]] = []
+    # Số token gửi lên ở mỗi iteration (để theo dõi chi phí / prompt caching)
+    usage_report: List[Dict[str, Any]] = []
 
     # 2) Loop: model ↔ tools cho đến khi model trả về final answer (không còn tool_calls)
     # Giới hạn số lần lặp để tránh timeout (max 10 tool calls)
@@ -326,19 +709,29 @@ def run_agent_turn(
         iteration += 1
         print(f"[AGENT] Iteration {iteration}/{max_iterations}")
         
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="auto",
-            timeout=60.0,  # Timeout 60s cho mỗi LLM call
-        )
+        # Prefix tĩnh (system + TOOLS) đứng đầu, history cũ bị cắt theo token budget
+        prompt_messages, prompt_report = build_prompt_messages(messages[1:], tools=TOOLS)
 
-        msg = response.choices[0].message
+        content, tool_calls, usage = await _complete(prompt_messages, on_event=on_event)
+
+        cached_details = getattr(usage, "prompt_tokens_details", None)
+        prompt_report.update(
+            iteration=iteration,
+            prompt_tokens=getattr(usage, "prompt_tokens", None),
+            cached_tokens=getattr(cached_details, "cached_tokens", None),
+            completion_tokens=getattr(usage, "completion_tokens", None),
+        )
+        usage_report.append(prompt_report)
+        print(
+            f"[AGENT] Iteration {iteration}: sent ~{prompt_report['total_tokens']} tokens "
+            f"(prefix {prompt_report['prefix_tokens']}, history {prompt_report['history_tokens']}, "
+            f"dropped {prompt_report['dropped_messages']} msgs), "
+            f"usage prompt={prompt_report['prompt_tokens']} cached={prompt_report['cached_tokens']}"
+        )
 
         # Không gọi tool nữa → final answer cho user
-        if not msg.tool_calls:
-            assistant_reply = msg.content or ""
+        if not tool_calls:
+            assistant_reply = content or ""
             messages.append({"role": "assistant", "content": assistant_reply})
             print(f"[AGENT] Final answer after {iteration} iterations, collected {len(collected_plans)} plans")
             return {
@@ -346,6 +739,8 @@ def run_agent_turn(
                 "messages": messages,
                 # Trả thêm danh sách kế hoạch để FE/Node có thể cho user preview & apply
                 "plans": collected_plans,
+                "tool_results": collected_tool_results,
+                "usage": usage_report,
             }
         
         # Nếu đạt max iterations mà vẫn còn tool_calls, trả về với warning
@@ -357,129 +752,39 @@ def run_agent_turn(
                 "assistant_reply": assistant_reply,
                 "messages": messages,
                 "plans": collected_plans,
+                "tool_results": collected_tool_results,
+                "usage": usage_report,
             }
 
         # Có tool_calls → thêm message assistant chứa tool_calls vào history
         messages.append({
             "role": "assistant",
-            "tool_calls": msg.tool_calls,
+            "tool_calls": tool_calls,
         })
 
-        # Thực thi tuần tự từng tool
-        for tool_call in msg.tool_calls:
-            tool_name = tool_call.function.name
-            raw_args = tool_call.function.arguments or "{}"
-            try:
-                tool_args = json.loads(raw_args)
-            except Exception:
-                tool_args = {}
-
-            print(f"[AGENT] calling tool {tool_name} with args={tool_args}")
-
-            try:
-                tool_result = call_tool(tool_name, tool_args, user_token=user_token)
-                print(f"[AGENT] tool {tool_name} success: {json.dumps(tool_result, ensure_ascii=False)[:200]}...")
-                # Nếu tool trả về một "plan" (epics_plan / tasks_plan / ...), lưu lại để trả cho FE.
-                if isinstance(tool_result, dict) and tool_result.get("type") in {"epics_plan", "tasks_plan"}:
-                    collected_plans.append(
-                        {
-                            "tool": tool_name,
-                            **tool_result,
-                        }
-                    )
-            except ValueError as e:
-                # ValueError từ tools thường chứa thông tin lỗi chi tiết
-                error_message = str(e)
-                error_type = "VALUE_ERROR"
-                
-                # Phân tích error message để xác định loại lỗi cụ thể
-                if "timeout" in error_message.lower() or "quá thời gian chờ" in error_message.lower():
-                    error_type = "TIMEOUT_ERROR"
-                    suggestion = "Kết nối đến backend quá thời gian chờ. Vui lòng thử lại sau hoặc kiểm tra kết nối mạng."
-                elif "connection" in error_message.lower() or "kết nối" in error_message.lower():
-                    error_type = "CONNECTION_ERROR"
-                    suggestion = "Không thể kết nối đến backend. Vui lòng kiểm tra xem backend có đang chạy không hoặc thử lại sau."
-                elif "authentication" in error_message.lower() or "401" in error_message or "xác thực" in error_message.lower():
-                    error_type = "AUTHENTICATION_ERROR"
-                    suggestion = "Token xác thực không hợp lệ hoặc đã hết hạn. Vui lòng đăng nhập lại."
-                elif "permission" in error_message.lower() or "403" in error_message or "quyền" in error_message.lower():
-                    error_type = "PERMISSION_ERROR"
-                    suggestion = "Bạn không có quyền thực hiện thao tác này. Vui lòng kiểm tra quyền của bạn."
-                elif "not found" in error_message.lower() or "404" in error_message or "không tìm thấy" in error_message.lower():
-                    error_type = "NOT_FOUND_ERROR"
-                    suggestion = "Không tìm thấy tài nguyên yêu cầu. Vui lòng kiểm tra lại ID hoặc thông tin đã cung cấp."
-                elif "missing" in error_message.lower() or "thiếu" in error_message.lower():
-                    error_type = "MISSING_FIELD_ERROR"
-                    suggestion = "Thiếu thông tin bắt buộc. Vui lòng kiểm tra lại các trường cần thiết."
-                elif "invalid" in error_message.lower() or "không hợp lệ" in error_message.lower():
-                    error_type = "VALIDATION_ERROR"
-                    suggestion = "Thông tin không hợp lệ. Vui lòng kiểm tra lại format hoặc giá trị đã nhập."
-                else:
-                    # Tạo suggestion dựa trên tool name
-                    if tool_name == "create_event":
-                        suggestion = "Vui lòng kiểm tra lại: tên sự kiện, đơn vị tổ chức, ngày bắt đầu/kết thúc (format yyyy-mm-dd), địa điểm, và loại sự kiện (public/private)."
-                    elif tool_name == "get_event_detail_for_ai":
-                        suggestion = "Vui lòng kiểm tra lại eventId hoặc thử lại sau. Nếu vấn đề vẫn tiếp tục, có thể backend đang gặp sự cố."
-                    elif tool_name == "ai_generate_tasks_for_epic":
-                        suggestion = "Vui lòng kiểm tra lại các tham số đầu vào (eventId, epicId, department, eventDescription, eventStartDate) và thử lại."
-                    elif tool_name == "ai_generate_epics_for_event":
-                        if "không sinh được epic" in error_message.lower() or "epic nào" in error_message.lower():
-                            suggestion = "Sự kiện này chưa có ban nào tham gia. Bạn cần thêm ít nhất một ban vào sự kiện trước khi tạo công việc lớn."
-                        else:
-                            suggestion = "Vui lòng kiểm tra lại các tham số đầu vào (eventId, eventDescription, departments) và thử lại."
-                    else:
-                        suggestion = "Vui lòng kiểm tra lại các tham số đầu vào và thử lại."
-                
-                print(f"[AGENT] tool {tool_name} error ({error_type}): {error_message}")
-                
-                # Trả về error message chi tiết để LLM có thể xử lý
-                # Format này giúp AI dễ đọc và hiển thị lỗi cho người dùng
-                tool_result = {
-                    "error": True,
-                    "error_type": error_type,
-                    "error_message": error_message,
-                    "suggestion": suggestion,
-                    "tool_name": tool_name,
-                    "tool_args": tool_args if 'tool_args' in locals() else {},
-                    "message": f"Lỗi khi thực hiện {tool_name}: {error_message}. {suggestion}"
-                }
-            except Exception as e:
-                import traceback
-                error_detail = traceback.format_exc()
-                error_message = str(e)
-                error_type = type(e).__name__
-                
-                print(f"[AGENT] tool {tool_name} error ({error_type}):")
-                print(error_detail)
-                
-                # Tạo suggestion dựa trên tool name và error type
-                if tool_name == "create_event":
-                    suggestion = "Vui lòng kiểm tra lại: tên sự kiện, đơn vị tổ chức, ngày bắt đầu/kết thúc (format yyyy-mm-dd), địa điểm, và loại sự kiện (public/private)."
-                elif tool_name == "get_event_detail_for_ai":
-                    suggestion = "Vui lòng kiểm tra lại eventId hoặc thử lại sau. Nếu vấn đề vẫn tiếp tục, có thể backend đang gặp sự cố."
-                elif tool_name == "ai_generate_tasks_for_epic":
-                    suggestion = "Vui lòng kiểm tra lại các tham số đầu vào (eventId, epicId, department, eventDescription, eventStartDate) và thử lại."
-                elif tool_name == "ai_generate_epics_for_event":
-                    suggestion = "Vui lòng kiểm tra lại các tham số đầu vào (eventId, eventDescription, departments) và thử lại."
-                else:
-                    suggestion = "Vui lòng kiểm tra lại các tham số đầu vào và thử lại."
-                
-                # Trả về error message chi tiết để LLM có thể xử lý
-                tool_result = {
-                    "error": True,
-                    "error_type": error_type,
-                    "error_message": error_message,
-                    "suggestion": suggestion,
-                    "tool_name": tool_name,
-                    "tool_args": tool_args if 'tool_args' in locals() else {},
-                    "message": f"Lỗi không mong đợi khi thực hiện {tool_name}: {error_message}. {suggestion}"
-                }
-
-            # Tool result để model “nhìn thấy” ở vòng lặp kế tiếp
+        # Thực thi song song các tool (có giới hạn), ghép kết quả theo thứ tự tool_calls
+        tool_results = await _execute_tool_calls(tool_calls, user_token=user_token, on_event=on_event)
+
+        for tool_call, tool_result in zip(tool_calls, tool_results):
+            tool_name = tool_call["function"]["name"]
+            # Nếu tool trả về "plan" (epics_plan / tasks_plan / batch tasks_plan), lưu lại để trả cho FE.
+            plans = _expand_plans(tool_result)
+            for plan in plans:
+                collected_plans.append(
+                    {
+                        "tool": tool_name,
+                        **plan,
+                    }
+                )
+            if not plans and isinstance(tool_result, dict) and not tool_result.get("error"):
+                collected_tool_results.append({"tool": tool_name, "result": tool_result})
+
+            # Tool result để model “nhìn thấy” ở vòng lặp kế tiếp: bản rút gọn theo từng tool
+            # (bảng columns/rows, bỏ field backend) để giảm token mỗi iteration.
             messages.append({
                 "role": "tool",
-                "tool_call_id": tool_call.id,
+                "tool_call_id": tool_call["id"],
                 "name": tool_name,
-                "content": json.dumps(tool_result, ensure_ascii=False),
+                "content": encode_tool_result(tool_name, tool_result),
             })
         # quay lại while: model sẽ đọc kết quả tool và quyết định bước tiếp
@@ -176,7 +176,9 @@ Nhiệm vụ chính:
         * Tìm Công việc lớn của ban đó trong epics array (so khớp tên ban, không phân biệt hoa thường)
         * Nếu tìm thấy Công việc lớn → GỌI ai_generate_tasks_for_epic cho Công việc lớn đó
         * Nếu KHÔNG tìm thấy Công việc lớn cho ban đó → TẠO Công việc lớn trước bằng ai_generate_epics_for_event với departments = [tên ban đó], sau đó mới tạo task
-      + Nếu user không chỉ định ban cụ thể → GỌI ai_generate_tasks_for_epic cho TẤT CẢ các Công việc lớn chưa có task (hoặc có ít task)
+      + Nếu user không chỉ định ban cụ thể → GỌI ai_generate_tasks_for_epics MỘT LẦN với epics = TẤT CẢ các Công việc lớn chưa có task (hoặc có ít task)
+        (mỗi phần tử gồm epicId, epicTitle, department; eventId / eventDescription / eventStartDate truyền như bên dưới)
+      + Khi cần tạo task cho từ 2 Công việc lớn trở lên, LUÔN dùng ai_generate_tasks_for_epics thay vì gọi ai_generate_tasks_for_epic nhiều lần
       + Khi gọi ai_generate_tasks_for_epic, cần truyền đúng:
         * eventId (từ ngữ cảnh, string ObjectId)
         * epicId (từ epics array, string ObjectId)
@@ -186,9 +188,12 @@ Nhiệm vụ chính:
         * eventStartDate (từ event.eventStartDate, format yyyy-mm-dd, string) - đây là D-Day (ngày bắt đầu diễn ra sự kiện), dùng làm mốc tham chiếu để tính offset_days_from_event
   * **BƯỚC 3**: Sau khi các tool chạy xong, bạn PHẢI format response theo cấu trúc sau:
     
-    **QUAN TRỌNG**: Khi các tool (ai_generate_epics_for_event, ai_generate_tasks_for_epic) trả về kết quả, 
+    **QUAN TRỌNG**: Khi các tool (ai_generate_epics_for_event, ai_generate_tasks_for_epic, ai_generate_tasks_for_epics) trả về kết quả, 
     bạn sẽ thấy trong tool results có các object với "type": "epics_plan" hoặc "type": "tasks_plan".
+    (ai_generate_tasks_for_epics trả về "type": "tasks_plan_batch": mỗi phần tử trong plans[] là một tasks_plan; errors[] là các Công việc lớn chưa sinh được task.)
     Hãy đọc các kết quả này và format response theo cấu trúc dưới đây.
+    (Trong tool result, các danh sách được rút gọn dạng bảng {"columns": [...], "rows": [[...]]}:
+    mỗi row là một phần tử, giá trị theo đúng thứ tự columns; ví dụ plan.epics.rows[i] ứng với columns title, description, department, phase.)
     
     **Format bắt buộc khi có plans (epics_plan hoặc tasks_plan):**
     
@@ -196,7 +201,7 @@ Nhiệm vụ chính:
        (Lấy tên sự kiện từ event.name trong get_event_detail_for_ai hoặc từ ngữ cảnh)
     
     2. Liệt kê từng Công việc lớn và công việc con (PHẢI dùng markdown **text** để in đậm các title):
-       - Nếu có epics_plan: Đọc từ plan.epics[] (mỗi item có: title, description, department)
+       - Nếu có epics_plan: Đọc từ plan.epics[] (mỗi item có: title, description, department, phase)
        - Nếu có tasks_plan: Đọc từ plan.tasks[] (mỗi item có: title, description) và gắn với Epic tương ứng (từ epicTitle trong tasks_plan)
        - Format cho mỗi Công việc lớn (PHẢI in đậm title bằng **):
          ```
@@ -1,4 +1,7 @@
 # app.py
+import asyncio
+import hmac
+import json
 import os
 import time
 import traceback
@@ -6,24 +9,41 @@ from typing import List, Dict, Any, Optional
 
 from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from agent_core import run_agent_turn  # dùng file bạn đã có
+from agent_core import get_relevance_cache_stats, run_agent_turn  # dùng file bạn đã có
+from tools import node_client
+import rag
+from conversation_summary import get_summary_stats
+from plan_cache import get_plan_cache_stats
+from plan_synthesizer import get_plan_synth_stats
+from relevance_classifier import get_relevance_stats
+from tools.event_detail import get_event_detail_cache_stats, invalidate_event_detail
 
 # ====== Pydantic models ======
 class Message(BaseModel):
     role: str
-    content: str
+    content: Optional[str] = None
+    # Cho phép Node gửi lại nguyên history agent trả về (assistant.tool_calls / message role=tool)
+    tool_calls: Optional[List[Dict[str, Any]]] = None
+    tool_call_id: Optional[str] = None
+    name: Optional[str] = None
 
 class TurnRequest(BaseModel):
     history_messages: List[Message]
     eventId: Optional[str] = None  # Optional: eventId nếu đang ở trong context của một sự kiện
 
+class InvalidateEventDetailRequest(BaseModel):
+    eventId: Optional[str] = None  # None → xoá toàn bộ cache event detail (chỉ service key)
+
 class TurnResponse(BaseModel):
     assistant_reply: str
     messages: List[Dict[str, Any]]
     plans: Optional[List[Dict[str, Any]]] = None  # Thêm plans vào response model
     eventId: Optional[str] = None  # Trả lại eventId để Node backend có thể lưu lịch sử
+    usage: Optional[List[Dict[str, Any]]] = None  # Số token gửi lên ở từng iteration
+    tool_results: Optional[List[Dict[str, Any]]] = None  # Kết quả đầy đủ của tool (context LLM chỉ nhận bản rút gọn)
 
 # Model cho endpoint cũ /api/chat/message (tương thích với backend hiện tại)
 class ChatMessageRequest(BaseModel):
@@ -54,11 +74,71 @@ app.add_middleware(
 )
 
 
+@app.on_event("shutdown")
+async def close_clients():
+    # Đóng connection pool dùng chung tới Node backend
+    await node_client.aclose()
+
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok", "service": "ai-agent"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Số liệu runtime (connection pool tới Node, ...) để sizing khi chạy tải."""
+    return {
+        "node_pool": node_client.get_pool_stats(),
+        "rag_cache": rag.get_cache_stats(),
+        "conversation_summary": get_summary_stats(),
+        "event_detail_cache": get_event_detail_cache_stats(),
+        "relevance_classifier": get_relevance_stats(),
+        "relevance_cache": get_relevance_cache_stats(),
+        "plan_cache": get_plan_cache_stats(),
+        "plan_synthesizer": get_plan_synth_stats(),
+    }
+
+
+@app.post("/agent/cache/event-detail/invalidate")
+async def invalidate_event_detail_cache(
+    payload: InvalidateEventDetailRequest,
+    authorization: Optional[str] = Header(default=None),
+):
+    """
+    Node gọi sau khi event thay đổi (user bấm "Áp dụng" plan, sửa ban/thành viên, ...)
+    để lượt chat kế tiếp không đọc event detail cũ từ cache.
+    Cùng yêu cầu auth như các endpoint khác: Bearer JWT của user hoặc service key.
+    Không có eventId (xoá toàn bộ cache của mọi user) → chỉ chấp nhận service key (MYFEVENT_API_KEY).
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        print("[FastAPI] ERROR: Missing or invalid Authorization header")
+        raise HTTPException(
+            status_code=401,
+            detail="Missing or invalid Authorization header. Please provide a valid Bearer token.",
+        )
+
+    token = authorization.split(" ", 1)[1].strip()
+    if not token:
+        print("[FastAPI] ERROR: Empty token after Bearer prefix")
+        raise HTTPException(
+            status_code=401,
+            detail="Empty authorization token",
+        )
+
+    if not payload.eventId:
+        service_key = node_client.SERVICE_API_KEY
+        if not service_key or not hmac.compare_digest(token, service_key):
+            print("[FastAPI] ERROR: Global event-detail cache flush without service key")
+            raise HTTPException(
+                status_code=403,
+                detail="eventId is required (flushing the whole cache requires the service key)",
+            )
+
+    removed = invalidate_event_detail(payload.eventId)
+    return {"eventId": payload.eventId, "removed": removed}
+
+
 @app.post("/agent/event-planner/turn", response_model=TurnResponse)
 async def event_planner_turn(
     payload: TurnRequest,
@@ -94,7 +174,7 @@ async def event_planner_turn(
     print(f"[FastAPI] Token prefix: {user_token[:20]}...")
 
     # Chuyển Pydantic models → dict cho agent_core
-    history = [m.model_dump() for m in payload.history_messages]
+    history = [m.model_dump(exclude_none=True) for m in payload.history_messages]
     
     # Log để debug lịch sử
     print(f"[FastAPI] History messages count: {len(history)}")
@@ -102,7 +182,7 @@ async def event_planner_turn(
         print(f"[FastAPI] First message role: {history[0].get('role')}")
 
     try:
-        result = run_agent_turn(
+        result = await run_agent_turn(
             history_messages=history,
             user_token=user_token,
         )
@@ -149,6 +229,106 @@ async def event_planner_turn(
     return result
 
 
+# Khoảng thời gian gửi comment keep-alive khi agent chưa có event mới (tránh proxy cắt kết nối)
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+@app.post("/agent/event-planner/turn/stream")
+async def event_planner_turn_stream(
+    payload: TurnRequest,
+    authorization: Optional[str] = Header(default=None),
+):
+    """
+    Phiên bản streaming (Server-Sent Events) của /agent/event-planner/turn.
+
+    Các event:
+      - start       : gửi ngay khi nhận request
+      - token       : {"delta": "..."} từng đoạn câu trả lời của model
+      - tool_start  : {"tool_call_id", "name", "arguments"}
+      - tool_finish : {"tool_call_id", "name", "ok", "duration_ms"}
+      - plan_partial: {"tool_call_id", "name", "index", "item"} từng epic / task ngay khi planner sinh xong
+      - plan_draft  : {"tool_call_id", "name", "type", "plan", "similarity", "sources", ...} bản nháp
+                      tổng hợp từ pattern KB, gửi trước khi LLM planner sinh bản chính
+      - plan        : plan (epics_plan / tasks_plan) ngay khi tool tạo xong
+      - done        : TurnResponse đầy đủ (giống hệt endpoint không streaming)
+      - error       : {"detail": "..."}
+    """
+    print(f"[FastAPI] Received stream request: {len(payload.history_messages)} messages, eventId={payload.eventId}")
+
+    if not authorization or not authorization.startswith("Bearer "):
+        print("[FastAPI] ERROR: Missing or invalid Authorization header")
+        raise HTTPException(
+            status_code=401,
+            detail="Missing or invalid Authorization header. Please provide a valid Bearer token.",
+        )
+
+    user_token = authorization.split(" ", 1)[1].strip()
+    if not user_token:
+        print("[FastAPI] ERROR: Empty token after Bearer prefix")
+        raise HTTPException(
+            status_code=401,
+            detail="Empty authorization token",
+        )
+
+    history = [m.model_dump(exclude_none=True) for m in payload.history_messages]
+    queue: "asyncio.Queue" = asyncio.Queue()
+
+    async def on_event(event: str, data: Dict[str, Any]) -> None:
+        await queue.put((event, data))
+
+    async def run_turn() -> None:
+        try:
+            result = await run_agent_turn(
+                history_messages=history,
+                user_token=user_token,
+                on_event=on_event,
+            )
+            result.setdefault("assistant_reply", "")
+            result.setdefault("messages", [])
+            result.setdefault("plans", [])
+            if payload.eventId:
+                result["eventId"] = payload.eventId
+            await queue.put(("done", TurnResponse(**result).model_dump()))
+        except Exception as e:  # noqa: BLE001
+            print("[FastAPI] ERROR in event_planner_turn_stream:")
+            print(traceback.format_exc())
+            await queue.put(("error", {"detail": f"Agent error: {e}"}))
+        finally:
+            await queue.put(None)
+
+    async def event_stream():
+        yield _sse("start", {"eventId": payload.eventId})
+        task = asyncio.create_task(run_turn())
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if item is None:
+                    break
+                event, data = item
+                yield _sse(event, data)
+        finally:
+            # Client ngắt kết nối giữa chừng → huỷ lượt agent đang chạy
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # nginx: không buffer response
+        },
+    )
+
+
 @app.post("/api/chat/message")
 async def chat_message(
     payload: ChatMessageRequest,
@@ -182,7 +362,7 @@ async def chat_message(
     ]
     
     try:
-        result = run_agent_turn(
+        result = await run_agent_turn(
             history_messages=history,
             user_token=user_token,
         )
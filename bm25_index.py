@@ -0,0 +1,172 @@
+# bm25_index.py
+"""
+Inverted index BM25 cục bộ cho KB, dùng song song với vector search của Chroma (rag.py).
+
+Dense search yếu với từ khoá chính xác / query ngắn ("check-in", "MC", "livestream"):
+BM25 trên token đã bỏ dấu bắt được các trường hợp này, rag.py gộp 2 danh sách bằng
+reciprocal-rank fusion.
+
+- Token: text đã normalize + bỏ dấu (keyword_filter), tách theo chữ/số; từ có gạch nối
+  ("check-in") giữ cả dạng gộp lẫn từng phần; thêm cặp âm tiết liền kề ("su_kien")
+  vì từ tiếng Việt thường gồm nhiều âm tiết.
+- scripts/index_kb.py build lại toàn bộ index từ collection sau mỗi lần KB đổi và ghi ra
+  BM25_INDEX_PATH (JSON, cạnh Chroma); rag.py tự load lại khi file đổi mtime.
+"""
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from keyword_filter import fold_text, normalize_text
+
+CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "./chroma_db")
+BM25_INDEX_PATH = os.getenv("BM25_INDEX_PATH", os.path.join(CHROMA_DB_DIR, "kb_bm25.json"))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Metadata giữ lại trong index để lọc giống where của Chroma
+FILTER_FIELDS = ("kb_group", "level", "department")
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    folded = fold_text(normalize_text(text))
+    tokens: List[str] = []
+    syllables: List[str] = []
+    for match in _TOKEN_RE.finditer(folded):
+        token = match.group(0)
+        tokens.append(token)
+        parts = token.split("-")
+        if len(parts) > 1:
+            tokens.extend(parts)
+        syllables.extend(parts)
+    tokens.extend(f"{a}_{b}" for a, b in zip(syllables, syllables[1:]))
+    return tokens
+
+
+class BM25Index:
+    """
+    ids[i] / meta[i] / lengths[i] mô tả document i; postings: term → [[doc_index, tf], ...].
+    """
+
+    def __init__(self) -> None:
+        self.ids: List[str] = []
+        self.meta: List[Dict[str, Any]] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[List[int]]] = {}
+        self.avgdl = 0.0
+
+    @classmethod
+    def build(cls, records: Iterable[Tuple[str, str, Dict[str, Any]]]) -> "BM25Index":
+        """records: (doc_id, text, metadata)."""
+        index = cls()
+        for doc_id, text, meta in records:
+            doc_index = len(index.ids)
+            tokens = tokenize(text)
+            index.ids.append(doc_id)
+            index.meta.append({k: meta[k] for k in FILTER_FIELDS if meta and meta.get(k) is not None})
+            index.lengths.append(len(tokens))
+            counts: Dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                index.postings.setdefault(token, []).append([doc_index, tf])
+        index.avgdl = sum(index.lengths) / len(index.lengths) if index.lengths else 0.0
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(
+        self,
+        query: str,
+        top_k: int,
+        predicate: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    ) -> List[Tuple[str, float]]:
+        """Top-k (doc_id, score BM25) cho query; predicate(meta) lọc document."""
+        n_docs = len(self.ids)
+        if not n_docs or top_k <= 0:
+            return []
+
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1.0 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_index, tf in postings:
+                norm = BM25_K1 * (1.0 - BM25_B + BM25_B * self.lengths[doc_index] / (self.avgdl or 1.0))
+                scores[doc_index] = scores.get(doc_index, 0.0) + idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+
+        if predicate is not None:
+            scores = {i: s for i, s in scores.items() if predicate(self.meta[i])}
+        best = heapq.nlargest(top_k, scores.items(), key=lambda kv: kv[1])
+        return [(self.ids[i], score) for i, score in best]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "ids": self.ids,
+            "meta": self.meta,
+            "lengths": self.lengths,
+            "postings": self.postings,
+            "avgdl": self.avgdl,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "BM25Index":
+        index = cls()
+        index.ids = data["ids"]
+        index.meta = data["meta"]
+        index.lengths = data["lengths"]
+        index.postings = data["postings"]
+        index.avgdl = data["avgdl"]
+        return index
+
+    def save(self, path: str = BM25_INDEX_PATH) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+        # Ghi atomically: rag.py có thể đang đọc file cũ
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = BM25_INDEX_PATH) -> "BM25Index":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+_lock = threading.Lock()
+_index: Optional[BM25Index] = None
+_loaded_mtime: Optional[float] = None
+
+
+def get_bm25_index() -> Optional[BM25Index]:
+    """Index hiện tại; load lại khi file đổi mtime. Chưa có file / lỗi đọc → None (chỉ dùng dense search)."""
+    global _index, _loaded_mtime
+    try:
+        mtime = os.path.getmtime(BM25_INDEX_PATH)
+    except OSError:
+        mtime = None
+
+    if mtime == _loaded_mtime:
+        return _index
+
+    with _lock:
+        if mtime == _loaded_mtime:
+            return _index
+        if mtime is None:
+            _index = None
+        else:
+            try:
+                _index = BM25Index.load(BM25_INDEX_PATH)
+                print(f"[RAG] BM25 index loaded: {len(_index)} docs from {BM25_INDEX_PATH}")
+            except Exception as e:  # noqa: BLE001
+                print(f"[RAG] WARN: cannot load BM25 index {BM25_INDEX_PATH}: {e}")
+        _loaded_mtime = mtime
+        return _index
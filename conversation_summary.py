@@ -0,0 +1,228 @@
+# conversation_summary.py
+import asyncio
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+from prompt_builder import count_message_tokens, group_units
+from ttl_cache import TTLCache
+
+load_dotenv()
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Khi phần history CŨ (ngoài các lượt gần nhất) vượt ngưỡng này → nén thành tóm tắt
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("AGENT_SUMMARY_TRIGGER_TOKENS", "6000"))
+# Số lượt user gần nhất luôn giữ nguyên văn
+SUMMARY_KEEP_RECENT_TURNS = int(os.getenv("AGENT_SUMMARY_KEEP_RECENT_TURNS", "3"))
+# Giới hạn độ dài mỗi message khi đưa vào LLM tóm tắt (tool result có thể rất dài)
+SUMMARY_INPUT_MAX_CHARS = 2000
+
+SUMMARY_MARKER = "[TÓM TẮT HỘI THOẠI TRƯỚC ĐÓ]"
+
+# Kết quả tool là plan (giống agent_core.PLAN_TYPES / PLAN_BATCH_TYPES): batch chứa nhiều tasks_plan trong plans[]
+PLAN_TYPES = {"epics_plan", "tasks_plan"}
+PLAN_BATCH_TYPES = {"tasks_plan_batch"}
+
+SUMMARY_SYSTEM_PROMPT = """
+Bạn nén lịch sử hội thoại giữa người dùng và trợ lý quản lý sự kiện myFEvent thành bản tóm tắt có cấu trúc,
+để trợ lý tiếp tục hội thoại mà không cần đọc lại toàn bộ lịch sử.
+
+Giữ lại chính xác các ID (eventId, epicId), tên sự kiện, tên ban, ngày tháng, quyết định và yêu cầu của người dùng.
+Bỏ qua lời chào, câu xã giao và nội dung lặp lại. Nếu input có bản tóm tắt cũ, hãy gộp nó vào bản mới.
+
+Output duy nhất: JSON với structure:
+{
+  "events": [{"eventId": "string", "name": "string", "notes": "string"}],
+  "user_goals": ["string"],
+  "decisions": ["string"],
+  "plans": [{"type": "epics_plan | tasks_plan", "eventId": "string", "epicId": "string", "epicTitle": "string", "summary": "string"}],
+  "open_questions": ["string"]
+}
+"""
+
+# key = hash của prefix history đã được tóm tắt → message tóm tắt
+_summary_cache = TTLCache(
+    max_entries=int(os.getenv("AGENT_SUMMARY_CACHE_ENTRIES", "512")),
+    ttl_seconds=float(os.getenv("AGENT_SUMMARY_CACHE_TTL_SECONDS", "21600")),
+)
+_in_flight: Dict[str, asyncio.Task] = {}
+_stats = {"scheduled": 0, "completed": 0, "failed": 0, "compacted_turns": 0, "compacted_messages": 0}
+
+
+def is_summary_message(message: Dict[str, Any]) -> bool:
+    return message.get("role") == "system" and str(message.get("content") or "").startswith(SUMMARY_MARKER)
+
+
+def _fingerprint(message: Dict[str, Any]) -> bytes:
+    return json.dumps(
+        {
+            "role": message.get("role"),
+            "content": message.get("content"),
+            "tool_calls": message.get("tool_calls"),
+            "tool_call_id": message.get("tool_call_id"),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    ).encode("utf-8")
+
+
+def _prefix_keys(units: List[List[Dict[str, Any]]]) -> List[str]:
+    """keys[i] = hash của units[: i + 1] (rolling hash → tìm được prefix dài nhất đã có tóm tắt)."""
+    hasher = hashlib.sha256()
+    keys = []
+    for unit in units:
+        for message in unit:
+            hasher.update(_fingerprint(message))
+        keys.append(hasher.copy().hexdigest())
+    return keys
+
+
+def _split_recent(history: List[Dict[str, Any]]) -> int:
+    """Vị trí bắt đầu của SUMMARY_KEEP_RECENT_TURNS lượt user gần nhất."""
+    seen = 0
+    for idx in range(len(history) - 1, -1, -1):
+        if history[idx].get("role") == "user":
+            seen += 1
+            if seen >= SUMMARY_KEEP_RECENT_TURNS:
+                return idx
+    return 0
+
+
+def _unit_plans(unit: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    plans = []
+    for message in unit:
+        if message.get("role") != "tool":
+            continue
+        try:
+            result = json.loads(message.get("content") or "")
+        except (TypeError, ValueError):
+            continue
+        if not isinstance(result, dict):
+            continue
+        if result.get("type") in PLAN_TYPES:
+            plans.append(result)
+        elif result.get("type") in PLAN_BATCH_TYPES:
+            plans.extend(
+                plan for plan in result.get("plans") or [] if isinstance(plan, dict) and plan.get("type") in PLAN_TYPES
+            )
+    return plans
+
+
+def _is_referenced(unit: List[Dict[str, Any]], recent_text: str) -> bool:
+    """Unit chứa plan mà các lượt gần đây còn nhắc tới (epicId / epicTitle / eventId) → giữ nguyên văn."""
+    for plan in _unit_plans(unit):
+        for key in ("epicId", "epicTitle", "eventId"):
+            value = plan.get(key)
+            if value and str(value) in recent_text:
+                return True
+    return False
+
+
+def _summary_input(messages: List[Dict[str, Any]]) -> str:
+    lines = []
+    for message in messages:
+        role = message.get("role")
+        content = str(message.get("content") or "")
+        if message.get("tool_calls"):
+            calls = [
+                f"{(tc.get('function') or {}).get('name')}({(tc.get('function') or {}).get('arguments')})"
+                for tc in message["tool_calls"]
+                if isinstance(tc, dict)
+            ]
+            content = f"{content} [gọi tool: {'; '.join(calls)}]".strip()
+        if len(content) > SUMMARY_INPUT_MAX_CHARS:
+            content = content[:SUMMARY_INPUT_MAX_CHARS] + "…"
+        lines.append(f"{role}: {content}")
+    return "\n".join(lines)
+
+
+async def _summarize(key: str, messages: List[Dict[str, Any]]) -> None:
+    try:
+        resp = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": _summary_input(messages)},
+            ],
+            response_format={"type": "json_object"},
+            timeout=60.0,
+        )
+        content = resp.choices[0].message.content
+        summary = json.loads(content or "{}")
+        _summary_cache.set(
+            key,
+            {
+                "role": "system",
+                "content": f"{SUMMARY_MARKER}\n{json.dumps(summary, ensure_ascii=False)}",
+            },
+        )
+        _stats["completed"] += 1
+        print(f"[SUMMARY] Summarized {len(messages)} messages into {len(content or '')} chars")
+    except Exception as e:  # noqa: BLE001
+        _stats["failed"] += 1
+        print(f"[SUMMARY] Summarization failed: {e}")
+    finally:
+        _in_flight.pop(key, None)
+
+
+def _schedule(key: str, messages: List[Dict[str, Any]]) -> None:
+    """Tóm tắt chạy nền: lượt hiện tại không phải chờ, lượt sau dùng kết quả từ cache."""
+    if key in _in_flight or _summary_cache.peek(key):
+        return
+    _stats["scheduled"] += 1
+    _in_flight[key] = asyncio.get_running_loop().create_task(_summarize(key, list(messages)))
+
+
+def compact_history(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Nén history trước khi chạy agent:
+      - SUMMARY_KEEP_RECENT_TURNS lượt gần nhất giữ nguyên văn,
+      - Phần cũ hơn: thay prefix dài nhất đã có tóm tắt (trong cache) bằng 1 message tóm tắt;
+        các unit chứa plan còn được nhắc tới ở lượt gần đây vẫn giữ nguyên văn,
+      - Nếu phần cũ (sau khi nén) vẫn vượt SUMMARY_TRIGGER_TOKENS → lên lịch tóm tắt nền
+        cho toàn bộ phần cũ; lượt này dùng history hiện có (prompt_builder sẽ cắt theo budget).
+
+    Phải được gọi trong event loop đang chạy.
+    """
+    split = _split_recent(history)
+    older, recent = history[:split], history[split:]
+    if not older:
+        return history
+
+    units = group_units(older)
+    keys = _prefix_keys(units)
+
+    covered = 0
+    summary_message: Optional[Dict[str, Any]] = None
+    for idx in range(len(keys) - 1, -1, -1):
+        if _summary_cache.peek(keys[idx]):
+            summary_message = _summary_cache.get(keys[idx])
+            covered = idx + 1
+            break
+
+    compacted_older = older
+    if summary_message is not None:
+        recent_text = "\n".join(str(m.get("content") or "") for m in recent)
+        pinned = [m for unit in units[:covered] if _is_referenced(unit, recent_text) for m in unit]
+        remainder = [m for unit in units[covered:] for m in unit]
+        compacted_older = [summary_message] + pinned + remainder
+        _stats["compacted_turns"] += 1
+        _stats["compacted_messages"] += len(older) - len(compacted_older)
+
+    older_tokens = sum(count_message_tokens(m) for m in compacted_older)
+    if older_tokens > SUMMARY_TRIGGER_TOKENS:
+        _schedule(keys[-1], compacted_older)
+
+    return compacted_older + recent
+
+
+def get_summary_stats() -> Dict[str, Any]:
+    stats = dict(_stats)
+    stats["in_flight"] = len(_in_flight)
+    stats["cache"] = _summary_cache.stats()
+    return stats
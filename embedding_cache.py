@@ -0,0 +1,166 @@
+# embedding_cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from typing import Any, Dict, List, Optional, Sequence
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "./chroma_db")
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(CHROMA_DB_DIR, "embedding_cache.sqlite")
+)
+
+
+def embedding_cache_key(model_name: str, text: str) -> str:
+    """Key = sha256(model + text): đổi model là tự động miss, không dùng nhầm vector cũ."""
+    return hashlib.sha256(f"{model_name}\n{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache embedding trên đĩa (SQLite), vector lưu dạng float32 blob.
+    Dùng chung được giữa nhiều lần chạy scripts/index_kb.py.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT NOT NULL,"
+            " dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        if not keys:
+            return found
+        with self._lock:
+            # SQLite giới hạn số tham số mỗi câu lệnh → query theo lô
+            for start in range(0, len(keys), 500):
+                batch = list(keys[start:start + 500])
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    vec = array("f")
+                    vec.frombytes(blob)
+                    found[key] = vec.tolist()
+        return found
+
+    def put_many(self, model_name: str, items: Dict[str, Sequence[float]]) -> None:
+        if not items:
+            return
+        rows = []
+        for key, vector in items.items():
+            vec = array("f", (float(x) for x in vector))
+            rows.append((key, model_name, len(vec), vec.tobytes()))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dim, vector) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    """
+    Bọc một embedding function của Chroma: tra cache trước, chỉ gửi các text
+    chưa có vector sang embedding backend (OpenAI / default), rồi ghi lại vào cache.
+    Re-index KB không đổi → 0 embedding request.
+
+    name() / get_config() / build_from_config(): API embedding function của Chroma bản mới,
+    dùng khi Chroma lưu cấu hình embedding function vào collection và dựng lại lúc mở collection.
+    """
+
+    def __init__(
+        self,
+        inner: EmbeddingFunction,
+        model_name: str,
+        cache: Optional[EmbeddingCache] = None,
+        backend: Optional[str] = None,
+    ):
+        super().__init__()
+        self.inner = inner
+        self.model_name = model_name
+        # Tên backend trong registry embeddings.EMBEDDING_BACKENDS (để build_from_config dựng lại inner)
+        self.backend = backend
+        self.cache = cache or EmbeddingCache()
+        # Có thể được gọi song song từ nhiều thread (bulk ingestion) → khoá khi cập nhật counter
+        self._stats_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.embedding_requests = 0
+
+    def __call__(self, input: Documents) -> Embeddings:
+        texts = list(input)
+        keys = [embedding_cache_key(self.model_name, t) for t in texts]
+        cached = self.cache.get_many(keys)
+
+        missing_idx = [i for i, k in enumerate(keys) if k not in cached]
+        with self._stats_lock:
+            self.cache_hits += len(texts) - len(missing_idx)
+            self.cache_misses += len(missing_idx)
+            if missing_idx:
+                self.embedding_requests += 1
+
+        if missing_idx:
+            fresh = self.inner([texts[i] for i in missing_idx])
+            new_items = {}
+            for i, vec in zip(missing_idx, fresh):
+                vec = [float(x) for x in vec]
+                cached[keys[i]] = vec
+                new_items[keys[i]] = vec
+            self.cache.put_many(self.model_name, new_items)
+
+        return [cached[k] for k in keys]
+
+    @staticmethod
+    def name() -> str:
+        return "myfevent-cached"
+
+    def get_config(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "model_name": self.model_name,
+            "cache_path": self.cache.path,
+        }
+
+    @staticmethod
+    def build_from_config(config: Dict[str, Any]) -> "CachedEmbeddingFunction":
+        # Import tại chỗ: embeddings.py import module này
+        from embeddings import create_embedding_function, get_embedding_spec
+
+        spec = get_embedding_spec(config.get("backend"))
+        if spec["model"] != config.get("model_name"):
+            raise ValueError(
+                f"Embedding backend '{spec['name']}' dùng model {spec['model']}, "
+                f"khác model đã lưu trong config: {config.get('model_name')}"
+            )
+        return CachedEmbeddingFunction(
+            create_embedding_function(spec, cached=False),
+            model_name=spec["model"],
+            cache=EmbeddingCache(config.get("cache_path") or EMBEDDING_CACHE_PATH),
+            backend=spec["name"],
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "embedding_requests": self.embedding_requests,
+        }
@@ -0,0 +1,105 @@
+# embeddings.py
+# Registry embedding dùng chung cho indexer (scripts/index_kb.py) và query path (rag.py).
+#
+# Cả hai phía PHẢI dùng cùng một model embedding, nếu không distance giữa query và
+# document là vô nghĩa (khác không gian vector). Registry:
+#   - chọn backend theo KB_EMBEDDING_BACKEND (mặc định: openai-small nếu có OPENAI_API_KEY),
+#   - ghi model + dimension vào metadata của collection khi index,
+#   - kiểm tra metadata đó ở phía query và từ chối query nếu không khớp.
+import os
+from typing import Any, Dict, Optional
+
+from chromadb.utils import embedding_functions
+
+from embedding_cache import CachedEmbeddingFunction
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# name -> spec. "model" được dùng làm key cache embedding và ghi vào metadata collection.
+EMBEDDING_BACKENDS: Dict[str, Dict[str, Any]] = {
+    "openai-small": {"provider": "openai", "model": "text-embedding-3-small", "dim": 1536},
+    "openai-large": {"provider": "openai", "model": "text-embedding-3-large", "dim": 3072},
+    "chroma-default": {"provider": "chroma", "model": "all-MiniLM-L6-v2", "dim": 384},
+}
+
+META_BACKEND = "embedding_backend"
+META_MODEL = "embedding_model"
+META_DIM = "embedding_dim"
+# INDEX_SCHEMA_VERSION của scripts/index_kb.py (collection index trước khi có doc con epic / task không có)
+META_INDEX_SCHEMA = "kb_index_schema"
+
+
+class EmbeddingMismatchError(RuntimeError):
+    """Collection được index bằng model embedding khác với model đang dùng để query."""
+
+
+def get_embedding_spec(name: Optional[str] = None) -> Dict[str, Any]:
+    name = name or os.getenv("KB_EMBEDDING_BACKEND") or ("openai-small" if OPENAI_API_KEY else "chroma-default")
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(
+            f"KB_EMBEDDING_BACKEND '{name}' không hợp lệ. Các giá trị hỗ trợ: {', '.join(EMBEDDING_BACKENDS)}"
+        )
+    spec = dict(EMBEDDING_BACKENDS[name])
+    spec["name"] = name
+    if spec["provider"] == "openai" and not OPENAI_API_KEY:
+        raise ValueError(f"Embedding backend '{name}' cần OPENAI_API_KEY")
+    return spec
+
+
+def create_embedding_function(spec: Optional[Dict[str, Any]] = None, cached: bool = True):
+    """Embedding function của Chroma theo spec, mặc định bọc cache trên đĩa."""
+    spec = spec or get_embedding_spec()
+    if spec["provider"] == "openai":
+        inner = embedding_functions.OpenAIEmbeddingFunction(
+            api_key=OPENAI_API_KEY,
+            model_name=spec["model"],
+        )
+    else:
+        inner = embedding_functions.DefaultEmbeddingFunction()
+    if not cached:
+        return inner
+    return CachedEmbeddingFunction(inner, model_name=spec["model"], backend=spec["name"])
+
+
+def collection_metadata(spec: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        META_BACKEND: spec["name"],
+        META_MODEL: spec["model"],
+        META_DIM: spec["dim"],
+    }
+
+
+def describe_collection_embedding(collection) -> Optional[Dict[str, Any]]:
+    """Đọc model/dimension đã ghi trong metadata collection (None nếu collection cũ chưa ghi)."""
+    meta = collection.metadata or {}
+    if META_MODEL not in meta:
+        return None
+    return {
+        "name": meta.get(META_BACKEND),
+        "model": meta.get(META_MODEL),
+        "dim": meta.get(META_DIM),
+    }
+
+
+def check_collection_embedding(collection, spec: Dict[str, Any]) -> None:
+    """Raise EmbeddingMismatchError nếu collection được index bằng model/dimension khác spec."""
+    indexed = describe_collection_embedding(collection)
+    if indexed is None:
+        print(
+            f"[WARN] Collection '{collection.name}' chưa ghi embedding model trong metadata. "
+            "Hãy chạy lại scripts/index_kb.py để ghi nhận model."
+        )
+        return
+    if indexed["model"] != spec["model"] or int(indexed["dim"] or 0) != int(spec["dim"]):
+        raise EmbeddingMismatchError(
+            f"Collection '{collection.name}' được index bằng {indexed['model']} (dim={indexed['dim']}) "
+            f"nhưng đang query bằng {spec['model']} (dim={spec['dim']}). "
+            "Đặt KB_EMBEDDING_BACKEND khớp với lúc index, hoặc chạy `python scripts/index_kb.py --full`."
+        )
+
+
+def stamp_collection_embedding(collection, spec: Dict[str, Any]) -> None:
+    """Ghi model/dimension vào metadata collection (giữ nguyên các key khác, bỏ qua hnsw:*)."""
+    meta = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+    meta.update(collection_metadata(spec))
+    collection.modify(metadata=meta)
@@ -0,0 +1,28 @@
+# kb_version.py
+import os
+import time
+from typing import Optional
+
+CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "./chroma_db")
+
+# File đánh dấu "phiên bản" KB: scripts/index_kb.py ghi lại mỗi khi collection thay đổi,
+# các process phục vụ query (rag.py) so sánh để tự invalidate cache.
+KB_VERSION_FILE = os.path.join(CHROMA_DB_DIR, "kb_version")
+
+
+def bump_kb_version() -> str:
+    """Ghi version mới (timestamp ns) sau khi index xong."""
+    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+    version = str(time.time_ns())
+    with open(KB_VERSION_FILE, "w", encoding="utf-8") as f:
+        f.write(version)
+    return version
+
+
+def get_kb_version() -> Optional[str]:
+    """Version hiện tại của KB, None nếu chưa từng index."""
+    try:
+        with open(KB_VERSION_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,171 @@
+# keyword_filter.py
+"""
+Bộ lọc từ khoá cho is_event_related: mọi keyword (sự kiện / không liên quan) được
+biên dịch thành MỘT automaton Aho-Corasick, phân loại 1 message = 1 lượt quét tuyến tính.
+
+- Text và keyword được chuẩn hoá: NFC, lowercase, bỏ dấu tiếng Việt (đ → d),
+  nên "sự kiện", "su kien", "sư kiên" khớp như nhau.
+- Keyword trong "exact" chỉ khớp khi đúng dấu trên text gốc (vd 'ban' không khớp 'bạn').
+- Keyword đọc từ config/event_keywords.json (hoặc EVENT_KEYWORDS_PATH),
+  tự build lại automaton khi file thay đổi → sửa keyword không cần sửa code.
+"""
+import json
+import os
+import threading
+import unicodedata
+from collections import deque
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+EVENT_KEYWORDS_PATH = os.getenv(
+    "EVENT_KEYWORDS_PATH",
+    os.path.join(PROJECT_ROOT, "config", "event_keywords.json"),
+)
+
+LABEL_EVENT = "event"
+LABEL_NON_EVENT = "non_event"
+
+
+def _fold_char(ch: str) -> str:
+    """1 ký tự → 1 ký tự không dấu (giữ nguyên độ dài để index text gốc / text đã fold trùng nhau)."""
+    if ch in ("đ", "Đ"):
+        return "d"
+    decomposed = unicodedata.normalize("NFD", ch)
+    return decomposed[0] if decomposed else ch
+
+
+def normalize_text(text: str) -> str:
+    """NFC + lowercase (giữ dấu): dùng để kiểm tra keyword "exact"."""
+    return unicodedata.normalize("NFC", text or "").lower()
+
+
+def fold_text(normalized: str) -> str:
+    """Bỏ dấu từng ký tự trên text đã normalize_text; len(kết quả) == len(đầu vào)."""
+    return "".join(_fold_char(ch) for ch in normalized)
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick trên text đã fold. Mỗi pattern gắn với 1 label và (tuỳ chọn) dạng có dấu
+    bắt buộc; match trả về tập label xuất hiện trong text.
+    """
+
+    def __init__(self, patterns: List[Tuple[str, str, Optional[str]]]):
+        # patterns: [(folded_keyword, label, exact_keyword | None)]
+        self.patterns = patterns
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+
+        for index, (folded, _label, _exact) in enumerate(patterns):
+            state = 0
+            for ch in folded:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(index)
+
+        # BFS build failure links; output của state = output riêng + output của fail state
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def match_labels(self, text: str) -> Set[str]:
+        """Các label có keyword xuất hiện trong text (1 lượt quét)."""
+        normalized = normalize_text(text)
+        folded = fold_text(normalized)
+        labels: Set[str] = set()
+        state = 0
+        for pos, ch in enumerate(folded):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            for index in self._out[state]:
+                folded_kw, label, exact = self.patterns[index]
+                if label in labels:
+                    continue
+                if exact is not None:
+                    start = pos - len(folded_kw) + 1
+                    if normalized[start:pos + 1] != exact:
+                        continue
+                labels.add(label)
+        return labels
+
+
+def _load_patterns(path: str) -> List[Tuple[str, str, Optional[str]]]:
+    with open(path, "r", encoding="utf-8") as f:
+        config: Dict[str, Any] = json.load(f)
+
+    patterns: List[Tuple[str, str, Optional[str]]] = []
+    seen = set()
+    for label in (LABEL_EVENT, LABEL_NON_EVENT):
+        section = config.get(label) or {}
+        for keyword in section.get("keywords") or []:
+            folded = fold_text(normalize_text(keyword).strip())
+            if folded and (folded, label, None) not in seen:
+                seen.add((folded, label, None))
+                patterns.append((folded, label, None))
+        for keyword in section.get("exact") or []:
+            exact = normalize_text(keyword).strip()
+            folded = fold_text(exact)
+            if folded and (folded, label, exact) not in seen:
+                seen.add((folded, label, exact))
+                patterns.append((folded, label, exact))
+    return patterns
+
+
+_lock = threading.Lock()
+_automaton: Optional[KeywordAutomaton] = None
+_loaded_mtime: Optional[float] = None
+
+
+def get_automaton() -> KeywordAutomaton:
+    """Automaton hiện tại; build lại nếu file config đổi mtime (lỗi đọc file → giữ bản cũ)."""
+    global _automaton, _loaded_mtime
+    try:
+        mtime = os.path.getmtime(EVENT_KEYWORDS_PATH)
+    except OSError:
+        mtime = None
+
+    if _automaton is not None and mtime == _loaded_mtime:
+        return _automaton
+
+    with _lock:
+        if _automaton is not None and mtime == _loaded_mtime:
+            return _automaton
+        try:
+            patterns = _load_patterns(EVENT_KEYWORDS_PATH)
+            _automaton = KeywordAutomaton(patterns)
+            print(f"[INFO] keyword_filter: loaded {len(patterns)} keywords from {EVENT_KEYWORDS_PATH}")
+        except Exception as e:  # noqa: BLE001
+            print(f"[WARN] keyword_filter: cannot load {EVENT_KEYWORDS_PATH}: {e}")
+            if _automaton is None:
+                _automaton = KeywordAutomaton([])
+        _loaded_mtime = mtime
+        return _automaton
+
+
+def classify_keywords(message: str) -> Optional[bool]:
+    """
+    True  → có keyword sự kiện.
+    False → chỉ có keyword không liên quan (không có keyword sự kiện nào).
+    None  → không khớp keyword nào, để tầng sau (LLM) quyết định.
+    """
+    labels = get_automaton().match_labels(message)
+    if LABEL_EVENT in labels:
+        return True
+    if LABEL_NON_EVENT in labels:
+        return False
+    return None
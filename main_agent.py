@@ -1,11 +1,12 @@
 # main_agent.py
+import asyncio
 import os
 import sys
 import json
 from typing import List, Dict, Any
 
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # Load .env
 load_dotenv()
@@ -19,7 +20,7 @@ from tools.epics import ai_generate_epics_for_event_tool
 from tools.tasks import ai_generate_tasks_for_epic_tool
 from agent_system_prompt import AGENT_SYSTEM_PROMPT
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # =========================
 # 1) KHAI BÁO TOOLS
@@ -109,11 +110,11 @@ TOOLS = [
 # =========================
 # 2) MAP TÊN TOOL -> HÀM PYTHON
 # =========================
-def call_tool(name: str, arguments: Dict[str, Any], user_token: str) -> Dict[str, Any]:
+async def call_tool(name: str, arguments: Dict[str, Any], user_token: str) -> Dict[str, Any]:
     if name == "ai_generate_epics_for_event":
-        return ai_generate_epics_for_event_tool(arguments, user_token=user_token)
+        return await ai_generate_epics_for_event_tool(arguments, user_token=user_token)
     elif name == "ai_generate_tasks_for_epic":
-        return ai_generate_tasks_for_epic_tool(arguments, user_token=user_token)
+        return await ai_generate_tasks_for_epic_tool(arguments, user_token=user_token)
     else:
         raise ValueError(f"Unknown tool name: {name}")
 
@@ -121,12 +122,15 @@ def call_tool(name: str, arguments: Dict[str, Any], user_token: str) -> Dict[str
 # =========================
 # 3) VÒNG LẶP CLI
 # =========================
-def run_agent_cli(user_token: str):
+async def run_agent_cli(user_token: str):
     """
     Demo CLI:
       - User nhập prompt.
       - Agent hỏi thêm info nếu thiếu.
       - Khi đủ, gọi create_event -> sau đó có thể gọi EPIC/TASK tùy cuộc hội thoại.
+
+    Tools là async (dùng chung AsyncOpenAI + httpx client) nên cả phiên CLI
+    chạy trong MỘT event loop (asyncio.run ở __main__).
     """
     messages: List[Dict[str, Any]] = [
         {"role": "system", "content": AGENT_SYSTEM_PROMPT},
@@ -144,7 +148,7 @@ def run_agent_cli(user_token: str):
         messages.append({"role": "user", "content": user_input})
 
         # Gọi OpenAI với tools
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=messages,
             tools=TOOLS,
@@ -163,7 +167,7 @@ def run_agent_cli(user_token: str):
                 print(json.dumps(tool_args, ensure_ascii=False, indent=2))
 
                 try:
-                    tool_result = call_tool(tool_name, tool_args, user_token=user_token)
+                    tool_result = await call_tool(tool_name, tool_args, user_token=user_token)
                 except Exception as e:
                     tool_result = {"error": str(e)}
                     print(f"❌ Lỗi khi gọi tool {tool_name}: {e}")
@@ -185,7 +189,7 @@ def run_agent_cli(user_token: str):
                 )
 
             # Gọi lại model để nó trả lời user dựa trên kết quả tool
-            followup = client.chat.completions.create(
+            followup = await client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=messages,
             )
@@ -208,4 +212,4 @@ if __name__ == "__main__":
         sys.exit(1)
 
     print(f"JWT prefix = {jwt[:20]}...")
-    run_agent_cli(user_token=jwt)
+    asyncio.run(run_agent_cli(user_token=jwt))
@@ -0,0 +1,197 @@
+# plan_cache.py
+"""
+Cache ngữ nghĩa cho kế hoạch EPIC (ai_generate_epics_for_event).
+
+User hay bấm tạo lại, các CLB tổ chức cùng một kiểu sự kiện mỗi kỳ → mô tả gần như giống hệt.
+Key = embedding của (mô tả sự kiện, danh sách ban đã sort) bằng embedding backend của registry
+(rag.embedding_fn). Chỉ so với các entry có CÙNG tập ban (plan gán epic theo ban),
+dùng lại plan khi cosine >= PLAN_CACHE_SIMILARITY.
+
+- LRU (PLAN_CACHE_MAX_ENTRIES) + TTL (PLAN_CACHE_TTL_SECONDS), xoá sạch khi KB đổi version.
+- Bypass: PLAN_CACHE_ENABLED=0 hoặc tool arg bypassCache=true (user muốn phương án khác).
+"""
+import copy
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from kb_version import get_kb_version
+from keyword_filter import normalize_text
+from rag import embedding_fn
+
+PLAN_CACHE_ENABLED = os.getenv("PLAN_CACHE_ENABLED", "1") not in ("0", "false", "False")
+PLAN_CACHE_SIMILARITY = float(os.getenv("PLAN_CACHE_SIMILARITY", "0.95"))
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "256"))
+PLAN_CACHE_TTL_SECONDS = float(os.getenv("PLAN_CACHE_TTL_SECONDS", str(14 * 24 * 3600)))
+
+
+def _departments_key(departments: List[str]) -> Tuple[str, ...]:
+    return tuple(sorted({" ".join(normalize_text(d).split()) for d in departments if d and d.strip()}))
+
+
+def _plan_text(description: str, departments_key: Tuple[str, ...]) -> str:
+    return f"{' '.join(normalize_text(description).split())}\nDepartments: {', '.join(departments_key)}"
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class SemanticPlanCache:
+    """
+    Store in-memory: entry_id → {expires_at, departments_key, vector (đã chuẩn hoá), plan, latency_ms}.
+    Thread-safe; embed chạy ngoài lock (gọi mạng / model).
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._kb_version = get_kb_version()
+        self.stats_counters = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stores": 0,
+            "evictions": 0,
+            "embed_errors": 0,
+            "saved_latency_ms": 0.0,
+            "hit_similarity_sum": 0.0,
+        }
+
+    def _sync_kb_version(self) -> None:
+        # Plan được sinh từ template trong KB → KB đổi thì plan cũ không còn đại diện
+        version = get_kb_version()
+        if version != self._kb_version:
+            print(f"[PLAN_CACHE] KB version changed ({self._kb_version} -> {version}), clearing plan cache")
+            self._entries.clear()
+            self._kb_version = version
+
+    def _embed(self, description: str, departments_key: Tuple[str, ...]) -> Optional[List[float]]:
+        try:
+            vector = embedding_fn([_plan_text(description, departments_key)])[0]
+            return _normalize([float(x) for x in vector])
+        except Exception as e:  # noqa: BLE001
+            self.stats_counters["embed_errors"] += 1
+            print(f"[PLAN_CACHE] embed failed, skipping cache: {e}")
+            return None
+
+    def lookup(self, description: str, departments: List[str]) -> Tuple[Optional[Dict[str, Any]], Optional[List[float]]]:
+        """
+        Trả về (hit, vector). hit = {"plan", "similarity", "saved_latency_ms"} hoặc None.
+        vector được trả lại để store() sau khi sinh plan mới không phải embed lần nữa.
+        """
+        departments_key = _departments_key(departments)
+        vector = self._embed(description, departments_key)
+        now = time.monotonic()
+
+        with self._lock:
+            self.stats_counters["lookups"] += 1
+            if vector is None:
+                self.stats_counters["misses"] += 1
+                return None, None
+            self._sync_kb_version()
+
+            best_id, best_sim = None, -1.0
+            for entry_id, entry in list(self._entries.items()):
+                if entry["expires_at"] <= now:
+                    del self._entries[entry_id]
+                    continue
+                if entry["departments_key"] != departments_key:
+                    continue
+                sim = sum(a * b for a, b in zip(vector, entry["vector"]))
+                if sim > best_sim:
+                    best_id, best_sim = entry_id, sim
+
+            if best_id is None or best_sim < self.similarity:
+                self.stats_counters["misses"] += 1
+                return None, vector
+
+            entry = self._entries[best_id]
+            self._entries.move_to_end(best_id)
+            self.stats_counters["hits"] += 1
+            self.stats_counters["saved_latency_ms"] += entry["latency_ms"]
+            self.stats_counters["hit_similarity_sum"] += best_sim
+            return {
+                "plan": copy.deepcopy(entry["plan"]),
+                "similarity": round(best_sim, 4),
+                "saved_latency_ms": round(entry["latency_ms"], 1),
+            }, vector
+
+    def store(
+        self,
+        description: str,
+        departments: List[str],
+        plan: Dict[str, Any],
+        latency_ms: float,
+        vector: Optional[List[float]] = None,
+    ) -> None:
+        departments_key = _departments_key(departments)
+        if vector is None:
+            vector = self._embed(description, departments_key)
+            if vector is None:
+                return
+        with self._lock:
+            self._sync_kb_version()
+            # Plan mới (vd user bấm tạo lại) thay thế entry gần như trùng của cùng tập ban
+            for entry_id, entry in list(self._entries.items()):
+                if entry["departments_key"] == departments_key and \
+                        sum(a * b for a, b in zip(vector, entry["vector"])) >= self.similarity:
+                    del self._entries[entry_id]
+            self._entries[self._next_id] = {
+                "expires_at": time.monotonic() + self.ttl_seconds,
+                "departments_key": departments_key,
+                "vector": vector,
+                "plan": copy.deepcopy(plan),
+                "latency_ms": latency_ms,
+            }
+            self._next_id += 1
+            self.stats_counters["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats_counters["evictions"] += 1
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.stats_counters["bypassed"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        c = self.stats_counters
+        decided = c["hits"] + c["misses"]
+        return {
+            "enabled": PLAN_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "similarity_threshold": self.similarity,
+            "lookups": c["lookups"],
+            "hits": c["hits"],
+            "misses": c["misses"],
+            "hit_rate": round(c["hits"] / decided, 4) if decided else None,
+            "bypassed": c["bypassed"],
+            "stores": c["stores"],
+            "evictions": c["evictions"],
+            "embed_errors": c["embed_errors"],
+            "avoided_llm_calls": c["hits"],
+            "saved_latency_ms": round(c["saved_latency_ms"], 1),
+            "avg_hit_similarity": round(c["hit_similarity_sum"] / c["hits"], 4) if c["hits"] else None,
+        }
+
+
+plan_cache = SemanticPlanCache(
+    max_entries=PLAN_CACHE_MAX_ENTRIES,
+    ttl_seconds=PLAN_CACHE_TTL_SECONDS,
+    similarity=PLAN_CACHE_SIMILARITY,
+)
+
+
+def get_plan_cache_stats() -> Dict[str, Any]:
+    return plan_cache.stats()
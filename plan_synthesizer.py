@@ -0,0 +1,295 @@
+# plan_synthesizer.py
+"""
+Sinh plan EPIC / TASK trực tiếp từ pattern trong KB, không gọi LLM.
+
+Pattern (kb/patterns/*.json) đã có sẵn epics đầy đủ: department, phase, priority, order_index
+và tasks lồng bên trong (depends_on theo task_key, suggested_offset_days). Module này map
+pattern khớp nhất (hoặc gộp top-k) sang ĐÚNG tên các ban của sự kiện và ngày bắt đầu sự kiện,
+trả về plan cùng schema với planner LLM (epics_plan / tasks_plan) trong vài mili-giây.
+
+- Độ giống của pattern lấy từ distance của chunk RAG (collection dùng L2 trên vector đã chuẩn hoá
+  → cosine = 1 - distance / 2).
+- Plan "high confidence" (pattern đủ giống + phủ đủ các ban / khớp đúng EPIC) → tool trả luôn,
+  bỏ qua LLM. Ngược lại plan tổng hợp được gửi như bản nháp (on_draft) trong lúc LLM sinh bản chính.
+- PLAN_SYNTH_MODE: "auto" (mặc định, dùng trực tiếp khi high confidence + gửi nháp),
+  "draft" (chỉ gửi nháp, luôn gọi LLM), "off".
+"""
+import os
+from datetime import date, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from keyword_filter import fold_text, normalize_text
+
+PLAN_SYNTH_MODE = os.getenv("PLAN_SYNTH_MODE", "auto").lower()
+PLAN_SYNTH_TOP_K = int(os.getenv("PLAN_SYNTH_TOP_K", "2"))
+PLAN_SYNTH_MIN_SIMILARITY = float(os.getenv("PLAN_SYNTH_MIN_SIMILARITY", "0.8"))
+PLAN_SYNTH_MIN_COVERAGE = float(os.getenv("PLAN_SYNTH_MIN_COVERAGE", "1.0"))
+PLAN_SYNTH_MIN_TITLE_MATCH = float(os.getenv("PLAN_SYNTH_MIN_TITLE_MATCH", "0.6"))
+
+# Callback nhận bản nháp ngay khi tổng hợp xong: await on_draft(draft)
+DraftCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Key ban trong pattern → các cách gọi tên ban thường gặp (đã bỏ dấu, so khớp theo nguyên từ)
+DEPARTMENT_ALIASES: Dict[str, List[str]] = {
+    "media": ["media", "truyen thong", "communication", "marketing", "design", "thiet ke"],
+    "logistics": ["logistics", "logistic", "hau can", "co so vat chat", "csvc"],
+    "sponsor": ["sponsor", "tai tro", "doi ngoai", "external", "partnership"],
+    "program": ["program", "noi dung", "chuong trinh", "content"],
+    "hr": ["hr", "nhan su", "human resource"],
+    "operation": ["operation", "van hanh", "dieu phoi"],
+    "finance": ["finance", "tai chinh", "ke toan"],
+}
+
+# Pattern dùng "during_event", schema planner dùng "event_day"
+_PHASE_ALIASES = {"during_event": "event_day", "event": "event_day"}
+_VALID_PHASES = {"pre_event", "event_day", "post_event"}
+_VALID_PRIORITIES = {"low", "medium", "high"}
+
+_stats = {
+    "epic_plans": 0,
+    "task_plans": 0,
+    "direct": 0,
+    "drafts": 0,
+    "no_match": 0,
+}
+
+
+def _fold(text: Any) -> str:
+    return " ".join(fold_text(normalize_text(str(text or ""))).split())
+
+
+def canonical_department(name: str) -> Optional[str]:
+    """Tên ban bất kỳ ("Ban Truyền thông", "media", ...) → key ban trong pattern, không nhận ra → None."""
+    folded = f" {_fold(name)} "
+    for key, aliases in DEPARTMENT_ALIASES.items():
+        if any(f" {alias} " in folded for alias in aliases):
+            return key
+    return None
+
+
+def _map_department(pattern_department: str, departments: List[str]) -> Optional[str]:
+    """Ban trong pattern → tên ban thật của sự kiện (giữ nguyên cách viết của user)."""
+    folded = _fold(pattern_department)
+    canonical = canonical_department(pattern_department)
+    for department in departments:
+        if _fold(department) == folded:
+            return department
+        if canonical is not None and canonical_department(department) == canonical:
+            return department
+    return None
+
+
+def _chunk_similarity(chunk: Dict[str, Any]) -> Optional[float]:
+    distance = chunk.get("distance")
+    if distance is None:
+        return None
+    return max(0.0, min(1.0, 1.0 - float(distance) / 2.0))
+
+
+def _pattern_docs(kb_chunks: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], float]]:
+    """Các chunk có full_doc chứa epics, kèm similarity, sắp giảm dần."""
+    docs = []
+    for chunk in kb_chunks or []:
+        if not isinstance(chunk, dict):
+            continue
+        similarity = _chunk_similarity(chunk)
+        full_doc = chunk.get("full_doc")
+        if similarity is None or not isinstance(full_doc, dict):
+            continue
+        if isinstance(full_doc.get("epics"), list) and full_doc["epics"]:
+            docs.append((full_doc, similarity))
+    docs.sort(key=lambda pair: pair[1], reverse=True)
+    return docs
+
+
+def _epic_candidates(kb_chunks: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], float, str]]:
+    """
+    (epic, similarity, nguồn) từ cả 2 loại chunk: pattern (full_doc.epics[]) và doc con cấp EPIC
+    của rag.retrieve_epic_tasks (full_doc = chính epic, metadata.parent_id = pattern).
+    """
+    candidates = []
+    for doc, similarity in _pattern_docs(kb_chunks):
+        source = doc.get("id") or doc.get("name") or "unknown"
+        candidates.extend((epic, similarity, source) for epic in doc["epics"] if isinstance(epic, dict))
+    for chunk in kb_chunks or []:
+        if not isinstance(chunk, dict) or (chunk.get("metadata") or {}).get("level") != "epic":
+            continue
+        similarity = _chunk_similarity(chunk)
+        epic = chunk.get("full_doc")
+        if similarity is not None and isinstance(epic, dict):
+            candidates.append((epic, similarity, chunk["metadata"].get("parent_id") or "unknown"))
+    return candidates
+
+
+def _phase(value: Any) -> str:
+    phase = _PHASE_ALIASES.get(str(value or "").lower(), str(value or "").lower())
+    return phase if phase in _VALID_PHASES else "pre_event"
+
+
+def _priority(value: Any) -> str:
+    priority = str(value or "").lower()
+    return priority if priority in _VALID_PRIORITIES else "medium"
+
+
+def _epic_sort_key(epic: Dict[str, Any]) -> Tuple[int, int]:
+    order = epic.get("order_index")
+    return (0 if isinstance(order, int) else 1, order if isinstance(order, int) else 0)
+
+
+def synthesize_epics_plan(kb_chunks: List[Dict[str, Any]], departments: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    Gộp epics của top-k pattern sang các ban của sự kiện.
+
+    Pattern giống nhất được lấy trọn (mọi epic map được ban); các pattern sau chỉ bổ sung epic
+    cho những ban pattern trước chưa phủ. Epic của ban không có trong sự kiện bị bỏ.
+
+    Trả về {"plan": {"epics": [...]}, "similarity", "coverage", "high_confidence", "sources"}
+    hoặc None nếu không có pattern / không map được ban nào.
+    """
+    docs = _pattern_docs(kb_chunks)[:max(1, PLAN_SYNTH_TOP_K)]
+    departments = [d for d in departments if d and str(d).strip()]
+    if not docs or not departments:
+        _stats["no_match"] += 1
+        return None
+
+    epics: List[Dict[str, Any]] = []
+    covered: Set[str] = set()
+    seen_titles: Set[str] = set()
+    sources: List[str] = []
+
+    for rank, (doc, similarity) in enumerate(docs):
+        covered_before = set(covered)
+        used = False
+        for epic in sorted((e for e in doc["epics"] if isinstance(e, dict)), key=_epic_sort_key):
+            department = _map_department(epic.get("department", ""), departments)
+            if department is None or (rank > 0 and department in covered_before):
+                continue
+            title = str(epic.get("title") or "").strip()
+            if not title or _fold(title) in seen_titles:
+                continue
+            seen_titles.add(_fold(title))
+            covered.add(department)
+            used = True
+            epics.append({
+                "title": title,
+                "description": str(epic.get("description") or ""),
+                "department": department,
+                "phase": _phase(epic.get("phase")),
+            })
+        if used:
+            sources.append(doc.get("id") or doc.get("name") or "unknown")
+
+    if not epics:
+        _stats["no_match"] += 1
+        return None
+
+    _stats["epic_plans"] += 1
+    similarity = docs[0][1]
+    coverage = len(covered) / len(departments)
+    return {
+        "plan": {"epics": epics},
+        "similarity": round(similarity, 4),
+        "coverage": round(coverage, 4),
+        "high_confidence": similarity >= PLAN_SYNTH_MIN_SIMILARITY and coverage >= PLAN_SYNTH_MIN_COVERAGE,
+        "sources": sources,
+    }
+
+
+def _title_match(a: str, b: str) -> float:
+    """Jaccard trên tập từ (đã bỏ dấu) của 2 title."""
+    words_a, words_b = set(_fold(a).split()), set(_fold(b).split())
+    if not words_a or not words_b:
+        return 0.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+
+def _parse_date(value: str) -> Optional[date]:
+    try:
+        return date.fromisoformat(str(value or "")[:10])
+    except ValueError:
+        return None
+
+
+def synthesize_tasks_plan(
+    kb_chunks: List[Dict[str, Any]],
+    epic_title: str,
+    department: str = "",
+    event_start_date: str = "",
+) -> Optional[Dict[str, Any]]:
+    """
+    Tìm EPIC (trong pattern hoặc doc cấp EPIC) khớp nhất với (epic_title, department) và chuyển tasks của nó
+    sang schema tasks_plan: depends_on task_key → title, suggested_offset_days →
+    offset_days_from_event (+ due_date tính từ eventStartDate nếu có).
+
+    Trả về {"plan": {"tasks": [...]}, "similarity", "title_match", "high_confidence", "sources"} hoặc None.
+    """
+    canonical = canonical_department(department) if department else None
+    best: Optional[Tuple[float, float, Dict[str, Any], str]] = None
+
+    for epic, similarity, source in _epic_candidates(kb_chunks):
+        if not isinstance(epic.get("tasks"), list) or not epic["tasks"]:
+            continue
+        epic_canonical = canonical_department(epic.get("department", ""))
+        if canonical is not None and epic_canonical is not None and epic_canonical != canonical:
+            continue
+        match = _title_match(epic_title, epic.get("title", ""))
+        if best is None or (match, similarity) > (best[0], best[1]):
+            best = (match, similarity, epic, source)
+
+    if best is None or best[0] == 0.0:
+        _stats["no_match"] += 1
+        return None
+
+    match, similarity, epic, source = best
+    start = _parse_date(event_start_date)
+    template_tasks = sorted((t for t in epic["tasks"] if isinstance(t, dict) and t.get("title")), key=_epic_sort_key)
+    titles_by_key = {t.get("task_key"): str(t["title"]).strip() for t in template_tasks if t.get("task_key")}
+
+    tasks: List[Dict[str, Any]] = []
+    for task in template_tasks:
+        offset = task.get("suggested_offset_days")
+        offset = int(offset) if isinstance(offset, (int, float)) else 0
+        item = {
+            "title": str(task["title"]).strip(),
+            "description": str(task.get("description") or ""),
+            "priority": _priority(task.get("priority")),
+            "can_parallel": bool(task.get("can_parallel", True)),
+            "depends_on": [titles_by_key[k] for k in task.get("depends_on") or [] if k in titles_by_key],
+            "offset_days_from_event": offset,
+        }
+        if start is not None:
+            item["due_date"] = (start + timedelta(days=offset)).isoformat()
+        tasks.append(item)
+
+    _stats["task_plans"] += 1
+    return {
+        "plan": {"tasks": tasks},
+        "similarity": round(similarity, 4),
+        "title_match": round(match, 4),
+        "high_confidence": similarity >= PLAN_SYNTH_MIN_SIMILARITY and match >= PLAN_SYNTH_MIN_TITLE_MATCH,
+        "sources": [source],
+    }
+
+
+def use_directly(synthesized: Optional[Dict[str, Any]]) -> bool:
+    """Plan tổng hợp có được trả luôn (bỏ qua LLM) không."""
+    if synthesized is None or PLAN_SYNTH_MODE != "auto" or not synthesized["high_confidence"]:
+        return False
+    _stats["direct"] += 1
+    return True
+
+
+async def emit_draft(on_draft: Optional[DraftCallback], synthesized: Optional[Dict[str, Any]], **context: Any) -> None:
+    """Gửi plan tổng hợp như bản nháp trong lúc LLM sinh bản chính."""
+    if on_draft is None or synthesized is None or PLAN_SYNTH_MODE == "off":
+        return
+    _stats["drafts"] += 1
+    await on_draft({**context, **synthesized})
+
+
+def get_plan_synth_stats() -> Dict[str, Any]:
+    return {
+        "mode": PLAN_SYNTH_MODE,
+        "min_similarity": PLAN_SYNTH_MIN_SIMILARITY,
+        **_stats,
+    }
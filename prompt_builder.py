@@ -0,0 +1,140 @@
+# prompt_builder.py
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from agent_system_prompt import AGENT_SYSTEM_PROMPT
+
+try:  # tiktoken là optional: có thì đếm token chính xác, không có thì ước lượng theo ký tự
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")  # encoding của gpt-4o / gpt-4o-mini
+except Exception:  # noqa: BLE001
+    _encoding = None
+
+# Ngân sách token cho phần history (KHÔNG tính system prompt + TOOLS)
+HISTORY_TOKEN_BUDGET = int(os.getenv("AGENT_HISTORY_TOKEN_BUDGET", "12000"))
+
+# Overhead mỗi message trong format chat của OpenAI (role, phân tách, ...)
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+# Prefix tĩnh: system prompt luôn là message đầu tiên và giữ nguyên từng byte giữa các lượt/iteration
+# để provider-side prompt caching áp dụng được (cache theo prefix).
+SYSTEM_MESSAGE: Dict[str, Any] = {"role": "system", "content": AGENT_SYSTEM_PROMPT}
+
+_prefix_tokens_cache: Dict[int, int] = {}
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Tiếng Việt có dấu ~3 ký tự / token
+    return len(text) // 3 + 1
+
+
+def _tool_call_arguments(tool_call: Any) -> str:
+    if isinstance(tool_call, dict):
+        function = tool_call.get("function") or {}
+        return f"{function.get('name', '')}{function.get('arguments', '')}"
+    function = getattr(tool_call, "function", None)
+    return f"{getattr(function, 'name', '')}{getattr(function, 'arguments', '')}"
+
+
+def count_message_tokens(message: Dict[str, Any]) -> int:
+    tokens = _MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        tokens += count_tokens(_tool_call_arguments(tool_call))
+    return tokens
+
+
+def count_prefix_tokens(tools: Optional[List[Dict[str, Any]]]) -> int:
+    """Số token của prefix tĩnh (system prompt + schema TOOLS), tính 1 lần rồi nhớ lại."""
+    key = id(tools)
+    if key not in _prefix_tokens_cache:
+        tools_json = json.dumps(tools or [], ensure_ascii=False, separators=(",", ":"))
+        _prefix_tokens_cache[key] = count_message_tokens(SYSTEM_MESSAGE) + count_tokens(tools_json)
+    return _prefix_tokens_cache[key]
+
+
+def strip_static_prefix(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Bỏ các bản copy system prompt trong history (Node lưu lại cả `messages` trả về rồi gửi lại)
+    để prefix không bị lặp và luôn giống hệt nhau.
+    """
+    return [
+        m for m in history
+        if not (m.get("role") == "system" and m.get("content") == AGENT_SYSTEM_PROMPT)
+    ]
+
+
+def group_units(history: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Gom history thành các "unit" không được cắt rời: một assistant có tool_calls
+    luôn đi kèm các tool message trả lời nó (OpenAI báo lỗi nếu thiếu một trong hai).
+    """
+    units: List[List[Dict[str, Any]]] = []
+    for message in history:
+        if message.get("role") == "tool" and units:
+            units[-1].append(message)
+        else:
+            units.append([message])
+    return units
+
+
+def build_prompt_messages(
+    conversation: List[Dict[str, Any]],
+    tools: Optional[List[Dict[str, Any]]] = None,
+    history_token_budget: int = HISTORY_TOKEN_BUDGET,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Dựng danh sách message gửi lên OpenAI cho 1 iteration:
+      - [SYSTEM_MESSAGE] + conversation (không gồm system prompt),
+      - Nếu history vượt history_token_budget → bỏ bớt các unit CŨ NHẤT
+        (trừ message tóm tắt hội thoại, xem conversation_summary.py).
+        Các message từ tin nhắn user cuối cùng trở đi (lượt hiện tại + tool result của lượt này)
+        luôn được giữ nguyên.
+
+    Trả về (messages, report) với report = số token prefix/history/tổng và số message bị cắt.
+    """
+    last_user_idx = None
+    for idx in range(len(conversation) - 1, -1, -1):
+        if conversation[idx].get("role") == "user":
+            last_user_idx = idx
+            break
+    if last_user_idx is None:
+        last_user_idx = len(conversation)
+
+    older_units = group_units(conversation[:last_user_idx])
+    current = conversation[last_user_idx:]
+
+    unit_tokens = [sum(count_message_tokens(m) for m in unit) for unit in older_units]
+    current_tokens = sum(count_message_tokens(m) for m in current)
+    history_tokens = sum(unit_tokens) + current_tokens
+
+    # Message system trong history (tóm tắt hội thoại cũ) luôn được giữ, chỉ cắt các unit khác
+    dropped = set()
+    for idx, unit in enumerate(older_units):
+        if history_tokens <= history_token_budget:
+            break
+        if unit[0].get("role") == "system":
+            continue
+        history_tokens -= unit_tokens[idx]
+        dropped.add(idx)
+    dropped_messages = sum(len(older_units[idx]) for idx in dropped)
+
+    kept: List[Dict[str, Any]] = [
+        m for idx, unit in enumerate(older_units) if idx not in dropped for m in unit
+    ]
+    prefix_tokens = count_prefix_tokens(tools)
+
+    report = {
+        "prefix_tokens": prefix_tokens,
+        "history_tokens": history_tokens,
+        "total_tokens": prefix_tokens + history_tokens,
+        "dropped_messages": dropped_messages,
+        "history_token_budget": history_token_budget,
+        "token_counter": "tiktoken" if _encoding is not None else "estimate",
+    }
+    return [SYSTEM_MESSAGE] + kept + current, report
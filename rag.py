@@ -1,25 +1,240 @@
 # rag.py
 import os
 import json
-import chromadb
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "./chroma_db")
+from bm25_index import get_bm25_index
+from embeddings import (
+    META_INDEX_SCHEMA,
+    EmbeddingMismatchError,
+    check_collection_embedding,
+    create_embedding_function,
+    describe_collection_embedding,
+    get_embedding_spec,
+)
+from kb_version import get_kb_version
+from ttl_cache import TTLCache
+from vector_store import open_vector_store
 
-client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
-collection = client.get_or_create_collection(name="myfevent_kb")
+# Cấp document do scripts/index_kb.py ghi vào metadata "level":
+# pattern / sự kiện gốc → epic (kèm task list trong raw_json) → task
+LEVEL_EVENT = "event"
+LEVEL_EPIC = "epic"
+LEVEL_TASK = "task"
+# Collection index từ schema này trở đi mới có metadata "level" (scripts/index_kb.py INDEX_SCHEMA_VERSION)
+LEVEL_SCHEMA_VERSION = 2
 
+# Dùng CÙNG embedding backend với scripts/index_kb.py (registry trong embeddings.py),
+# nếu không query sẽ bị embed bằng model default của Chroma → distance vô nghĩa.
+# Không bọc cache SQLite của indexer: mỗi query user sẽ bị ghi xuống đĩa (file phình mãi, các worker
+# tranh lock, lưu nguyên văn text user). Query lặp lại đã được _query_cache giữ trong RAM.
+embedding_spec = get_embedding_spec()
+embedding_fn = create_embedding_function(embedding_spec, cached=False)
 
-def _raw_query(query, top_k, kb_groups=None):
+# Vector store theo KB_VECTOR_BACKEND (vector_store.py): Chroma hoặc snapshot numpy in-process,
+# cùng API query / get như collection Chroma
+collection = None
+_embedding_error = None
+
+# Pool nhỏ để chạy song song các search theo group trên cùng 1 query vector
+_query_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-query")
+
+
+def _check_collection_embedding():
+    """
+    So model/dimension ghi trong metadata collection với backend đang dùng.
+    Không khớp → ghi nhận lỗi, mọi query sau đó bị từ chối (thay vì âm thầm trả kết quả sai).
+    """
+    global collection, _embedding_error
+    # Mở lại store để đọc metadata / snapshot mới nhất (indexer có thể vừa rebuild bằng model khác).
+    # Store cũ không close ở đây: query đang chạy trong _query_pool / to_thread có thể còn dùng nó;
+    # hết tham chiếu thì GC tự giải phóng mmap / file.
+    collection = open_vector_store(embedding_fn)
+    try:
+        check_collection_embedding(collection, embedding_spec)
+        _embedding_error = None
+    except EmbeddingMismatchError as e:
+        print(f"[RAG] ERROR: {e}")
+        _embedding_error = e
+    if not _collection_has_levels():
+        print(f"[RAG] WARN: collection '{collection.name}' chưa index theo schema {LEVEL_SCHEMA_VERSION} "
+              f"(chưa có doc con epic / task), bỏ qua filter level. Chạy lại scripts/index_kb.py để migrate.")
+
+
+def _collection_has_levels():
+    """Collection đã được scripts/index_kb.py index với metadata "level" (schema >= LEVEL_SCHEMA_VERSION)."""
+    try:
+        schema = int((collection.metadata or {}).get(META_INDEX_SCHEMA) or 0)
+    except (TypeError, ValueError):
+        schema = 0
+    return schema >= LEVEL_SCHEMA_VERSION
+
+
+_check_collection_embedding()
+
+# Cache kết quả query: user hay retry cùng một mô tả sự kiện → khỏi embed + query lại.
+RAG_CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", "256"))
+RAG_CACHE_TTL_SECONDS = float(os.getenv("RAG_CACHE_TTL_SECONDS", "600"))
+
+_query_cache = TTLCache(max_entries=RAG_CACHE_MAX_ENTRIES, ttl_seconds=RAG_CACHE_TTL_SECONDS)
+
+# Hybrid retrieval: dense (Chroma) + BM25 (bm25_index, do scripts/index_kb.py build) gộp bằng
+# reciprocal-rank fusion. Mỗi bên lấy top_k * RAG_HYBRID_CANDIDATES ứng viên.
+RAG_HYBRID = os.getenv("RAG_HYBRID", "1") not in ("0", "false", "False")
+RAG_HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "3"))
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+_hybrid_stats = {"queries": 0, "dense_only": 0, "lexical_only_hits": 0}
+_cache_kb_version = get_kb_version()
+_cache_version_lock = threading.Lock()
+
+
+def _normalize_query(query):
+    """Chuẩn hoá query làm cache key: lower + gộp khoảng trắng."""
+    return " ".join(str(query).lower().split())
+
+
+def _sync_cache_with_kb_version():
+    """Nếu scripts/index_kb.py vừa thay đổi collection → xoá toàn bộ cache."""
+    global _cache_kb_version
+    version = get_kb_version()
+    if version == _cache_kb_version:
+        return
+    with _cache_version_lock:
+        if version != _cache_kb_version:
+            print(f"[RAG] KB version changed ({_cache_kb_version} -> {version}), clearing query cache")
+            _query_cache.clear()
+            _check_collection_embedding()
+            _cache_kb_version = version
+
+
+def _cached(key, compute):
+    _sync_cache_with_kb_version()
+    chunks = _query_cache.get(key)
+    if chunks is None:
+        chunks = compute()
+        _query_cache.set(key, chunks)
+    # Trả bản copy của list để caller có sửa list cũng không ảnh hưởng cache
+    return list(chunks)
+
+
+def get_cache_stats():
+    stats = _query_cache.stats()
+    stats["kb_version"] = _cache_kb_version
+    bm25 = get_bm25_index() if RAG_HYBRID else None
+    stats["hybrid"] = {
+        "enabled": RAG_HYBRID,
+        "bm25_docs": len(bm25) if bm25 is not None else None,
+        **_hybrid_stats,
+    }
+    stats["vector_store"] = collection.stats()
+    stats["embedding"] = {
+        "query_backend": embedding_spec,
+        "indexed_with": describe_collection_embedding(collection),
+        "error": str(_embedding_error) if _embedding_error else None,
+    }
+    return stats
+
+
+def _embed_query(query):
+    """Embed query bằng backend của registry và kiểm tra dimension với dimension ghi trong collection."""
+    if _embedding_error:
+        raise _embedding_error
+    vector = [float(x) for x in embedding_fn([str(query)])[0]]
+    indexed = describe_collection_embedding(collection)
+    expected_dim = int(indexed["dim"]) if indexed and indexed.get("dim") else embedding_spec["dim"]
+    if len(vector) != expected_dim:
+        raise EmbeddingMismatchError(
+            f"Query embedding dim={len(vector)} ({embedding_spec['model']}) khác với "
+            f"dim={expected_dim} của collection '{collection.name}'"
+        )
+    return vector
+
+
+class KBChunk(dict):
+    """
+    Chunk RAG: dict {"context", "metadata", "full_doc", "doc_id", "distance"}.
+    full_doc chỉ được json.loads từ raw_json khi truy cập lần đầu (chunk["full_doc"] /
+    chunk.get("full_doc")), vì phần lớn caller (tools/epics.py, tools/tasks.py) không dùng tới.
+    Trước lần truy cập đó, "full_doc" chưa nằm trong keys() / items() / `in` (như dict thường).
+    """
+
+    __slots__ = ("_raw_json",)
+
+    def __init__(self, raw_json=None, **fields):
+        super().__init__(**fields)
+        self._raw_json = raw_json
+
+    def _decode_full_doc(self):
+        full_doc = None
+        if self._raw_json:
+            try:
+                full_doc = json.loads(self._raw_json)
+            except Exception:
+                full_doc = None
+        self._raw_json = None
+        dict.__setitem__(self, "full_doc", full_doc)
+        return full_doc
+
+    def __getitem__(self, key):
+        if key == "full_doc" and not dict.__contains__(self, "full_doc"):
+            return self._decode_full_doc()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == "full_doc":
+            full_doc = self["full_doc"]
+            # Không có raw_json / raw_json lỗi → coi như chưa có full_doc
+            return default if full_doc is None else full_doc
+        return dict.get(self, key, default)
+
+
+def _build_where(kb_groups=None, levels=None, department=None):
+    clauses = []
+    if kb_groups:
+        clauses.append({"kb_group": {"$in": list(kb_groups)}})
+    if levels:
+        clauses.append({"level": {"$in": list(levels)}})
+    if department:
+        clauses.append({"department": department})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def _raw_query(
+    query,
+    top_k,
+    kb_groups=None,
+    query_embedding=None,
+    include_full_doc=True,
+    levels=(LEVEL_EVENT,),
+    department=None,
+):
+    """
+    query_embedding: vector đã embed sẵn (để nhiều lần search dùng chung 1 lần embed).
+    include_full_doc=False: bỏ hẳn raw_json khỏi metadata của chunk (full_doc luôn là None),
+      dùng cho hot path chỉ cần context + metadata.
+    levels: chỉ lấy document ở các cấp này (mặc định cấp sự kiện / pattern như trước khi có doc con).
+    department: lọc theo metadata "department" (chỉ doc cấp epic / task có).
+    """
     if not query or not str(query).strip():
         return []
+    if levels and not _collection_has_levels():
+        # Collection index trước khi có doc con: mọi document đều là cấp sự kiện và chưa có
+        # metadata "level" → filter level sẽ loại hết
+        if LEVEL_EVENT not in levels:
+            return []
+        levels = None
 
-    where = None
-    if kb_groups:
-        where = {"kb_group": {"$in": kb_groups}}
+    where = _build_where(kb_groups, levels, department)
+    query_embedding = query_embedding or _embed_query(query)
+    bm25 = get_bm25_index() if RAG_HYBRID else None
+    n_candidates = top_k * max(1, RAG_HYBRID_CANDIDATES) if bm25 is not None else top_k
 
     results = collection.query(
-        query_texts=[query],
-        n_results=top_k,
+        query_embeddings=[query_embedding],
+        n_results=n_candidates,
         where=where,
     )
 
@@ -32,27 +247,84 @@ def _raw_query(query, top_k, kb_groups=None):
     else:
         distances_list = [None] * len(docs)
 
-    chunks = []
-    for doc, meta, doc_id, distance in zip(docs, metas, ids_list, distances_list):
-        raw_json = meta.get("raw_json")
-        full_doc = None
-        if raw_json:
-            try:
-                full_doc = json.loads(raw_json)
-            except Exception:
-                full_doc = None
+    chunks = [
+        _make_chunk(doc, meta, doc_id, distance, include_full_doc)
+        for doc, meta, doc_id, distance in zip(docs, metas, ids_list, distances_list)
+    ]
+    if bm25 is None:
+        return chunks
 
-        chunks.append(
-            {
-                "context": doc,
-                "metadata": meta,
-                "full_doc": full_doc,
-                "doc_id": doc_id,
-                "distance": distance,
-            }
-        )
+    _hybrid_stats["queries"] += 1
+    lexical = bm25.search(
+        query, n_candidates, predicate=lambda meta: _matches_filter(meta, kb_groups, levels, department)
+    )
+    if not lexical:
+        _hybrid_stats["dense_only"] += 1
+        return chunks[:top_k]
+    return _fuse(chunks, lexical, top_k, query_embedding, include_full_doc)
 
-    return chunks
+
+def _make_chunk(doc, meta, doc_id, distance, include_full_doc=True):
+    meta = meta or {}
+    if not include_full_doc and "raw_json" in meta:
+        meta = {k: v for k, v in meta.items() if k != "raw_json"}
+    # raw_json (cả pattern: mọi epic + task) có thể nặng vài KB → không parse ở đây,
+    # KBChunk chỉ json.loads khi có caller thực sự đọc full_doc
+    return KBChunk(
+        raw_json=meta.get("raw_json"),
+        context=doc,
+        metadata=meta,
+        doc_id=doc_id,
+        distance=distance,
+    )
+
+
+def _matches_filter(meta, kb_groups=None, levels=None, department=None):
+    """Cùng điều kiện với _build_where, áp trên metadata lưu trong BM25 index."""
+    if kb_groups and meta.get("kb_group") not in kb_groups:
+        return False
+    if levels and meta.get("level") not in levels:
+        return False
+    if department and meta.get("department") != department:
+        return False
+    return True
+
+
+def _fuse(dense_chunks, lexical, top_k, query_embedding, include_full_doc=True):
+    """
+    Reciprocal-rank fusion: score(doc) = Σ 1 / (RAG_RRF_K + rank) trên 2 danh sách.
+    Doc chỉ BM25 tìm thấy được lấy từ Chroma (kèm embedding) để tính distance như dense search,
+    nên caller lọc theo max_distance / plan_synthesizer vẫn dùng được.
+    """
+    scores = {}
+    for rank, chunk in enumerate(dense_chunks):
+        scores[chunk["doc_id"]] = scores.get(chunk["doc_id"], 0.0) + 1.0 / (RAG_RRF_K + rank + 1)
+    for rank, (doc_id, _score) in enumerate(lexical):
+        scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (RAG_RRF_K + rank + 1)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+    by_id = {chunk["doc_id"]: chunk for chunk in dense_chunks}
+    missing = [doc_id for doc_id in ranked if doc_id not in by_id]
+    if missing:
+        _hybrid_stats["lexical_only_hits"] += len(missing)
+        fetched = collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+        for doc_id, doc, meta, embedding in zip(
+            fetched.get("ids") or [],
+            fetched.get("documents") or [],
+            fetched.get("metadatas") or [],
+            fetched.get("embeddings") if fetched.get("embeddings") is not None else [],
+        ):
+            # Cùng metric với collection (L2 bình phương)
+            distance = sum((float(a) - b) ** 2 for a, b in zip(embedding, query_embedding))
+            by_id[doc_id] = _make_chunk(doc, meta, doc_id, distance, include_full_doc)
+
+    fused = []
+    for doc_id in ranked:
+        chunk = by_id.get(doc_id)
+        if chunk is not None:
+            chunk["rrf_score"] = round(scores[doc_id], 6)
+            fused.append(chunk)
+    return fused
 
 
 def _filter_by_distance(chunks, max_distance=1.0):
@@ -70,14 +342,62 @@ def _filter_by_distance(chunks, max_distance=1.0):
     return good
 
 
-def retrieve_chunks(query, top_k=3, kb_groups=None, max_distance=None):
+def retrieve_chunks(
+    query, top_k=3, kb_groups=None, max_distance=None, include_full_doc=True, levels=(LEVEL_EVENT,)
+):
     """
     Nếu max_distance được set (vd 1.0), sẽ lọc theo ngưỡng.
+    include_full_doc=False: không giữ raw_json / full_doc trong chunk trả về.
+    levels: cấp document cần lấy (mặc định pattern / sự kiện gốc, không lẫn doc con epic / task).
+    Kết quả được cache theo (query đã chuẩn hoá, top_k, kb_groups, max_distance, levels).
+    """
+    if not query or not str(query).strip():
+        return []
+
+    def compute():
+        chunks = _raw_query(
+            query, top_k, kb_groups=kb_groups, include_full_doc=include_full_doc, levels=levels
+        )
+        if max_distance is not None:
+            chunks = _filter_by_distance(chunks, max_distance=max_distance)
+        return chunks
+
+    key = (
+        "chunks",
+        _normalize_query(query),
+        top_k,
+        tuple(sorted(kb_groups)) if kb_groups else None,
+        max_distance,
+        include_full_doc,
+        tuple(levels) if levels else None,
+    )
+    return _cached(key, compute)
+
+
+def retrieve_epic_tasks(query, department=None, top_k=3, max_distance=None):
     """
-    chunks = _raw_query(query, top_k, kb_groups=kb_groups)
-    if max_distance is not None:
-        chunks = _filter_by_distance(chunks, max_distance=max_distance)
-    return chunks
+    Chế độ retrieval cho task planning: tìm doc cấp EPIC khớp nhất thay vì cả pattern.
+    Mỗi chunk trả về có full_doc = đúng 1 epic (title, department, phase, tasks[...]),
+    metadata có parent_id (pattern chứa epic).
+
+    department: key ban trong pattern (vd "media", "logistics"). Không có epic nào của ban đó
+    → tìm lại trên mọi ban.
+    """
+    if not query or not str(query).strip():
+        return []
+
+    def compute():
+        chunks = []
+        if department:
+            chunks = _raw_query(query, top_k, levels=(LEVEL_EPIC,), department=department)
+        if not chunks:
+            chunks = _raw_query(query, top_k, levels=(LEVEL_EPIC,))
+        if max_distance is not None:
+            chunks = _filter_by_distance(chunks, max_distance=max_distance)
+        return chunks
+
+    key = ("epic_tasks", _normalize_query(query), department, top_k, max_distance)
+    return _cached(key, compute)
 
 
 def retrieve_kb_for_event(
@@ -85,6 +405,7 @@ def retrieve_kb_for_event(
     top_k_user_events=4,
     top_k_patterns=2,
     max_distance=1.0,
+    include_full_doc=True,
 ):
     """
     - B1: thử lấy user_event, lọc theo max_distance
@@ -92,36 +413,62 @@ def retrieve_kb_for_event(
       + Nếu rỗng => thử pattern
     - B2: fallback sang pattern, cũng lọc theo max_distance
     - Nếu vẫn rỗng => trả []
+    Kết quả được cache giống retrieve_chunks.
     """
+    if not query or not str(query).strip():
+        return []
 
-    # 1) Ưu tiên dữ liệu từ các sự kiện thực tế
-    user_chunks_raw = _raw_query(
-        query=query,
-        top_k=top_k_user_events,
-        kb_groups=["user_event"],
+    key = (
+        "kb_for_event",
+        _normalize_query(query),
+        top_k_user_events,
+        top_k_patterns,
+        max_distance,
+        include_full_doc,
     )
+    return _cached(
+        key,
+        lambda: _retrieve_kb_for_event_uncached(
+            query, top_k_user_events, top_k_patterns, max_distance, include_full_doc
+        ),
+    )
+
+
+def _retrieve_kb_for_event_uncached(
+    query, top_k_user_events, top_k_patterns, max_distance, include_full_doc=True
+):
+    # Embed query MỘT lần, rồi search song song các group (user_event + pattern) từ cùng vector.
+    # Group pattern được query với đúng top_k của từng nhánh (backup khi có user_event / fallback
+    # khi không có): kết quả hybrid được fuse theo top_k nên không cắt prefix của list top_k khác.
+    query_embedding = _embed_query(query)
+
+    user_future = _query_pool.submit(
+        _raw_query, query, top_k_user_events, ["user_event"], query_embedding, include_full_doc
+    )
+    pattern_futures = {
+        k: _query_pool.submit(_raw_query, query, k, ["pattern"], query_embedding, include_full_doc)
+        for k in {top_k_user_events, top_k_patterns or 0}
+        if k > 0
+    }
+    user_chunks_raw = user_future.result()
+
+    # 1) Ưu tiên dữ liệu từ các sự kiện thực tế
     user_chunks = _filter_by_distance(user_chunks_raw, max_distance=max_distance)
 
     if user_chunks:
         pattern_chunks = []
         if top_k_patterns and top_k_patterns > 0:
-            pattern_chunks_raw = _raw_query(
-                query=query,
-                top_k=top_k_patterns,
-                kb_groups=["pattern"],
-            )
             pattern_chunks = _filter_by_distance(
-                pattern_chunks_raw, max_distance=max_distance
+                pattern_futures[top_k_patterns].result(), max_distance=max_distance
             )
 
         return user_chunks + pattern_chunks
 
     # 2) Nếu chưa có user_event phù hợp -> dùng pattern
-    pattern_chunks_raw = _raw_query(
-        query=query,
-        top_k=top_k_user_events,
-        kb_groups=["pattern"],
-    )
-    pattern_chunks = _filter_by_distance(pattern_chunks_raw, max_distance=max_distance)
+    pattern_chunks = []
+    if top_k_user_events > 0:
+        pattern_chunks = _filter_by_distance(
+            pattern_futures[top_k_user_events].result(), max_distance=max_distance
+        )
 
     return pattern_chunks
@@ -0,0 +1,186 @@
+# relevance_classifier.py
+"""
+Bộ phân loại relevance cục bộ (không gọi mạng) cho is_event_related khi không khớp keyword.
+
+- Vector: hashed n-gram ký tự (3-5) + từ đơn / cặp từ trên text đã bỏ dấu (keyword_filter.fold_text),
+  sparse dict, chuẩn hoá L2 → không cần model / thư viện ngoài, chạy cỡ mili-giây.
+- Model: nearest-centroid (cosine) với 2 nhãn "event" / "other", train từ
+  config/relevance_examples.json (hoặc RELEVANCE_EXAMPLES_PATH) lúc load.
+- Độ tin cậy = chênh lệch cosine giữa 2 centroid; dưới RELEVANCE_CONFIDENCE_THRESHOLD
+  thì trả None để caller fallback sang LLM.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from keyword_filter import PROJECT_ROOT, fold_text, normalize_text
+
+RELEVANCE_EXAMPLES_PATH = os.getenv(
+    "RELEVANCE_EXAMPLES_PATH",
+    os.path.join(PROJECT_ROOT, "config", "relevance_examples.json"),
+)
+RELEVANCE_CONFIDENCE_THRESHOLD = float(os.getenv("RELEVANCE_CONFIDENCE_THRESHOLD", "0.08"))
+
+LABEL_EVENT = "event"
+LABEL_OTHER = "other"
+
+_HASH_DIM = 1 << 20
+_CHAR_NGRAMS = (3, 4, 5)
+
+SparseVector = Dict[int, float]
+
+
+def _hash_feature(feature: str) -> int:
+    # hash() của Python bị random theo process → dùng blake2b để vector ổn định giữa các lần chạy
+    digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % _HASH_DIM
+
+
+def vectorize(text: str) -> SparseVector:
+    """Text → sparse vector (hashed n-gram) đã chuẩn hoá L2."""
+    folded = " ".join(fold_text(normalize_text(text)).split())
+    counts: Dict[int, float] = {}
+
+    padded = f" {folded} "
+    for n in _CHAR_NGRAMS:
+        for i in range(len(padded) - n + 1):
+            idx = _hash_feature("c:" + padded[i:i + n])
+            counts[idx] = counts.get(idx, 0.0) + 1.0
+
+    words = folded.split()
+    for i, word in enumerate(words):
+        idx = _hash_feature("w:" + word)
+        counts[idx] = counts.get(idx, 0.0) + 1.0
+        if i + 1 < len(words):
+            idx = _hash_feature("b:" + word + " " + words[i + 1])
+            counts[idx] = counts.get(idx, 0.0) + 1.0
+
+    # tf sublinear + L2
+    vec = {idx: 1.0 + math.log(count) for idx, count in counts.items()}
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    if norm == 0:
+        return {}
+    return {idx: v / norm for idx, v in vec.items()}
+
+
+def _dot(a: SparseVector, b: SparseVector) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(idx, 0.0) for idx, v in a.items())
+
+
+class NearestCentroidClassifier:
+    """Centroid (đã chuẩn hoá) của mỗi nhãn; predict = nhãn có cosine lớn nhất."""
+
+    def __init__(self) -> None:
+        self.centroids: Dict[str, SparseVector] = {}
+        self.n_examples: Dict[str, int] = {}
+
+    def fit(self, examples: List[Tuple[str, str]]) -> "NearestCentroidClassifier":
+        sums: Dict[str, SparseVector] = {}
+        self.n_examples = {}
+        for text, label in examples:
+            acc = sums.setdefault(label, {})
+            for idx, v in vectorize(text).items():
+                acc[idx] = acc.get(idx, 0.0) + v
+            self.n_examples[label] = self.n_examples.get(label, 0) + 1
+
+        self.centroids = {}
+        for label, acc in sums.items():
+            norm = math.sqrt(sum(v * v for v in acc.values())) or 1.0
+            self.centroids[label] = {idx: v / norm for idx, v in acc.items()}
+        return self
+
+    def scores(self, text: str) -> Dict[str, float]:
+        vec = vectorize(text)
+        return {label: _dot(vec, centroid) for label, centroid in self.centroids.items()}
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """(nhãn, độ tin cậy = chênh lệch cosine top1 - top2)."""
+        ranked = sorted(self.scores(text).items(), key=lambda kv: kv[1], reverse=True)
+        if not ranked:
+            return None, 0.0
+        if len(ranked) == 1:
+            return ranked[0][0], ranked[0][1]
+        return ranked[0][0], ranked[0][1] - ranked[1][1]
+
+
+def load_examples(path: str = RELEVANCE_EXAMPLES_PATH) -> List[Tuple[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        data: Dict[str, Any] = json.load(f)
+    return [
+        (item["text"], item["label"])
+        for item in data.get("examples") or []
+        if item.get("text") and item.get("label") in (LABEL_EVENT, LABEL_OTHER)
+    ]
+
+
+_lock = threading.Lock()
+_model: Optional[NearestCentroidClassifier] = None
+_loaded_mtime: Optional[float] = None
+_stats = {
+    "local_decisions": 0,
+    "low_confidence": 0,
+    "total_latency_ms": 0.0,
+}
+
+
+def get_model() -> Optional[NearestCentroidClassifier]:
+    """Model hiện tại; train lại khi file câu mẫu đổi mtime. Lỗi load → None (caller dùng LLM)."""
+    global _model, _loaded_mtime
+    try:
+        mtime = os.path.getmtime(RELEVANCE_EXAMPLES_PATH)
+    except OSError:
+        mtime = None
+
+    if mtime == _loaded_mtime:
+        return _model
+
+    with _lock:
+        if mtime == _loaded_mtime:
+            return _model
+        try:
+            examples = load_examples()
+            _model = NearestCentroidClassifier().fit(examples)
+            print(f"[INFO] relevance_classifier: trained on {len(examples)} examples from {RELEVANCE_EXAMPLES_PATH}")
+        except Exception as e:  # noqa: BLE001
+            print(f"[WARN] relevance_classifier: cannot load {RELEVANCE_EXAMPLES_PATH}: {e}")
+        _loaded_mtime = mtime
+        return _model
+
+
+def classify_relevance(message: str, threshold: Optional[float] = None) -> Optional[bool]:
+    """
+    True / False nếu model đủ tự tin, None nếu độ tin cậy < threshold (hoặc chưa có model).
+    """
+    model = get_model()
+    if model is None:
+        return None
+
+    started = time.perf_counter()
+    label, confidence = model.predict(message)
+    _stats["total_latency_ms"] += (time.perf_counter() - started) * 1000
+
+    if threshold is None:
+        threshold = RELEVANCE_CONFIDENCE_THRESHOLD
+    if label is None or confidence < threshold:
+        _stats["low_confidence"] += 1
+        return None
+
+    _stats["local_decisions"] += 1
+    return label == LABEL_EVENT
+
+
+def get_relevance_stats() -> Dict[str, Any]:
+    total = _stats["local_decisions"] + _stats["low_confidence"]
+    return {
+        "local_decisions": _stats["local_decisions"],
+        "llm_fallbacks": _stats["low_confidence"],
+        "local_ratio": round(_stats["local_decisions"] / total, 4) if total else None,
+        "avg_latency_ms": round(_stats["total_latency_ms"] / total, 3) if total else None,
+        "confidence_threshold": RELEVANCE_CONFIDENCE_THRESHOLD,
+    }
@@ -0,0 +1,122 @@
+# scripts/eval_relevance.py
+"""
+Đánh giá bộ lọc relevance (keyword automaton + classifier cục bộ) bằng k-fold cross-validation
+trên file câu mẫu có nhãn.
+
+Ví dụ:
+    python scripts/eval_relevance.py
+    python scripts/eval_relevance.py --folds 10 --thresholds 0 0.02 0.05 0.1
+    python scripts/eval_relevance.py --examples path/to/examples.json
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from keyword_filter import classify_keywords
+from relevance_classifier import (
+    LABEL_EVENT,
+    RELEVANCE_CONFIDENCE_THRESHOLD,
+    RELEVANCE_EXAMPLES_PATH,
+    NearestCentroidClassifier,
+    load_examples,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Đánh giá accuracy / latency của bộ phân loại relevance cục bộ.")
+    parser.add_argument("--examples", default=RELEVANCE_EXAMPLES_PATH, help="File JSON câu mẫu có nhãn.")
+    parser.add_argument("--folds", type=int, default=5, help="Số fold cross-validation.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[0.0, 0.02, 0.05, RELEVANCE_CONFIDENCE_THRESHOLD, 0.1],
+        help="Các ngưỡng confidence cần so sánh.",
+    )
+    return parser.parse_args()
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+def cross_validate(examples, folds, seed):
+    """Trả về list (text, label, predicted_label, confidence, latency_ms) cho mọi câu mẫu."""
+    shuffled = list(examples)
+    random.Random(seed).shuffle(shuffled)
+    folds = max(2, min(folds, len(shuffled)))
+
+    results = []
+    for fold in range(folds):
+        test = shuffled[fold::folds]
+        train = [ex for i, ex in enumerate(shuffled) if i % folds != fold]
+        model = NearestCentroidClassifier().fit(train)
+        for text, label in test:
+            started = time.perf_counter()
+            predicted, confidence = model.predict(text)
+            latency_ms = (time.perf_counter() - started) * 1000
+            results.append((text, label, predicted, confidence, latency_ms))
+    return results
+
+
+def main():
+    args = parse_args()
+    examples = load_examples(args.examples)
+    if not examples:
+        print(f"[ERROR] Không có câu mẫu hợp lệ trong {args.examples}")
+        sys.exit(1)
+
+    n_event = sum(1 for _, label in examples if label == LABEL_EVENT)
+    print(f"[INFO] {len(examples)} câu mẫu ({n_event} event / {len(examples) - n_event} other), {args.folds}-fold CV")
+
+    results = cross_validate(examples, args.folds, args.seed)
+    latencies = [r[4] for r in results]
+    print(
+        f"[LATENCY] classifier predict: p50={_percentile(latencies, 50):.3f}ms "
+        f"p95={_percentile(latencies, 95):.3f}ms max={max(latencies):.3f}ms"
+    )
+
+    overall = sum(1 for _, label, pred, _, _ in results if label == pred) / len(results)
+    print(f"[ACCURACY] classifier (không ngưỡng): {overall:.3f}")
+
+    print("\nthreshold | local coverage | local accuracy | pipeline accuracy (keyword → local, còn lại coi như LLM đúng)")
+    for threshold in args.thresholds:
+        local = [r for r in results if r[3] >= threshold]
+        local_correct = sum(1 for _, label, pred, _, _ in local if label == pred)
+
+        # Pipeline như is_event_related: keyword trước, classifier sau, LLM cho phần còn lại
+        pipeline_correct = 0
+        for text, label, pred, confidence, _ in results:
+            verdict = classify_keywords(text)
+            if verdict is None and confidence >= threshold:
+                verdict = pred == LABEL_EVENT
+            if verdict is None or verdict == (label == LABEL_EVENT):
+                pipeline_correct += 1
+
+        coverage = len(local) / len(results)
+        local_acc = local_correct / len(local) if local else 0.0
+        print(f"{threshold:9.3f} | {coverage:14.3f} | {local_acc:14.3f} | {pipeline_correct / len(results):.3f}")
+
+    errors = [r for r in results if r[1] != r[2] and r[3] >= RELEVANCE_CONFIDENCE_THRESHOLD]
+    if errors:
+        print(f"\n[ERRORS] Sai với confidence >= {RELEVANCE_CONFIDENCE_THRESHOLD}:")
+        for text, label, pred, confidence, _ in errors:
+            print(f"  - ({label} → {pred}, conf={confidence:.3f}) {text}")
+
+    print(f"\n[INFO] Latency trung bình: {statistics.mean(latencies):.3f}ms/câu")
+
+
+if __name__ == "__main__":
+    main()
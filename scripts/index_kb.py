@@ -1,37 +1,67 @@
 # scripts/index_kb.py
+import argparse
+import hashlib
 import json
+import random
+import time
 import uuid
 import chromadb
 import os
-from chromadb.utils import embedding_functions
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Thêm project root vào sys.path để import các module dùng chung (kb_version, ...)
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.append(PROJECT_ROOT)
+
+from embeddings import (
+    META_INDEX_SCHEMA,
+    EmbeddingMismatchError,
+    check_collection_embedding,
+    collection_metadata,
+    create_embedding_function,
+    describe_collection_embedding,
+    get_embedding_spec,
+    stamp_collection_embedding,
+)
+from bm25_index import BM25_INDEX_PATH, BM25Index
+from kb_version import bump_kb_version
+from vector_store import KB_NUMPY_SNAPSHOT_DIR, KB_VECTOR_BACKEND, export_numpy_snapshot
 
 CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "./chroma_db")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+COLLECTION_NAME = "myfevent_kb"
 
-# Tạo embedding function sử dụng OpenAI
-def create_embedding_function():
-    """
-    Tạo embedding function cho ChromaDB.
-    Nếu có OPENAI_API_KEY -> dùng OpenAI embeddings
-    Ngược lại -> dùng default embedding của ChromaDB
-    """
-    if OPENAI_API_KEY:
-        # Sử dụng OpenAI embedding function
-        return embedding_functions.OpenAIEmbeddingFunction(
-            api_key=OPENAI_API_KEY,
-            model_name="text-embedding-3-small"  # Model nhẹ và hiệu quả
-        )
-    else:
-        # Fallback về default embedding của ChromaDB
-        print("[WARN] OPENAI_API_KEY không được set, sử dụng default embedding của ChromaDB")
-        return embedding_functions.DefaultEmbeddingFunction()
+# Manifest cho chế độ incremental: mtime từng file + hash nội dung từng item đã index
+MANIFEST_PATH = os.path.join(CHROMA_DB_DIR, "kb_manifest.json")
+
+# Tăng khi cấu trúc record thay đổi (vd thêm doc con epic/task) → lần chạy incremental kế tiếp
+# bỏ qua mtime / hash trong manifest và index lại mọi file
+INDEX_SCHEMA_VERSION = 2
+
+# Cấp của document trong collection: pattern / sự kiện gốc → epic → task
+LEVEL_EVENT = "event"
+LEVEL_EPIC = "epic"
+LEVEL_TASK = "task"
 
-# Khởi tạo ChromaDB client với embedding function
-embedding_fn = create_embedding_function()
+# Bulk ingestion: gom item thành batch embedding theo token budget, chạy song song nhiều batch,
+# ghi vào Chroma theo lô lớn
+EMBED_BATCH_TOKEN_BUDGET = int(os.getenv("KB_EMBED_BATCH_TOKENS", "50000"))
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("KB_EMBED_BATCH_MAX_ITEMS", "256"))
+EMBED_CONCURRENCY = int(os.getenv("KB_EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("KB_EMBED_MAX_RETRIES", "6"))
+CHROMA_WRITE_BATCH = int(os.getenv("KB_CHROMA_WRITE_BATCH", "1000"))
+
+# Embedding backend lấy từ registry dùng chung với rag.py (KB_EMBEDDING_BACKEND)
+# để document và query luôn nằm cùng một không gian vector.
+# Bọc bằng cache trên đĩa (key = hash(model + text)) → không embed lại tài liệu không đổi
+embedding_spec = get_embedding_spec()
+embedding_fn = create_embedding_function(embedding_spec)
 client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
 collection = client.get_or_create_collection(
-    name="myfevent_kb",
-    embedding_function=embedding_fn
+    name=COLLECTION_NAME,
+    embedding_function=embedding_fn,
+    metadata=collection_metadata(embedding_spec),
 )
 
 # Các thư mục KB sẽ scan
@@ -69,7 +99,113 @@ def detect_kb_group(path: str) -> str:
     return "pattern"
 
 
-def index_file(path: str):
+def load_manifest() -> dict:
+    if not os.path.exists(MANIFEST_PATH):
+        return {"files": {}, "schema_version": INDEX_SCHEMA_VERSION}
+    try:
+        manifest = load_json(MANIFEST_PATH)
+        manifest.setdefault("files", {})
+        return manifest
+    except Exception as e:
+        print(f"[WARN] Manifest {MANIFEST_PATH} hỏng ({e}), coi như index lại từ đầu.")
+        return {"files": {}, "schema_version": INDEX_SCHEMA_VERSION}
+
+
+def save_manifest(manifest: dict):
+    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    # Ghi atomically để lần chạy bị ngắt giữa chừng không làm hỏng manifest
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _make_record(_id: str, document: str, meta: dict) -> dict:
+    return {
+        "id": _id,
+        "document": document,
+        "metadata": meta,
+        # Hash cả metadata (kb_group, source_file) để đổi vị trí file cũng được cập nhật
+        "hash": content_hash(json.dumps(meta, ensure_ascii=False, sort_keys=True) + document),
+    }
+
+
+def _scalar_meta(meta: dict) -> dict:
+    """Chroma chỉ nhận metadata kiểu str/int/float/bool, không nhận None."""
+    return {k: v if isinstance(v, (int, float, bool)) else str(v) for k, v in meta.items() if v is not None}
+
+
+def build_child_records(item: dict, parent_id: str, base_meta: dict):
+    """
+    Tách pattern thành doc con: 1 doc / epic (kèm danh sách task của epic trong raw_json)
+    và 1 doc / task. Task planning query thẳng vào doc epic thay vì nhận nguyên pattern.
+      - epic: id "<parent>::epic::<epic_key|vị trí>", parent_id = id pattern
+      - task: id "<epic id>::task::<task_key|vị trí>", parent_id = id epic, root_id = id pattern
+    """
+    records = []
+    for epic_pos, epic in enumerate(item.get("epics") or []):
+        if not isinstance(epic, dict) or not str(epic.get("title") or "").strip():
+            continue
+        epic_id = f"{parent_id}::epic::{epic.get('epic_key') or epic_pos}"
+        tasks = [t for t in epic.get("tasks") or [] if isinstance(t, dict) and str(t.get("title") or "").strip()]
+
+        epic_meta = _scalar_meta({
+            **base_meta,
+            "id": epic_id,
+            "level": LEVEL_EPIC,
+            "parent_id": parent_id,
+            "root_id": parent_id,
+            "epic_key": epic.get("epic_key"),
+            "department": epic.get("department"),
+            "phase": epic.get("phase"),
+            "priority": epic.get("priority"),
+            "order_index": epic.get("order_index"),
+            "task_count": len(tasks),
+            "raw_json": json.dumps(epic, ensure_ascii=False, sort_keys=True),
+        })
+        epic_document = (
+            f"Epic: {epic['title']}. {epic.get('description') or ''}\n"
+            f"Department: {epic.get('department') or ''}. Phase: {epic.get('phase') or ''}.\n"
+            f"Tasks: {'; '.join(str(t['title']) for t in tasks)}"
+        )
+        records.append(_make_record(epic_id, epic_document, epic_meta))
+
+        for task_pos, task in enumerate(tasks):
+            task_id = f"{epic_id}::task::{task.get('task_key') or task_pos}"
+            task_meta = _scalar_meta({
+                **base_meta,
+                "id": task_id,
+                "level": LEVEL_TASK,
+                "parent_id": epic_id,
+                "root_id": parent_id,
+                "epic_key": epic.get("epic_key"),
+                "task_key": task.get("task_key"),
+                "department": epic.get("department"),
+                "phase": epic.get("phase"),
+                "priority": task.get("priority"),
+                "order_index": task.get("order_index"),
+                "raw_json": json.dumps(task, ensure_ascii=False, sort_keys=True),
+            })
+            task_document = (
+                f"Task: {task['title']}. {task.get('description') or ''}\n"
+                f"Epic: {epic['title']}. Department: {epic.get('department') or ''}."
+            )
+            records.append(_make_record(task_id, task_document, task_meta))
+    return records
+
+
+def build_records(path: str):
+    """
+    Đọc 1 file KB và trả về danh sách record sẵn sàng để upsert:
+      {"id", "document", "metadata", "hash"}
+    ID ổn định giữa các lần chạy: dùng item["id"] nếu có, ngược lại uuid5(path + vị trí item)
+    (không dùng uuid4 nữa vì mỗi lần chạy lại sẽ sinh bản trùng).
+    Item có "epics" sinh thêm doc con cấp epic / task (build_child_records).
+    """
     data = load_json(path)
 
     # Cho phép file chứa 1 object hoặc 1 list object
@@ -79,28 +215,29 @@ def index_file(path: str):
         items = data
     else:
         print(f"[WARN] File {path} không phải dict/list hợp lệ, bỏ qua.")
-        return
-
-    docs = []
-    metadatas = []
-    ids = []
+        return []
 
     kb_group = detect_kb_group(path)
+    source_key = path.replace("\\", "/")
 
-    for item in items:
+    records = {}
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
         # Lấy trường "context" từ item để embed
         context = item.get("context")
         if not context or not str(context).strip():
             # Bắt buộc phải có context để embed, bỏ qua nếu không có
             continue
 
-        _id = item.get("id") or str(uuid.uuid4())
-        raw_json = json.dumps(item, ensure_ascii=False)
+        _id = item.get("id") or str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_key}#{position}"))
+        raw_json = json.dumps(item, ensure_ascii=False, sort_keys=True)
 
         meta = {
             "id": _id,
             "source_file": path,
             "kb_group": kb_group,   # 'pattern' hoặc 'user_event'
+            "level": LEVEL_EVENT,
             "raw_json": raw_json,   # full tài liệu để LLM dùng
         }
         if item.get("type") is not None:
@@ -110,43 +247,346 @@ def index_file(path: str):
         if item.get("name") is not None:
             meta["name"] = str(item["name"])
 
-        # Thêm trường "context" vào docs để ChromaDB embed thành vector
-        docs.append(str(context))
-        metadatas.append(meta)
-        ids.append(_id)
-
-    if docs:
-        # Thêm documents vào ChromaDB với embedding tự động
-        # ChromaDB sẽ tự động gọi embedding function để tạo vector cho mỗi document
-        collection.add(
-            documents=docs,
-            metadatas=metadatas,
-            ids=ids,
-        )
-        print(f"[OK] Indexed {len(docs)} docs from {path} (embeddings created)")
-    else:
+        if _id in records:
+            print(f"[WARN] Trùng id '{_id}' trong {path}, giữ bản xuất hiện sau.")
+        records[_id] = _make_record(_id, str(context), meta)
+
+        child_base = {k: meta[k] for k in ("source_file", "kb_group", "event_type", "name") if k in meta}
+        for child in build_child_records(item, _id, child_base):
+            records[child["id"]] = child
+
+    return list(records.values())
+
+
+def plan_file(path: str, previous: dict = None, full: bool = False):
+    """
+    So sánh 1 file KB với manifest:
+      - Trả về các record mới / có hash nội dung thay đổi (để pipeline embed + upsert),
+      - Xoá ngay các item từng có trong file nhưng nay đã bị xoá (tombstone).
+    Trả về (entry manifest mới của file {"mtime", "items": {id: hash}}, changed_records).
+    """
+    previous = previous or {}
+    previous_items = {} if full else (previous.get("items") or {})
+
+    records = build_records(path)
+    changed = [r for r in records if previous_items.get(r["id"]) != r["hash"]]
+    current_ids = {r["id"] for r in records}
+    removed_ids = [_id for _id in (previous.get("items") or {}) if _id not in current_ids]
+
+    if removed_ids:
+        collection.delete(ids=removed_ids)
+
+    if changed or removed_ids:
+        print(f"[OK] {path}: changed {len(changed)}, deleted {len(removed_ids)}, unchanged {len(records) - len(changed)}")
+    elif not records:
         print(f"[SKIP] No valid docs in {path}")
 
+    entry = {
+        "mtime": os.path.getmtime(path),
+        "items": {r["id"]: r["hash"] for r in records},
+    }
+    return entry, changed, len(removed_ids)
+
+
+def estimate_tokens(text: str) -> int:
+    # Ước lượng thô (tiếng Việt có dấu ~3 ký tự/token), đủ để chia batch dưới giới hạn API
+    return len(text) // 3 + 1
+
+
+def iter_embedding_batches(records):
+    """Gom record (stream) thành batch theo token budget + số item tối đa mỗi request."""
+    batch, batch_tokens = [], 0
+    for record in records:
+        tokens = estimate_tokens(record["document"])
+        if batch and (batch_tokens + tokens > EMBED_BATCH_TOKEN_BUDGET or len(batch) >= EMBED_BATCH_MAX_ITEMS):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(record)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    if getattr(e, "status_code", None) == 429 or type(e).__name__ == "RateLimitError":
+        return True
+    message = str(e).lower()
+    return "429" in message or "rate limit" in message
+
+
+def embed_batch(batch):
+    """Embed 1 batch, retry với exponential backoff + jitter khi bị rate limit / lỗi tạm thời."""
+    documents = [r["document"] for r in batch]
+    attempt = 0
+    while True:
+        try:
+            embeddings = embedding_fn(documents)
+            break
+        except Exception as e:  # noqa: BLE001
+            attempt += 1
+            if attempt > EMBED_MAX_RETRIES:
+                raise
+            delay = min(60.0, (2 ** attempt) * (1.0 if _is_rate_limit_error(e) else 0.25))
+            delay += random.uniform(0, delay / 2)
+            print(f"[WARN] Embedding batch ({len(batch)} docs) lỗi: {type(e).__name__}, retry {attempt}/{EMBED_MAX_RETRIES} sau {delay:.1f}s")
+            time.sleep(delay)
+
+    # Chặn ghi vector sai dimension vào collection (registry khai báo sai / đổi model)
+    for vec in embeddings:
+        if len(vec) != embedding_spec["dim"]:
+            raise EmbeddingMismatchError(
+                f"Embedding có dim={len(vec)} nhưng registry khai báo {embedding_spec['model']} dim={embedding_spec['dim']}"
+            )
+    return batch, embeddings
+
+
+def ingest_records(records):
+    """
+    Bulk ingestion pipeline:
+      records (stream) → batch theo token budget → embed song song (EMBED_CONCURRENCY batch)
+      → gom lại và upsert vào Chroma theo lô CHROMA_WRITE_BATCH (kèm embeddings có sẵn).
+    Trả về (số doc đã ghi, set id bị lỗi để lần chạy sau thử lại).
+    """
+    max_write_batch = CHROMA_WRITE_BATCH
+    try:
+        max_write_batch = min(max_write_batch, client.get_max_batch_size())
+    except Exception:  # noqa: BLE001
+        pass
+
+    started = time.perf_counter()
+    written = 0
+    failed_ids = set()
+    buffer = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+
+    def flush():
+        nonlocal written
+        if not buffer["ids"]:
+            return
+        collection.upsert(**buffer)
+        written += len(buffer["ids"])
+        for values in buffer.values():
+            values.clear()
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        print(f"[PROGRESS] {written} docs written, {written / elapsed:.1f} docs/sec")
+
+    batches = iter_embedding_batches(records)
+    with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as pool:
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            # Giữ số batch đang chạy có giới hạn → không đọc hết corpus vào RAM
+            while not exhausted and len(pending) < EMBED_CONCURRENCY * 2:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                pending[pool.submit(embed_batch, batch)] = batch
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                try:
+                    _, embeddings = future.result()
+                except Exception as e:  # noqa: BLE001
+                    print(f"[ERROR] Embedding batch ({len(batch)} docs) failed sau {EMBED_MAX_RETRIES} lần retry: {e}")
+                    failed_ids.update(r["id"] for r in batch)
+                    continue
+                for record, embedding in zip(batch, embeddings):
+                    buffer["ids"].append(record["id"])
+                    buffer["documents"].append(record["document"])
+                    buffer["metadatas"].append(record["metadata"])
+                    buffer["embeddings"].append(embedding)
+                if len(buffer["ids"]) >= max_write_batch:
+                    flush()
+    flush()
+
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    if written:
+        print(f"[INFO] Ingested {written} docs in {elapsed:.1f}s ({written / elapsed:.1f} docs/sec)")
+    return written, failed_ids
+
+
+def iter_collection_pages(include):
+    """Đọc toàn bộ collection theo trang CHROMA_WRITE_BATCH doc."""
+    offset = 0
+    while True:
+        page = collection.get(include=include, limit=CHROMA_WRITE_BATCH, offset=offset)
+        ids = page.get("ids") or []
+        if not ids:
+            break
+        yield page
+        offset += len(ids)
+
+
+def rebuild_bm25_index():
+    """
+    Build lại inverted index BM25 (rag.py dùng cho hybrid retrieval) từ TOÀN BỘ collection,
+    đọc theo trang; collection là nguồn sự thật nên index luôn khớp sau incremental / xoá.
+    """
+    started = time.perf_counter()
+    records = []
+    for page in iter_collection_pages(["documents", "metadatas"]):
+        for _id, document, meta in zip(page["ids"], page.get("documents") or [], page.get("metadatas") or []):
+            meta = meta or {}
+            # Doc cấp sự kiện: thêm tên pattern (context thường không nhắc lại tên)
+            name = meta.get("name") if meta.get("level", "event") == "event" else None
+            records.append((_id, f"{name or ''}\n{document or ''}", meta))
+
+    index = BM25Index.build(records)
+    index.save(BM25_INDEX_PATH)
+    print(f"[INFO] BM25 index: {len(index)} docs, {len(index.postings)} terms → {BM25_INDEX_PATH} "
+          f"({time.perf_counter() - started:.2f}s)")
+
+
+def stamp_index_schema():
+    """Ghi INDEX_SCHEMA_VERSION vào metadata collection → rag.py biết document đã có metadata "level"."""
+    meta = {k: v for k, v in (collection.metadata or {}).items() if not k.startswith("hnsw:")}
+    if meta.get(META_INDEX_SCHEMA) == INDEX_SCHEMA_VERSION:
+        return
+    meta[META_INDEX_SCHEMA] = INDEX_SCHEMA_VERSION
+    collection.modify(metadata=meta)
+    print(f"[INFO] Ghi index schema {INDEX_SCHEMA_VERSION} vào metadata collection")
+
+
+def export_vector_snapshot():
+    """Export embedding + document của collection thành snapshot cho KB_VECTOR_BACKEND=numpy (vector_store.py)."""
+    started = time.perf_counter()
+    manifest = export_numpy_snapshot(
+        iter_collection_pages(["embeddings", "documents", "metadatas"]),
+        collection.metadata or {},
+        KB_NUMPY_SNAPSHOT_DIR,
+    )
+    print(f"[INFO] Numpy vector snapshot: {manifest['count']} docs, dim={manifest['dim']} → {KB_NUMPY_SNAPSHOT_DIR} "
+          f"(gen={manifest['generation']}, {time.perf_counter() - started:.2f}s)")
+
+
+def reset_collection():
+    """Xoá và tạo lại collection (dùng cho --full)."""
+    global collection
+    try:
+        client.delete_collection(name=COLLECTION_NAME)
+    except Exception as e:  # noqa: BLE001
+        print(f"[WARN] Không xoá được collection cũ: {e}")
+    collection = client.get_or_create_collection(
+        name=COLLECTION_NAME,
+        embedding_function=embedding_fn,
+        metadata=collection_metadata(embedding_spec),
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Index knowledge base myFEvent vào ChromaDB.")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Xoá collection và index lại toàn bộ (mặc định: incremental theo manifest).",
+    )
+    return parser.parse_args()
+
 
 def main():
+    args = parse_args()
+
     # Hiển thị thông tin về embedding function đang sử dụng
-    if OPENAI_API_KEY:
-        print(f"[INFO] Sử dụng OpenAI embeddings (model: text-embedding-3-small)")
+    print(f"[INFO] Embedding backend: {embedding_spec['name']} (model: {embedding_spec['model']}, dim: {embedding_spec['dim']})")
+
+    full = args.full
+    if full:
+        print("[INFO] Chế độ --full: xoá collection và index lại toàn bộ KB")
+        reset_collection()
+        manifest = {"files": {}}
     else:
-        print(f"[INFO] Sử dụng default embedding của ChromaDB")
-    
-    any_file = False
-    for path in iter_json_files():
-        any_file = True
+        if describe_collection_embedding(collection) is None:
+            # Collection tạo bởi indexer cũ: ghi nhận model hiện tại (indexer cũ cũng chọn theo OPENAI_API_KEY)
+            print(f"[INFO] Ghi embedding model vào metadata collection: {embedding_spec['model']}")
+            stamp_collection_embedding(collection, embedding_spec)
         try:
-            index_file(path)
-        except Exception as e:
-            print(f"[ERROR] Index {path} failed: {e}")
+            check_collection_embedding(collection, embedding_spec)
+        except EmbeddingMismatchError as e:
+            print(f"[ERROR] {e}")
+            sys.exit(1)
+        manifest = load_manifest()
+        if manifest.get("schema_version") != INDEX_SCHEMA_VERSION:
+            # Cấu trúc record đã đổi: index lại mọi item (upsert đè), item không còn vẫn bị xoá theo manifest
+            print(f"[INFO] Index schema {manifest.get('schema_version')} -> {INDEX_SCHEMA_VERSION}, index lại toàn bộ file")
+            full = True
+
+    manifest["schema_version"] = INDEX_SCHEMA_VERSION
+    previous_files = manifest["files"]
+    new_files = {}
+    counters = {"files": 0, "skipped_files": 0, "deleted": 0}
 
-    if not any_file:
+    def iter_changed_records():
+        """Stream record cần upsert từ tất cả file KB (file không đổi mtime thì bỏ qua)."""
+        for path in iter_json_files():
+            counters["files"] += 1
+            previous = previous_files.get(path)
+            if not full and previous and previous.get("mtime") == os.path.getmtime(path):
+                new_files[path] = previous
+                counters["skipped_files"] += 1
+                continue
+            try:
+                entry, changed, deleted = plan_file(path, previous=previous, full=full)
+            except Exception as e:
+                print(f"[ERROR] Index {path} failed: {e}")
+                # Giữ entry cũ để lần sau thử lại, không xoá nhầm item của file lỗi
+                if previous:
+                    new_files[path] = previous
+                continue
+            new_files[path] = entry
+            counters["deleted"] += deleted
+            yield from changed
+
+    written, failed_ids = ingest_records(iter_changed_records())
+
+    if failed_ids:
+        # Bỏ các item lỗi khỏi manifest + reset mtime để lần chạy sau embed lại
+        for entry in new_files.values():
+            items = entry.get("items") or {}
+            if any(_id in failed_ids for _id in items):
+                entry["items"] = {k: v for k, v in items.items() if k not in failed_ids}
+                entry["mtime"] = None
+        print(f"[WARN] {len(failed_ids)} docs chưa index được, sẽ thử lại ở lần chạy sau.")
+    else:
+        # Chỉ stamp khi mọi record đã được ghi theo schema mới (item lỗi có thể còn bản cũ không có "level")
+        stamp_index_schema()
+
+    # File nguồn đã bị xoá khỏi KB → xoá toàn bộ item của nó khỏi collection
+    for path, previous in previous_files.items():
+        if path in new_files:
+            continue
+        stale_ids = list((previous.get("items") or {}).keys())
+        if stale_ids:
+            collection.delete(ids=stale_ids)
+            counters["deleted"] += len(stale_ids)
+        print(f"[OK] {path} đã bị xoá khỏi KB: deleted {len(stale_ids)} docs")
+
+    manifest["files"] = new_files
+    save_manifest(manifest)
+
+    if not counters["files"]:
         print("[WARN] Không tìm thấy file KB nào trong kb/patterns hoặc kb/user_events.")
+
+    total_changes = written + counters["deleted"]
+    if total_changes or full or not os.path.exists(BM25_INDEX_PATH):
+        # Trước khi bump version: process phục vụ query thấy version mới là đã có BM25 mới
+        rebuild_bm25_index()
+    # Snapshot numpy chỉ cần khi rag.py chạy KB_VECTOR_BACKEND=numpy (đọc lại cả collection → không export thừa)
+    if KB_VECTOR_BACKEND == "numpy" and (
+        total_changes or full or not os.path.exists(os.path.join(KB_NUMPY_SNAPSHOT_DIR, "snapshot.json"))
+    ):
+        export_vector_snapshot()
+    if total_changes or full:
+        # Báo cho các process đang phục vụ query (rag.py) biết collection đã đổi → invalidate cache
+        version = bump_kb_version()
+        print(f"[INFO] Hoàn thành indexing: upserted {written}, deleted {counters['deleted']}, "
+              f"{counters['skipped_files']} file không đổi. "
+              f"Tổng số documents trong collection: {collection.count()} (kb_version={version})")
     else:
-        print(f"[INFO] Hoàn thành indexing. Tổng số documents trong collection: {collection.count()}")
+        print(f"[INFO] KB không thay đổi ({counters['skipped_files']} file). Tổng số documents trong collection: {collection.count()}")
+    print(f"[INFO] Embedding cache: {embedding_fn.stats()}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+# stream_json.py
+"""
+Parse JSON tăng dần cho output streaming của các planner (EPIC / TASK).
+
+Planner trả về JSON dạng {"epics": [ {...}, {...} ]} / {"tasks": [...]}. Thay vì đợi cả
+completion rồi json.loads, JsonArrayItemParser nhận từng đoạn text và trả ra mỗi object
+trong mảng ngay khi object đó đóng ngoặc → caller có thể hiển thị plan từng phần và
+dừng generation khi đạt ngân sách.
+"""
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Callback nhận từng item ngay khi parse xong: await on_item(index, item)
+ItemCallback = Callable[[int, Dict[str, Any]], Awaitable[None]]
+
+
+class JsonArrayItemParser:
+    """
+    Máy trạng thái trên từng ký tự: theo dõi chuỗi / escape / độ sâu ngoặc,
+    nhận diện mảng của `key` ở object gốc và cắt ra từng object con hoàn chỉnh.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._buf: List[str] = []
+        self._length = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = -1
+        self._last_string: Optional[str] = None
+        self._current_key: Optional[str] = None
+        self._array_depth: Optional[int] = None  # độ sâu BÊN TRONG mảng mục tiêu
+        self._item_start = -1
+        self.items: List[Dict[str, Any]] = []
+
+    @property
+    def text(self) -> str:
+        return "".join(self._buf)
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Nạp thêm text, trả về các item mới hoàn chỉnh trong lần nạp này."""
+        new_items: List[Dict[str, Any]] = []
+        if not chunk:
+            return new_items
+
+        offset = self._length
+        self._buf.append(chunk)
+        self._length += len(chunk)
+        text = None  # chỉ join buffer khi thực sự cần cắt chuỗi
+
+        for i, ch in enumerate(chunk):
+            pos = offset + i
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        text = text or self.text
+                        try:
+                            self._last_string = json.loads(text[self._string_start:pos + 1])
+                        except ValueError:
+                            self._last_string = None
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif ch == ":" and self._depth == 1:
+                self._current_key = self._last_string
+            elif ch in "{[":
+                if ch == "{" and self._array_depth is not None and self._depth == self._array_depth:
+                    self._item_start = pos
+                self._depth += 1
+                if ch == "[" and self._depth == 2 and self._current_key == self.key and self._array_depth is None:
+                    self._array_depth = 2
+            elif ch in "}]":
+                self._depth -= 1
+                if ch == "]" and self._array_depth is not None and self._depth == self._array_depth - 1:
+                    self._array_depth = None
+                    self._current_key = None
+                elif ch == "}" and self._array_depth is not None and self._depth == self._array_depth and self._item_start >= 0:
+                    text = text or self.text
+                    try:
+                        item = json.loads(text[self._item_start:pos + 1])
+                    except ValueError:
+                        item = None
+                    self._item_start = -1
+                    if isinstance(item, dict):
+                        self.items.append(item)
+                        new_items.append(item)
+        return new_items
+
+
+async def stream_json_items(
+    stream: Any,
+    key: str,
+    on_item: Optional[ItemCallback] = None,
+    max_items: Optional[int] = None,
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Đọc stream chat completion (OpenAI, stream=True), parse mảng `key` tăng dần.
+
+    - on_item: gọi ngay khi mỗi item hoàn chỉnh.
+    - max_items: đạt ngân sách → đóng stream (huỷ generation phía provider), trả về các item đã có.
+
+    Trả về (plan, truncated): plan là JSON đầy đủ nếu completion kết thúc bình thường,
+    ngược lại {key: items đã parse được}.
+    """
+    parser = JsonArrayItemParser(key)
+    truncated = False
+
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        new_items = parser.feed(delta)
+        first_index = len(parser.items) - len(new_items)
+        for k, item in enumerate(new_items):
+            index = first_index + k
+            if on_item is not None:
+                await on_item(index, item)
+            if max_items is not None and index + 1 >= max_items:
+                truncated = True
+                break
+        if truncated:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                await close()
+            break
+
+    if not truncated:
+        try:
+            plan = json.loads(parser.text)
+            if isinstance(plan, dict):
+                return plan, False
+        except ValueError as e:
+            print(f"[WARN] stream_json_items: full JSON decode failed ({e}), using {len(parser.items)} parsed items")
+
+    return {key: parser.items[:max_items] if max_items is not None else parser.items}, truncated
@@ -0,0 +1,199 @@
+# tool_projection.py
+"""
+Thu gọn kết quả tool trước khi đưa lại vào context của LLM.
+
+Kết quả đầy đủ (plans, event detail, ...) vẫn được trả cho Node/FE qua response;
+model chỉ cần "nhìn" những field nó thực sự dùng để suy luận. List các object
+được mã hoá dạng bảng: {"columns": [...], "rows": [[...], ...]} để tên field
+không bị lặp lại ở từng phần tử.
+"""
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+# Field backend không có ý nghĩa với agent (metadata Mongo, audit, ...)
+_NOISE_KEYS = {
+    "__v",
+    "createdAt",
+    "updatedAt",
+    "deletedAt",
+    "createdBy",
+    "updatedBy",
+    "password",
+    "avatar",
+    "avatarUrl",
+    "image",
+    "images",
+    "imageUrl",
+    "coverImage",
+    "banner",
+}
+
+# Chuỗi dài (mô tả sự kiện, ghi chú, ...) bị cắt bớt trong context
+MAX_TEXT_CHARS = 1200
+
+# Các key trong event detail luôn giữ nguyên (system prompt đọc trực tiếp)
+_EVENT_DETAIL_VERBATIM_KEYS = ("currentUser", "_user_role_info", "summary")
+
+PLAN_NOTE = "Plan đầy đủ đã được gửi cho giao diện (plans); đây là bản rút gọn để trình bày cho người dùng."
+
+
+def _is_noise(key: str) -> bool:
+    return key in _NOISE_KEYS
+
+
+def _compact_value(value: Any) -> Any:
+    """Thu gọn 1 giá trị: bỏ field nhiễu, cắt chuỗi dài, list object → bảng."""
+    if isinstance(value, str):
+        if len(value) > MAX_TEXT_CHARS:
+            return value[:MAX_TEXT_CHARS] + "…"
+        return value
+    if isinstance(value, dict):
+        return {k: _compact_value(v) for k, v in value.items() if not _is_noise(k) and v not in (None, "", [], {})}
+    if isinstance(value, list):
+        if value and all(isinstance(item, dict) for item in value):
+            return to_table(value)
+        return [_compact_value(item) for item in value]
+    return value
+
+
+def _flatten_row(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Làm phẳng 1 cấp object lồng nhau (vd: departmentId: {_id, name} → departmentId._id, departmentId.name)
+    để giữ được bảng 2 chiều.
+    """
+    flat: Dict[str, Any] = {}
+    for key, value in item.items():
+        if _is_noise(key):
+            continue
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                if _is_noise(sub_key) or isinstance(sub_value, (dict, list)):
+                    continue
+                flat[f"{key}.{sub_key}"] = _compact_value(sub_value)
+        else:
+            flat[key] = _compact_value(value)
+    return flat
+
+
+def to_table(items: List[Dict[str, Any]], columns: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    List object → {"columns": [...], "rows": [[...]]}.
+    columns=None → lấy hợp các field (theo thứ tự xuất hiện), bỏ cột rỗng ở mọi dòng.
+    """
+    flat_items = [_flatten_row(item) for item in items]
+
+    if columns is None:
+        columns = []
+        seen = set()
+        for flat in flat_items:
+            for key, value in flat.items():
+                if key in seen or value in (None, "", [], {}):
+                    continue
+                seen.add(key)
+                columns.append(key)
+
+    rows = [[flat.get(col) for col in columns] for flat in flat_items]
+    return {"columns": columns, "rows": rows}
+
+
+# ====== PROJECTOR THEO TỪNG TOOL ======
+
+def _project_event_detail(result: Dict[str, Any]) -> Dict[str, Any]:
+    projected: Dict[str, Any] = {}
+    for key, value in result.items():
+        if _is_noise(key):
+            continue
+        if key in _EVENT_DETAIL_VERBATIM_KEYS:
+            projected[key] = value
+        elif key == "members" and isinstance(value, dict):
+            # members.total / members.byRole giữ nguyên, members.detail[] → bảng
+            projected[key] = {
+                k: (to_table(v) if k == "detail" and isinstance(v, list) else _compact_value(v))
+                for k, v in value.items()
+                if not _is_noise(k)
+            }
+        else:
+            projected[key] = _compact_value(value)
+    return projected
+
+
+def _project_epics_plan(result: Dict[str, Any]) -> Dict[str, Any]:
+    plan = result.get("plan") or {}
+    epics = plan.get("epics") if isinstance(plan, dict) else None
+    return {
+        "type": result.get("type"),
+        "eventId": result.get("eventId"),
+        "departments": result.get("departments"),
+        "cached": bool(result.get("cached")),
+        "plan": {
+            "epics": to_table(epics, ["title", "description", "department", "phase"])
+            if isinstance(epics, list)
+            else _compact_value(plan),
+        },
+        "truncated": bool(result.get("truncated")),
+        "note": PLAN_NOTE,
+    }
+
+
+def _project_tasks_plan(result: Dict[str, Any]) -> Dict[str, Any]:
+    plan = result.get("plan") or {}
+    tasks = plan.get("tasks") if isinstance(plan, dict) else None
+    return {
+        "type": result.get("type"),
+        "eventId": result.get("eventId"),
+        "epicId": result.get("epicId"),
+        "epicTitle": result.get("epicTitle"),
+        "department": result.get("department"),
+        "plan": {
+            # offset/depends_on/can_parallel chỉ FE cần khi apply → không đưa vào context
+            "tasks": to_table(tasks, ["title", "description", "priority"])
+            if isinstance(tasks, list)
+            else _compact_value(plan),
+        },
+        "truncated": bool(result.get("truncated")),
+        "note": PLAN_NOTE,
+    }
+
+
+def _project_tasks_plan_batch(result: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": result.get("type"),
+        "eventId": result.get("eventId"),
+        "plans": [
+            {k: v for k, v in _project_tasks_plan(plan).items() if k != "note"}
+            for plan in result.get("plans") or []
+        ],
+        "errors": result.get("errors") or [],
+        "note": PLAN_NOTE,
+    }
+
+
+TOOL_PROJECTORS: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]] = {
+    "get_event_detail_for_ai": _project_event_detail,
+    "ai_generate_epics_for_event": _project_epics_plan,
+    "ai_generate_tasks_for_epic": _project_tasks_plan,
+    "ai_generate_tasks_for_epics": _project_tasks_plan_batch,
+}
+
+
+def project_tool_result(tool_name: str, result: Any) -> Any:
+    """
+    Trả về bản rút gọn của kết quả tool để đưa vào context.
+    Lỗi tool (có key "error") và tool chưa có projector được giữ nguyên.
+    """
+    if not isinstance(result, dict) or result.get("error"):
+        return result
+    projector = TOOL_PROJECTORS.get(tool_name)
+    if projector is None:
+        return result
+    try:
+        return projector(result)
+    except Exception as e:  # noqa: BLE001
+        # Projector không được làm hỏng lượt chat: lỗi → dùng kết quả gốc
+        print(f"[WARN] project_tool_result({tool_name}) failed, using full result: {e}")
+        return result
+
+
+def encode_tool_result(tool_name: str, result: Any) -> str:
+    """Nội dung message role=tool: bản rút gọn, JSON không khoảng trắng thừa."""
+    return json.dumps(project_tool_result(tool_name, result), ensure_ascii=False, separators=(",", ":"))
@@ -1,10 +1,11 @@
 # tools/departments.py
 from typing import Dict, Any, Optional, List
 
+from .event_detail import invalidate_event_detail
 from .node_client import post, get
 
 
-def create_departments_for_event_tool(
+async def create_departments_for_event_tool(
     args: Dict[str, Any],
     user_token: Optional[str] = None,
 ) -> Dict[str, Any]:
@@ -38,7 +39,7 @@ def create_departments_for_event_tool(
 
     # 1) Lấy danh sách department hiện có
     try:
-        existing_res = get(
+        existing_res = await get(
             f"/events/{event_id}/departments",
             params={"page": 1, "limit": 200},
             user_token=user_token,
@@ -83,7 +84,7 @@ def create_departments_for_event_tool(
         }
 
         try:
-            res = post(
+            res = await post(
                 f"/events/{event_id}/departments",
                 json=payload,
                 user_token=user_token,
@@ -102,9 +103,13 @@ def create_departments_for_event_tool(
             print(f"[ERROR] Tạo department '{name}' thất bại: {e}")
             errors.append({"name": name, "error": str(e)})
 
+    # Event đã có ban mới → event detail đang cache không còn đúng
+    if created:
+        invalidate_event_detail(event_id)
+
     # 3) Lấy lại danh sách department sau khi tạo
     try:
-        final_res = get(
+        final_res = await get(
             f"/events/{event_id}/departments",
             params={"page": 1, "limit": 200},
             user_token=user_token,
@@ -1,17 +1,28 @@
 # tools/epics.py
+import asyncio
 import json
+import time
 from typing import Dict, Any, Optional, List
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 
+from plan_cache import PLAN_CACHE_ENABLED, plan_cache
+from plan_synthesizer import PLAN_SYNTH_MODE, DraftCallback, emit_draft, synthesize_epics_plan, use_directly
 from rag import retrieve_chunks
+from stream_json import ItemCallback, stream_json_items
 from .node_client import post, get  # ⬅️ nhớ import get
 
 
 from dotenv import load_dotenv
 import os
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Ngân sách số epics mỗi plan: đạt ngưỡng thì dừng stream (huỷ generation), trả phần đã có
+EPIC_PLANNER_MAX_EPICS = int(os.getenv("EPIC_PLANNER_MAX_EPICS", "40"))
+
+# Số chunk KB (pattern / sự kiện tương tự) đưa vào prompt planner
+EPIC_PLANNER_KB_TOP_K = int(os.getenv("EPIC_PLANNER_KB_TOP_K", "6"))
 
 
 EPIC_PLANNER_SYSTEM_PROMPT = """
@@ -60,16 +71,21 @@ def _chunk_to_text(chunk: Any) -> str:
     return json.dumps(chunk, ensure_ascii=False)
 
 
-def ai_generate_epics_for_event_tool(
+async def ai_generate_epics_for_event_tool(
     args: Dict[str, Any],
     user_token: Optional[str] = None,
+    on_item: Optional[ItemCallback] = None,
+    on_draft: Optional[DraftCallback] = None,
 ) -> Dict[str, Any]:
     """
     Tool cho LLM:
       - Input: eventId, eventDescription, departments (list string),
       - Nội bộ:
         + Gọi RAG: lấy epic_template + event_case giống event này,
-        + Gọi LLM con: sinh plan EPIC.
+        + Gọi LLM con (streaming): sinh plan EPIC, mỗi epic được parse ngay khi
+          hoàn chỉnh và báo qua on_item(index, epic); dừng khi đạt EPIC_PLANNER_MAX_EPICS.
+        + Trước khi gọi LLM: tổng hợp plan trực tiếp từ pattern trong KB (plan_synthesizer).
+          Đủ tin cậy → trả luôn (synthesized=True), ngược lại gửi làm bản nháp qua on_draft.
 
     LƯU Ý:
       - Hàm NÀY KHÔNG còn tự gọi Node để tạo EPIC thật nữa.
@@ -87,11 +103,39 @@ def ai_generate_epics_for_event_tool(
     if not event_description:
         raise ValueError("eventDescription is required")
 
+    # 0) Cache ngữ nghĩa: mô tả + tập ban gần như trùng một plan gần đây → dùng lại, không gọi RAG/LLM
+    regenerate = bool(args.get("bypassCache"))
+    bypass_cache = regenerate or not PLAN_CACHE_ENABLED
+    cache_vector = None
+    if bypass_cache:
+        plan_cache.record_bypass()
+    else:
+        hit, cache_vector = await asyncio.to_thread(plan_cache.lookup, event_description, departments)
+        if hit is not None:
+            print(f"[INFO] EPIC planner: plan cache hit (similarity={hit['similarity']}), skipped RAG + LLM")
+            epics_plan = hit["plan"]
+            if on_item is not None:
+                for index, epic in enumerate(epics_plan.get("epics") or []):
+                    await on_item(index, epic)
+            return {
+                "type": "epics_plan",
+                "eventId": event_id,
+                "departments": departments,
+                "eventDescription": event_description,
+                "plan": epics_plan,
+                "truncated": False,
+                "cached": True,
+                "cacheSimilarity": hit["similarity"],
+            }
+
+    started = time.perf_counter()
+
     # 1) RAG: lấy epic_template + case tương tự
-    # Giảm top_k từ 12 xuống 6 để tăng tốc độ RAG query
+    # Giảm top_k từ 12 xuống 6 để tăng tốc độ RAG query (EPIC_PLANNER_KB_TOP_K)
     query = f"{event_description} departments: {', '.join(departments)} epic_template"
-    kb_chunks = retrieve_chunks(query, top_k=6) or []
-    print(f"[DEBUG] RAG – retrieved {len(kb_chunks)} KB chunks for EPIC planning (top_k=6 for faster query).")
+    # Chroma là API đồng bộ → chạy trong thread để không chặn event loop
+    kb_chunks = await asyncio.to_thread(retrieve_chunks, query, top_k=EPIC_PLANNER_KB_TOP_K) or []
+    print(f"[DEBUG] RAG – retrieved {len(kb_chunks)} KB chunks for EPIC planning (top_k={EPIC_PLANNER_KB_TOP_K}).")
 
     kb_text_parts: List[str] = []
     for idx, c in enumerate(kb_chunks):
@@ -107,6 +151,31 @@ def ai_generate_epics_for_event_tool(
         else "Không tìm thấy template nào."
     )
 
+    # 1b) Tổng hợp plan từ pattern (không gọi LLM). bypassCache = user muốn phương án khác
+    #     → không trả lại đúng template, chỉ dùng làm bản nháp.
+    synthesized = synthesize_epics_plan(kb_chunks, departments) if PLAN_SYNTH_MODE != "off" else None
+    if not regenerate and use_directly(synthesized):
+        print(
+            f"[INFO] EPIC planner: synthesized from {synthesized['sources']} "
+            f"(similarity={synthesized['similarity']}, coverage={synthesized['coverage']}), skipped LLM"
+        )
+        epics_plan = synthesized["plan"]
+        if on_item is not None:
+            for index, epic in enumerate(epics_plan["epics"]):
+                await on_item(index, epic)
+        return {
+            "type": "epics_plan",
+            "eventId": event_id,
+            "departments": departments,
+            "eventDescription": event_description,
+            "plan": epics_plan,
+            "truncated": False,
+            "cached": False,
+            "synthesized": True,
+            "synthesisSources": synthesized["sources"],
+        }
+    await emit_draft(on_draft, synthesized, type="epics_plan", eventId=event_id)
+
     # 2) Gọi LLM con để sinh JSON epics
     messages = [
         {"role": "system", "content": EPIC_PLANNER_SYSTEM_PROMPT},
@@ -122,23 +191,31 @@ def ai_generate_epics_for_event_tool(
         },
     ]
 
-    resp = client.chat.completions.create(
+    stream = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
         response_format={"type": "json_object"},
+        stream=True,
     )
 
-    # 3) Parse JSON từ assistant
-    content = resp.choices[0].message.content
-    # Phòng trường hợp content = None
-    if not content:
-        raise ValueError("LLM không trả về nội dung cho kế hoạch EPIC.")
+    # 3) Parse JSON tăng dần trong lúc stream
+    epics_plan, truncated = await stream_json_items(
+        stream, "epics", on_item=on_item, max_items=EPIC_PLANNER_MAX_EPICS
+    )
+    if truncated:
+        print(f"[INFO] EPIC planner: reached budget of {EPIC_PLANNER_MAX_EPICS} epics, generation stopped")
 
-    epics_plan = json.loads(content)
     epics = epics_plan.get("epics", [])
     if not isinstance(epics, list) or not epics:
         raise ValueError("Không sinh được epic nào từ AI.")
 
+    # Plan đầy đủ (không bị cắt theo ngân sách) mới được cache; user bấm tạo lại → thay entry cũ
+    if not truncated and PLAN_CACHE_ENABLED:
+        latency_ms = (time.perf_counter() - started) * 1000
+        await asyncio.to_thread(
+            plan_cache.store, event_description, departments, epics_plan, latency_ms, cache_vector
+        )
+
     # 4) Không ghi vào DB tại đây — chỉ trả về kế hoạch để preview/apply sau.
     return {
         "type": "epics_plan",
@@ -146,4 +223,6 @@ def ai_generate_epics_for_event_tool(
         "departments": departments,
         "eventDescription": event_description,
         "plan": epics_plan,
+        "truncated": truncated,
+        "cached": False,
     }
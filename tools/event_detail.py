@@ -1,9 +1,83 @@
-from typing import Dict, Any, Optional
+import base64
+import copy
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Any, Optional, Tuple
 
+from ttl_cache import TTLCache
 from .node_client import get
 
+# Cache ngắn hạn cho /events/{id}/ai-detail: system prompt bắt model gọi tool này trước hầu hết
+# mọi thao tác nên trong 1 hội thoại cùng một event bị lấy lại nhiều lần.
+EVENT_DETAIL_CACHE_TTL_SECONDS = float(os.getenv("EVENT_DETAIL_CACHE_TTL_SECONDS", "30"))
+EVENT_DETAIL_CACHE_MAX_ENTRIES = int(os.getenv("EVENT_DETAIL_CACHE_MAX_ENTRIES", "512"))
 
-def get_event_detail_for_ai_tool(
+_detail_cache = TTLCache(
+    max_entries=EVENT_DETAIL_CACHE_MAX_ENTRIES,
+    ttl_seconds=EVENT_DETAIL_CACHE_TTL_SECONDS,
+)
+_invalidations = 0
+
+
+def _decode_jwt_claims(user_token: Optional[str]) -> Dict[str, Any]:
+    """
+    Đọc payload của JWT KHÔNG verify chữ ký (Node mới là nơi verify).
+    Chỉ dùng để log / lấy exp, không dùng làm căn cứ phân quyền.
+    """
+    if not user_token or user_token.count(".") != 2:
+        return {}
+    try:
+        payload = user_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        return claims if isinstance(claims, dict) else {}
+    except Exception:  # noqa: BLE001
+        return {}
+
+
+def _cache_key(event_id: str, user_token: Optional[str]) -> Tuple[str, str, str]:
+    """
+    Key = (eventId, user id trong JWT, digest của token).
+    Vì claim không được verify ở đây, digest của cả token mới là phần phân biệt user thật sự:
+    token giả mạo cùng user id không bao giờ trúng cache của người khác.
+    """
+    claims = _decode_jwt_claims(user_token)
+    user_id = str(claims.get("id") or claims.get("userId") or claims.get("_id") or claims.get("sub") or "anonymous")
+    token_digest = hashlib.sha256((user_token or "").encode("utf-8")).hexdigest()[:32]
+    return (event_id, user_id, token_digest)
+
+
+def _entry_ttl(user_token: Optional[str]) -> Optional[float]:
+    """TTL của entry không vượt quá thời điểm token hết hạn (exp)."""
+    exp = _decode_jwt_claims(user_token).get("exp")
+    if not isinstance(exp, (int, float)):
+        return None
+    return max(0.0, min(EVENT_DETAIL_CACHE_TTL_SECONDS, exp - time.time()))
+
+
+def invalidate_event_detail(event_id: Optional[str] = None) -> int:
+    """
+    Xoá cache event detail của 1 event (mọi user), hoặc toàn bộ nếu event_id=None.
+    Gọi khi event thay đổi (apply plan, tạo ban, ...).
+    """
+    global _invalidations
+    if event_id is None:
+        removed = len(_detail_cache)
+        _detail_cache.clear()
+    else:
+        removed = _detail_cache.invalidate(lambda key: key[0] == event_id)
+    _invalidations += 1
+    print(f"[INFO] invalidate_event_detail(eventId={event_id}): removed {removed} entries")
+    return removed
+
+
+def get_event_detail_cache_stats() -> Dict[str, Any]:
+    return {**_detail_cache.stats(), "invalidations": _invalidations}
+
+
+async def get_event_detail_for_ai_tool(
     args: Dict[str, Any],
     user_token: Optional[str] = None,
 ) -> Dict[str, Any]:
@@ -27,9 +101,16 @@ def get_event_detail_for_ai_tool(
     if not event_id:
         raise ValueError("eventId là bắt buộc cho get_event_detail_for_ai_tool")
 
+    key = _cache_key(event_id, user_token)
+    cached = _detail_cache.get(key)
+    if cached is not None:
+        print(f"[INFO] get_event_detail_for_ai_tool: cache hit eventId={event_id} user={key[1]}")
+        # Bản copy: caller (projection, response) không được sửa entry trong cache
+        return copy.deepcopy(cached)
+
     try:
         print(f"[INFO] get_event_detail_for_ai_tool: calling /events/{event_id}/ai-detail")
-        result = get(f"/events/{event_id}/ai-detail", user_token=user_token)
+        result = await get(f"/events/{event_id}/ai-detail", user_token=user_token)
         print(f"[INFO] get_event_detail_for_ai_tool: received response, type={type(result)}")
 
         # API backend bọc data trong { data: { ... } }
@@ -41,6 +122,9 @@ def get_event_detail_for_ai_tool(
                 print(f"[ERROR] {error_msg}")
                 raise ValueError(error_msg)
             print(f"[INFO] get_event_detail_for_ai_tool: success, event name={data.get('event', {}).get('name', 'N/A')}")
+            ttl = _entry_ttl(user_token)
+            if ttl is None or ttl > 0:
+                _detail_cache.set(key, copy.deepcopy(data), ttl_seconds=ttl)
             return data
 
         print(f"[WARN] get_event_detail_for_ai_tool: unexpected result type: {type(result)}")
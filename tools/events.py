@@ -3,7 +3,7 @@ from typing import Dict, Any, Optional
 from .node_client import post
 
 
-def create_event_tool(args: Dict[str, Any], user_token: Optional[str] = None) -> Dict[str, Any]:
+async def create_event_tool(args: Dict[str, Any], user_token: Optional[str] = None) -> Dict[str, Any]:
     """
     Gọi endpoint Node /api/events để tạo event mới.
     args: dict sinh từ LLM theo schema tool "create_event".
@@ -35,4 +35,4 @@ def create_event_tool(args: Dict[str, Any], user_token: Optional[str] = None) ->
     if missing:
         raise ValueError(f"Missing required fields for createEvent: {', '.join(missing)}")
 
-    return post("/events", json=payload, user_token=user_token)
+    return await post("/events", json=payload, user_token=user_token)
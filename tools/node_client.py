@@ -1,9 +1,11 @@
 # tools/node_client.py
+import asyncio
 import os
+import time
 from typing import Optional, Dict, Any
 
 from dotenv import load_dotenv
-import requests
+import httpx
 
 load_dotenv()
 
@@ -13,8 +15,72 @@ if not MYFEVENT_BASE_URL.rstrip("/").endswith("/api"):
     MYFEVENT_BASE_URL = MYFEVENT_BASE_URL.rstrip("/") + "/api"
 SERVICE_API_KEY = os.getenv("MYFEVENT_API_KEY", "")
 
-...
+# Cấu hình connection pool tới Node backend (keep-alive, dùng lại TCP/TLS giữa các tool call)
+NODE_POOL_MAX_CONNECTIONS = int(os.getenv("NODE_POOL_MAX_CONNECTIONS", "20"))
+NODE_POOL_MAX_KEEPALIVE = int(os.getenv("NODE_POOL_MAX_KEEPALIVE", "10"))
+NODE_POOL_KEEPALIVE_EXPIRY = float(os.getenv("NODE_POOL_KEEPALIVE_EXPIRY", "30"))
+# Retry + exponential backoff CHỈ cho GET (idempotent); POST không retry để tránh tạo trùng
+NODE_GET_MAX_RETRIES = int(os.getenv("NODE_GET_MAX_RETRIES", "2"))
+NODE_GET_BACKOFF_SECONDS = float(os.getenv("NODE_GET_BACKOFF_SECONDS", "0.25"))
+# Lỗi tạm thời phía gateway / Node đang restart → GET được retry
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+# Thời gian từ lúc gửi tới lúc có connection vượt ngưỡng này → tính là phải chờ pool
+POOL_WAIT_THRESHOLD_SECONDS = float(os.getenv("NODE_POOL_WAIT_THRESHOLD_SECONDS", "0.005"))
 
+# Một AsyncClient dùng chung cho cả process (giữ connection pool giữa các tool call).
+# Tạo lazy để client gắn với event loop đang chạy (uvicorn / asyncio.run của CLI).
+_client: Optional[httpx.AsyncClient] = None
+
+# Thống kê connection pool để sizing khi chạy tải (xem get_pool_stats)
+_stats: Dict[str, Any] = {
+    "requests": 0,
+    "new_connections": 0,
+    "reused_connections": 0,
+    "pool_waits": 0,
+    "pool_wait_seconds": 0.0,
+    "retries": 0,
+    "in_flight": 0,
+    "max_in_flight": 0,
+}
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=NODE_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=NODE_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=NODE_POOL_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _client
+
+
+async def aclose() -> None:
+    """Đóng AsyncClient dùng chung (gọi khi app shutdown)."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """
+    Thống kê connection pool:
+      - reuse_ratio: tỉ lệ request dùng lại connection keep-alive,
+      - pool_waits / avg_pool_wait_ms: số request phải chờ connection trống và thời gian chờ trung bình,
+      - max_in_flight so với max_connections để biết pool có đang bị nghẽn không.
+    """
+    stats = dict(_stats)
+    opened = stats["new_connections"] + stats["reused_connections"]
+    stats["reuse_ratio"] = round(stats["reused_connections"] / opened, 4) if opened else None
+    stats["avg_pool_wait_ms"] = (
+        round(stats["pool_wait_seconds"] * 1000 / stats["pool_waits"], 2) if stats["pool_waits"] else 0.0
+    )
+    stats["max_connections"] = NODE_POOL_MAX_CONNECTIONS
+    stats["max_keepalive_connections"] = NODE_POOL_MAX_KEEPALIVE
+    return stats
 
 
 def _build_headers(
@@ -37,17 +103,81 @@ def _build_headers(
     return headers
 
 
-def post(path: str, json: dict, user_token: Optional[str] = None, timeout: int = 30):
+def _build_url(path: str) -> str:
     base = MYFEVENT_BASE_URL.rstrip("/")
-    url = f"{base}/{path.lstrip('/')}"
-    resp = requests.post(url, json=json, headers=_build_headers(user_token=user_token), timeout=timeout)
+    return f"{base}/{path.lstrip('/')}"
+
+
+async def _send(method: str, url: str, timeout: int, **kwargs) -> httpx.Response:
+    """
+    Gửi 1 request qua pool và ghi nhận connection mới / dùng lại + thời gian chờ pool.
+    Dựa trên trace extension của httpcore: sự kiện đầu tiên sau khi lấy được connection là
+    connect_tcp (connection mới) hoặc send_request_headers (connection keep-alive).
+    """
+    started = time.perf_counter()
+    acquired: Dict[str, Any] = {}
+
+    async def trace(event_name: str, info: Dict[str, Any]) -> None:
+        if acquired:
+            return
+        if event_name == "connection.connect_tcp.started":
+            acquired.update(at=time.perf_counter(), new=True)
+        elif event_name.endswith("send_request_headers.started"):
+            acquired.update(at=time.perf_counter(), new=False)
+
+    _stats["requests"] += 1
+    _stats["in_flight"] += 1
+    _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
+    try:
+        return await _get_client().request(
+            method, url, timeout=timeout, extensions={"trace": trace}, **kwargs
+        )
+    finally:
+        _stats["in_flight"] -= 1
+        if acquired:
+            _stats["new_connections" if acquired["new"] else "reused_connections"] += 1
+            waited = acquired["at"] - started
+            if waited > POOL_WAIT_THRESHOLD_SECONDS:
+                _stats["pool_waits"] += 1
+                _stats["pool_wait_seconds"] += waited
+
+
+async def _request(method: str, path: str, timeout: int, **kwargs):
+    url = _build_url(path)
+    max_retries = NODE_GET_MAX_RETRIES if method == "GET" else 0
+
+    attempt = 0
+    while True:
+        try:
+            resp = await _send(method, url, timeout, **kwargs)
+            if resp.status_code in RETRYABLE_STATUS_CODES and attempt < max_retries:
+                raise httpx.HTTPStatusError(
+                    f"Retryable status {resp.status_code}", request=resp.request, response=resp
+                )
+            break
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if attempt >= max_retries:
+                if isinstance(e, httpx.TimeoutException):
+                    # httpx thường để message rỗng → ghi rõ "timeout" để agent_core phân loại lỗi đúng
+                    raise type(e)(f"Request timeout sau {timeout}s khi gọi {method} {url}", request=e.request) from e
+                raise
+            attempt += 1
+            _stats["retries"] += 1
+            delay = NODE_GET_BACKOFF_SECONDS * (2 ** (attempt - 1))
+            print(f"[NODE] {method} {url} failed ({type(e).__name__}), retry {attempt}/{max_retries} sau {delay:.2f}s")
+            await asyncio.sleep(delay)
+
     resp.raise_for_status()
     return resp.json()
 
 
-def get(path: str, params: Optional[dict] = None, user_token: Optional[str] = None, timeout: int = 30):
-    base = MYFEVENT_BASE_URL.rstrip("/")
-    url = f"{base}/{path.lstrip('/')}"
-    resp = requests.get(url, params=params, headers=_build_headers(user_token=user_token), timeout=timeout)
-    resp.raise_for_status()
-    return resp.json()
\ No newline at end of file
+async def post(path: str, json: dict, user_token: Optional[str] = None, timeout: int = 30):
+    return await _request(
+        "POST", path, timeout, json=json, headers=_build_headers(user_token=user_token)
+    )
+
+
+async def get(path: str, params: Optional[dict] = None, user_token: Optional[str] = None, timeout: int = 30):
+    return await _request(
+        "GET", path, timeout, params=params, headers=_build_headers(user_token=user_token)
+    )
@@ -1,17 +1,36 @@
 # tools/tasks.py
+import asyncio
 import json
-from typing import Dict, Any, Optional, List
-
-from openai import OpenAI
-
-from rag import retrieve_chunks
+from typing import Dict, Any, Optional, List, Tuple
+
+from openai import AsyncOpenAI
+
+from plan_synthesizer import (
+    PLAN_SYNTH_MODE,
+    DraftCallback,
+    canonical_department,
+    emit_draft,
+    synthesize_tasks_plan,
+    use_directly,
+)
+from rag import retrieve_chunks, retrieve_epic_tasks
+from stream_json import ItemCallback, stream_json_items
 from .node_client import post, get
 
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Ngân sách số tasks mỗi plan: đạt ngưỡng thì dừng stream (huỷ generation), trả phần đã có
+TASK_PLANNER_MAX_TASKS = int(os.getenv("TASK_PLANNER_MAX_TASKS", "30"))
+
+# Số LLM con chạy đồng thời khi sinh task cho nhiều EPIC trong 1 tool call
+TASK_BATCH_CONCURRENCY = int(os.getenv("TASK_BATCH_CONCURRENCY", "4"))
+
+# Số doc cấp EPIC (mỗi doc = 1 epic template + task list của nó) lấy cho mỗi EPIC cần sinh task
+TASK_KB_EPIC_TOP_K = int(os.getenv("TASK_KB_EPIC_TOP_K", "3"))
 
 # ======================================================================
 #  TASK PLANNER PROMPT – ĐÃ ĐIỀU CHỈNH THEO TASK MODEL MỚI
@@ -104,49 +123,54 @@ def _chunk_to_text(chunk: Any) -> str:
     return json.dumps(chunk, ensure_ascii=False)
 
 
-def ai_generate_tasks_for_epic_tool(
-    args: Dict[str, Any],
-    user_token: Optional[str] = None,
-) -> Dict[str, Any]:
-    """
-    Tool cho LLM cha (agent):
+def _epic_chunk_to_text(chunk: Dict[str, Any]) -> str:
+    """Doc cấp EPIC → text gọn: epic + đúng task list của nó (không kéo theo cả pattern)."""
+    epic = chunk.get("full_doc")
+    if not isinstance(epic, dict):
+        return _chunk_to_text(chunk)
+
+    lines = [f"Epic: {epic.get('title', '')} (department: {epic.get('department', '')}, phase: {epic.get('phase', '')})"]
+    titles_by_key = {t.get("task_key"): t.get("title") for t in epic.get("tasks") or [] if isinstance(t, dict)}
+    for task in epic.get("tasks") or []:
+        if not isinstance(task, dict):
+            continue
+        depends_on = [titles_by_key.get(k, k) for k in task.get("depends_on") or []]
+        lines.append(
+            f"- {task.get('title', '')} [priority={task.get('priority', '')}, "
+            f"offset_days={task.get('suggested_offset_days', '')}, depends_on={depends_on}]: "
+            f"{task.get('description', '')}"
+        )
+    return "\n".join(lines)
 
-    Input (args):
-      - eventId: ID sự kiện trong hệ thống myFEvent (string, bắt buộc)
-      - epicId: ID task cha (EPIC) trong DB (string, bắt buộc)
-      - epicTitle: tên EPIC (string, bắt buộc)
-      - department: tên ban phụ trách EPIC (string, optional – chỉ để context cho LLM)
-      - eventDescription: mô tả sự kiện (string, bắt buộc để RAG hiểu context)
-      - eventStartDate: "yyyy-mm-dd" (string, optional nhưng nên có để tính offset)
 
-    Pipeline:
-      1) Gọi RAG: lấy task_template + task_snapshot phù hợp với eventDescription + epicTitle + department.
-      2) Gọi LLM con với TASK_PLANNER_SYSTEM_PROMPT để sinh JSON tasks:
-         - tasks[].title, description, priority, can_parallel, depends_on, offset_days_from_event.
-      3) Trả JSON tasks này (tasks_plan) cho layer phía trên để HIỂN THỊ & PREVIEW.
-         Backend / frontend sẽ quyết định khi nào gọi API apply để tạo task thật.
+async def _retrieve_task_kb(
+    event_description: str, epic_titles: List[str], department: str
+) -> Tuple[str, List[Dict[str, Any]]]:
     """
-    event_id: str = args.get("eventId")
-    epic_id: str = args.get("epicId")
-    epic_title: str = args.get("epicTitle", "")
-    department: str = args.get("department", "")
-    event_description: str = args.get("eventDescription", "")
-    event_start_date: str = args.get("eventStartDate", "")  # "yyyy-mm-dd"
-
-    # ===== Validate input tối thiểu =====
-    if not event_id or not epic_id:
-        raise ValueError("eventId và epicId là bắt buộc")
-
-    if not epic_title:
-        raise ValueError("epicTitle là bắt buộc")
+    RAG: epic template khớp nhất (kèm task list) cho (các) EPIC của một ban.
+    Trả về (text đưa vào prompt, chunks gốc cho plan_synthesizer).
 
-    if not event_description:
-        raise ValueError("eventDescription là bắt buộc để RAG hiểu ngữ cảnh")
+    Query thẳng vào doc cấp EPIC (retrieve_epic_tasks) → prompt chỉ chứa task list của epic liên quan.
+    Collection chưa có doc con (index cũ) → fallback lấy cả pattern như trước.
+    """
+    query = f"EPIC: {'; '.join(epic_titles)} department: {department} {event_description}"
+    top_k = TASK_KB_EPIC_TOP_K + len(epic_titles) - 1
+    # Chroma là API đồng bộ → chạy trong thread để không chặn event loop
+    kb_chunks = await asyncio.to_thread(
+        retrieve_epic_tasks, query, canonical_department(department) if department else None, top_k
+    ) or []
+    if kb_chunks:
+        print(f"[DEBUG] RAG – retrieved {len(kb_chunks)} epic templates for TASK planning (top_k={top_k}).")
+        kb_text = "\n\n".join(
+            f"[KB#{idx+1}] (epic_template, {(c.get('metadata') or {}).get('parent_id', 'unknown')}):\n"
+            f"{_epic_chunk_to_text(c)}"
+            for idx, c in enumerate(kb_chunks)
+        )
+        return kb_text, kb_chunks
 
-    # 1) RAG – lấy task_template + snapshot cho EPIC này
     # Giảm top_k từ 12 xuống 6 để tăng tốc độ RAG query
-    query = f"{event_description} EPIC: {epic_title} department: {department} task_template task_snapshot"
-    kb_chunks = retrieve_chunks(query, top_k=6) or []
+    query = f"{event_description} EPIC: {'; '.join(epic_titles)} department: {department} task_template task_snapshot"
+    kb_chunks = await asyncio.to_thread(retrieve_chunks, query, top_k=6) or []
     print(f"[DEBUG] RAG – retrieved {len(kb_chunks)} KB chunks for TASK planning (top_k=6 for faster query).")
 
     kb_text_parts: List[str] = []
@@ -162,8 +186,45 @@ def ai_generate_tasks_for_epic_tool(
         if kb_text_parts
         else "Không tìm thấy task template nào trong KB."
     )
+    return kb_text, kb_chunks
 
-    # 2) Gọi LLM con – sinh JSON tasks
+
+def _synthesized_tasks_result(
+    event_id: str,
+    epic_id: str,
+    epic_title: str,
+    department: str,
+    event_start_date: str,
+    synthesized: Dict[str, Any],
+) -> Dict[str, Any]:
+    print(
+        f"[INFO] TASK planner: '{epic_title}' synthesized from {synthesized['sources']} "
+        f"(similarity={synthesized['similarity']}, title_match={synthesized['title_match']}), skipped LLM"
+    )
+    return {
+        "type": "tasks_plan",
+        "eventId": event_id,
+        "epicId": epic_id,
+        "epicTitle": epic_title,
+        "department": department,
+        "eventStartDate": event_start_date,
+        "plan": synthesized["plan"],
+        "truncated": False,
+        "synthesized": True,
+        "synthesisSources": synthesized["sources"],
+    }
+
+
+async def _generate_tasks_plan(
+    event_description: str,
+    event_start_date: str,
+    department: str,
+    epic_id: str,
+    epic_title: str,
+    kb_text: str,
+    on_item: Optional[ItemCallback] = None,
+) -> Tuple[Dict[str, Any], bool]:
+    """Gọi LLM con (streaming) sinh JSON tasks cho 1 EPIC, trả về (tasks_plan, truncated)."""
     messages = [
         {"role": "system", "content": TASK_PLANNER_SYSTEM_PROMPT},
         {
@@ -179,27 +240,97 @@ def ai_generate_tasks_for_epic_tool(
         },
     ]
 
-    resp = client.chat.completions.create(
+    stream = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
         response_format={"type": "json_object"},
+        stream=True,
     )
 
-    content = resp.choices[0].message.content
-    if not content:
-        raise ValueError("LLM không trả về nội dung cho kế hoạch TASK (content rỗng).")
-
-    try:
-        tasks_plan = json.loads(content)
-    except json.JSONDecodeError as e:
-        # Log thêm để debug nếu LLM trả về JSON lỗi
-        print("[ERROR] JSON decode error from TASK planner:", e)
-        print("[RAW CONTENT]", content)
-        raise
+    # JSON lỗi / bị cắt → stream_json_items giữ lại các task đã parse được
+    tasks_plan, truncated = await stream_json_items(
+        stream, "tasks", on_item=on_item, max_items=TASK_PLANNER_MAX_TASKS
+    )
+    if truncated:
+        print(f"[INFO] TASK planner: reached budget of {TASK_PLANNER_MAX_TASKS} tasks, generation stopped")
 
     tasks = tasks_plan.get("tasks", [])
     if not isinstance(tasks, list) or not tasks:
         raise ValueError("Không sinh được task nào từ AI cho EPIC này (tasks rỗng).")
+    return tasks_plan, truncated
+
+
+async def ai_generate_tasks_for_epic_tool(
+    args: Dict[str, Any],
+    user_token: Optional[str] = None,
+    on_item: Optional[ItemCallback] = None,
+    on_draft: Optional[DraftCallback] = None,
+) -> Dict[str, Any]:
+    """
+    Tool cho LLM cha (agent):
+
+    Input (args):
+      - eventId: ID sự kiện trong hệ thống myFEvent (string, bắt buộc)
+      - epicId: ID task cha (EPIC) trong DB (string, bắt buộc)
+      - epicTitle: tên EPIC (string, bắt buộc)
+      - department: tên ban phụ trách EPIC (string, optional – chỉ để context cho LLM)
+      - eventDescription: mô tả sự kiện (string, bắt buộc để RAG hiểu context)
+      - eventStartDate: "yyyy-mm-dd" (string, optional nhưng nên có để tính offset)
+
+    Pipeline:
+      1) Gọi RAG: lấy epic template (kèm task list) khớp nhất với epicTitle + department + eventDescription.
+      1b) Tổng hợp tasks từ EPIC khớp nhất trong pattern KB (plan_synthesizer): đủ tin cậy → trả luôn
+          (synthesized=True, bỏ qua LLM), ngược lại gửi làm bản nháp qua on_draft.
+      2) Gọi LLM con với TASK_PLANNER_SYSTEM_PROMPT để sinh JSON tasks:
+         - tasks[].title, description, priority, can_parallel, depends_on, offset_days_from_event.
+         Completion được stream: mỗi task báo qua on_item(index, task) ngay khi hoàn chỉnh,
+         dừng khi đạt TASK_PLANNER_MAX_TASKS.
+      3) Trả JSON tasks này (tasks_plan) cho layer phía trên để HIỂN THỊ & PREVIEW.
+         Backend / frontend sẽ quyết định khi nào gọi API apply để tạo task thật.
+    """
+    event_id: str = args.get("eventId")
+    epic_id: str = args.get("epicId")
+    epic_title: str = args.get("epicTitle", "")
+    department: str = args.get("department", "")
+    event_description: str = args.get("eventDescription", "")
+    event_start_date: str = args.get("eventStartDate", "")  # "yyyy-mm-dd"
+
+    # ===== Validate input tối thiểu =====
+    if not event_id or not epic_id:
+        raise ValueError("eventId và epicId là bắt buộc")
+
+    if not epic_title:
+        raise ValueError("epicTitle là bắt buộc")
+
+    if not event_description:
+        raise ValueError("eventDescription là bắt buộc để RAG hiểu ngữ cảnh")
+
+    # 1) RAG – lấy task_template + snapshot cho EPIC này
+    kb_text, kb_chunks = await _retrieve_task_kb(event_description, [epic_title], department)
+
+    # 1b) Tổng hợp từ pattern, không gọi LLM
+    synthesized = (
+        synthesize_tasks_plan(kb_chunks, epic_title, department, event_start_date)
+        if PLAN_SYNTH_MODE != "off" else None
+    )
+    if use_directly(synthesized):
+        result = _synthesized_tasks_result(event_id, epic_id, epic_title, department, event_start_date, synthesized)
+        if on_item is not None:
+            for index, task in enumerate(result["plan"]["tasks"]):
+                await on_item(index, task)
+        return result
+    await emit_draft(on_draft, synthesized, type="tasks_plan", eventId=event_id, epicId=epic_id, epicTitle=epic_title)
+
+    # 2) Gọi LLM con – sinh JSON tasks
+    tasks_plan, truncated = await _generate_tasks_plan(
+        event_description=event_description,
+        event_start_date=event_start_date,
+        department=department,
+        epic_id=epic_id,
+        epic_title=epic_title,
+        kb_text=kb_text,
+        on_item=on_item,
+    )
 
     # 3) Không gửi sang Node ở đây nữa – chỉ trả plan để preview/apply sau.
     return {
@@ -210,4 +341,130 @@ def ai_generate_tasks_for_epic_tool(
         "department": department,
         "eventStartDate": event_start_date,
         "plan": tasks_plan,   # raw plan từ LLM (title/priority/offset/depends_on)
+        "truncated": truncated,
+    }
+
+
+async def ai_generate_tasks_for_epics_tool(
+    args: Dict[str, Any],
+    user_token: Optional[str] = None,
+    on_item: Optional[ItemCallback] = None,
+    on_draft: Optional[DraftCallback] = None,
+) -> Dict[str, Any]:
+    """
+    Tool cho LLM cha: sinh task cho NHIỀU EPIC của một sự kiện trong 1 lần gọi
+    (thay vì gọi ai_generate_tasks_for_epic N lần = N iteration của agent).
+
+    Input (args):
+      - eventId, eventDescription, eventStartDate: như ai_generate_tasks_for_epic
+      - epics: [{"epicId", "epicTitle", "department"}, ...]
+
+    Pipeline:
+      1) RAG một lần cho mỗi ban (các EPIC cùng ban dùng chung KB context), các ban chạy song song.
+      2) EPIC khớp pattern đủ tin cậy → tổng hợp trực tiếp (plan_synthesizer), không gọi LLM;
+         các EPIC còn lại gọi LLM con song song, tối đa TASK_BATCH_CONCURRENCY cùng lúc
+         (bản nháp từ pattern, nếu có, gửi qua on_draft).
+      3) Trả về tasks_plan_batch: plans[] (mỗi phần tử đúng format tasks_plan) + errors[] của EPIC lỗi.
+
+    on_item(index, {"epicId", "epicTitle", "task"}): báo từng task ngay khi sinh xong.
+    """
+    event_id: str = args.get("eventId")
+    event_description: str = args.get("eventDescription", "")
+    event_start_date: str = args.get("eventStartDate", "")
+    epics: List[Dict[str, Any]] = [
+        epic for epic in (args.get("epics") or [])
+        if isinstance(epic, dict) and epic.get("epicId") and epic.get("epicTitle")
+    ]
+
+    if not event_id:
+        raise ValueError("eventId là bắt buộc")
+    if not event_description:
+        raise ValueError("eventDescription là bắt buộc để RAG hiểu ngữ cảnh")
+    if not epics:
+        raise ValueError("epics phải là danh sách EPIC có epicId và epicTitle")
+
+    # 1) RAG theo ban
+    by_department: Dict[str, List[str]] = {}
+    for epic in epics:
+        by_department.setdefault(epic.get("department", ""), []).append(epic["epicTitle"])
+
+    departments = list(by_department)
+    kb_results = await asyncio.gather(
+        *(_retrieve_task_kb(event_description, by_department[dept], dept) for dept in departments)
+    )
+    kb_by_department = dict(zip(departments, kb_results))
+    print(f"[INFO] TASK batch: {len(epics)} EPICs, {len(departments)} RAG queries")
+
+    # 2) LLM con cho từng EPIC, có giới hạn đồng thời
+    semaphore = asyncio.Semaphore(TASK_BATCH_CONCURRENCY)
+
+    async def _plan_one(epic: Dict[str, Any]) -> Dict[str, Any]:
+        epic_id = epic["epicId"]
+        epic_title = epic["epicTitle"]
+        department = epic.get("department", "")
+
+        async def emit_epic_item(index: int, item: Dict[str, Any]) -> None:
+            await on_item(index, {"epicId": epic_id, "epicTitle": epic_title, "task": item})
+
+        epic_on_item = emit_epic_item if on_item is not None else None
+
+        kb_text, kb_chunks = kb_by_department[department]
+        synthesized = (
+            synthesize_tasks_plan(kb_chunks, epic_title, department, event_start_date)
+            if PLAN_SYNTH_MODE != "off" else None
+        )
+        if use_directly(synthesized):
+            result = _synthesized_tasks_result(
+                event_id, epic_id, epic_title, department, event_start_date, synthesized
+            )
+            if epic_on_item is not None:
+                for index, task in enumerate(result["plan"]["tasks"]):
+                    await epic_on_item(index, task)
+            return result
+        await emit_draft(
+            on_draft, synthesized, type="tasks_plan", eventId=event_id, epicId=epic_id, epicTitle=epic_title
+        )
+
+        async with semaphore:
+            tasks_plan, truncated = await _generate_tasks_plan(
+                event_description=event_description,
+                event_start_date=event_start_date,
+                department=department,
+                epic_id=epic_id,
+                epic_title=epic_title,
+                kb_text=kb_text,
+                on_item=epic_on_item,
+            )
+        return {
+            "type": "tasks_plan",
+            "eventId": event_id,
+            "epicId": epic_id,
+            "epicTitle": epic_title,
+            "department": department,
+            "eventStartDate": event_start_date,
+            "plan": tasks_plan,
+            "truncated": truncated,
+        }
+
+    results = await asyncio.gather(*(_plan_one(epic) for epic in epics), return_exceptions=True)
+
+    plans: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    for epic, result in zip(epics, results):
+        if isinstance(result, BaseException):
+            print(f"[ERROR] TASK batch: EPIC '{epic['epicTitle']}' failed: {result}")
+            errors.append({"epicId": epic["epicId"], "epicTitle": epic["epicTitle"], "error": str(result)})
+        else:
+            plans.append(result)
+
+    if not plans:
+        raise ValueError(f"Không sinh được task cho EPIC nào. Lỗi: {[e['error'] for e in errors]}")
+
+    # 3) Chỉ trả plan để preview/apply sau.
+    return {
+        "type": "tasks_plan_batch",
+        "eventId": event_id,
+        "eventStartDate": event_start_date,
+        "plans": plans,
+        "errors": errors,
     }
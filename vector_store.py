@@ -0,0 +1,328 @@
+# vector_store.py
+"""
+Interface vector store cho rag.py, chọn backend bằng KB_VECTOR_BACKEND:
+
+- "chroma" (mặc định): collection ChromaDB như trước (SQLite + HNSW + filter metadata).
+- "numpy": snapshot do scripts/index_kb.py export ra KB_NUMPY_SNAPSHOT_DIR, load vào process:
+    + toàn bộ embedding trong 1 ma trận float32 liền mạch, memory-map từ đĩa
+      (các worker uvicorn dùng chung page cache, không mỗi worker một bản),
+    + bình phương norm tính sẵn → distance L2 bình phương (cùng metric với collection Chroma,
+      nên max_distance / plan_synthesizer không phải đổi ngưỡng) = |x|² - 2·x·q + |q|²,
+    + bitmask uint64 cho từng field lọc (kb_group, level, department): where = phép AND bit,
+    + top-k = 1 phép nhân ma trận-vector + argpartition,
+    + document / metadata nằm trong file jsonl, chỉ đọc (mmap) đúng các dòng được trả về.
+  KB cỡ vài trăm - vài nghìn doc: query dưới 1ms, không cần HNSW.
+
+Cả 2 backend trả kết quả đúng shape của Chroma (query / get), rag.py dùng như collection cũ.
+"""
+import json
+import mmap
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import chromadb
+import numpy as np
+
+from embeddings import META_DIM
+
+CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "./chroma_db")
+COLLECTION_NAME = "myfevent_kb"
+
+KB_VECTOR_BACKEND = os.getenv("KB_VECTOR_BACKEND", "chroma").lower()
+KB_NUMPY_SNAPSHOT_DIR = os.getenv("KB_NUMPY_SNAPSHOT_DIR", os.path.join(CHROMA_DB_DIR, "numpy_snapshot"))
+
+# Field metadata có bitmask trong snapshot numpy (đúng các field rag._build_where dùng)
+FILTER_FIELDS = ("kb_group", "level", "department")
+_MAX_VALUES_PER_FIELD = 64
+_SNAPSHOT_MANIFEST = "snapshot.json"
+
+
+class VectorStore(ABC):
+    """Phần API collection Chroma mà rag.py dùng: query / get / count + name, metadata."""
+
+    backend = "base"
+    name = COLLECTION_NAME
+    metadata: Dict[str, Any] = {}
+
+    @abstractmethod
+    def query(self, query_embeddings: List[List[float]], n_results: int, where: Optional[Dict[str, Any]] = None):
+        ...
+
+    @abstractmethod
+    def get(self, ids: Sequence[str], include: Sequence[str] = ("documents", "metadatas")):
+        ...
+
+    @abstractmethod
+    def count(self) -> int:
+        ...
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "count": self.count()}
+
+
+class ChromaVectorStore(VectorStore):
+    backend = "chroma"
+
+    def __init__(self, embedding_fn=None, path: str = CHROMA_DB_DIR):
+        self._client = chromadb.PersistentClient(path=path)
+        self._collection = self._client.get_or_create_collection(name=COLLECTION_NAME, embedding_function=embedding_fn)
+        self.name = self._collection.name
+        self.metadata = self._collection.metadata or {}
+
+    def query(self, query_embeddings, n_results, where=None):
+        return self._collection.query(query_embeddings=query_embeddings, n_results=n_results, where=where)
+
+    def get(self, ids, include=("documents", "metadatas")):
+        return self._collection.get(ids=list(ids), include=list(include))
+
+    def count(self) -> int:
+        return self._collection.count()
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Snapshot (ghi bởi export_numpy_snapshot), tên file có hậu tố generation để ghi đè an toàn:
+      snapshot.json        : generation, count, dim, metadata collection, mã giá trị từng field lọc
+      vectors-<gen>.f32    : N x dim float32 (memmap)
+      sqnorms-<gen>.f32    : N float32, |x|²
+      masks-<gen>.u64      : N x len(FILTER_FIELDS) uint64, bit = mã giá trị của field
+      docs-<gen>.jsonl     : mỗi dòng {"id", "document", "metadata"}
+      offsets-<gen>.u64    : N + 1 byte offset của từng dòng trong docs-<gen>.jsonl
+    """
+
+    backend = "numpy"
+
+    def __init__(self, snapshot_dir: str = KB_NUMPY_SNAPSHOT_DIR):
+        with open(os.path.join(snapshot_dir, _SNAPSHOT_MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        gen = manifest["generation"]
+        self.snapshot_dir = snapshot_dir
+        self.generation = gen
+        self.metadata = manifest.get("collection_metadata") or {}
+        self.dim = int(manifest["dim"])
+        self._count = int(manifest["count"])
+        self._codes: Dict[str, Dict[str, int]] = manifest["codes"]
+
+        def path(name: str) -> str:
+            return os.path.join(snapshot_dir, f"{name}-{gen}")
+
+        if self._count:
+            self.vectors = np.memmap(path("vectors") + ".f32", dtype=np.float32, mode="r", shape=(self._count, self.dim))
+            self.sqnorms = np.memmap(path("sqnorms") + ".f32", dtype=np.float32, mode="r", shape=(self._count,))
+            self.masks = np.memmap(
+                path("masks") + ".u64", dtype=np.uint64, mode="r", shape=(self._count, len(FILTER_FIELDS))
+            )
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+            self.sqnorms = np.zeros((0,), dtype=np.float32)
+            self.masks = np.zeros((0, len(FILTER_FIELDS)), dtype=np.uint64)
+        self.offsets = np.fromfile(path("offsets") + ".u64", dtype=np.uint64)
+        self._docs_file = open(path("docs") + ".jsonl", "rb")
+        self._docs = mmap.mmap(self._docs_file.fileno(), 0, access=mmap.ACCESS_READ) if self._count else b""
+        self._row_by_id: Optional[Dict[str, int]] = None
+        self._lock = threading.Lock()
+        self.total_query_ms = 0.0
+        self.queries = 0
+
+    def _record(self, row: int) -> Dict[str, Any]:
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        return json.loads(self._docs[start:end])
+
+    def _row_index(self) -> Dict[str, int]:
+        # Chỉ cần cho get(ids=...) (doc BM25 tìm thấy mà dense không có) → build lần đầu khi dùng
+        if self._row_by_id is None:
+            with self._lock:
+                if self._row_by_id is None:
+                    self._row_by_id = {self._record(row)["id"]: row for row in range(self._count)}
+        return self._row_by_id
+
+    def _clause_mask(self, field: str, condition: Any) -> np.ndarray:
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"NumpyVectorStore không hỗ trợ lọc theo field '{field}'")
+        if isinstance(condition, dict):
+            if set(condition) != {"$in"}:
+                raise ValueError(f"NumpyVectorStore chỉ hỗ trợ $in / so sánh bằng, nhận {condition}")
+            values = condition["$in"]
+        else:
+            values = [condition]
+        codes = self._codes.get(field) or {}
+        bits = 0
+        for value in values:
+            code = codes.get(str(value))
+            if code is not None:
+                bits |= 1 << code
+        column = self.masks[:, FILTER_FIELDS.index(field)]
+        return (column & np.uint64(bits)) != 0
+
+    def _where_mask(self, where: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        if not where:
+            return None
+        if "$and" in where:
+            mask = np.ones(self._count, dtype=bool)
+            for clause in where["$and"]:
+                mask &= self._where_mask(clause)
+            return mask
+        mask = np.ones(self._count, dtype=bool)
+        for field, condition in where.items():
+            mask &= self._clause_mask(field, condition)
+        return mask
+
+    def query(self, query_embeddings, n_results, where=None):
+        started = time.perf_counter()
+        ids, documents, metadatas, distances = [], [], [], []
+        for query_embedding in query_embeddings:
+            q = np.asarray(query_embedding, dtype=np.float32)
+            # |x - q|² = |x|² - 2 x·q + |q|²
+            dist = self.sqnorms - 2.0 * (self.vectors @ q) + float(q @ q)
+            mask = self._where_mask(where)
+            if mask is not None:
+                dist = np.where(mask, dist, np.inf)
+                n_valid = int(mask.sum())
+            else:
+                n_valid = self._count
+            k = min(int(n_results), n_valid)
+            if k <= 0:
+                rows = np.empty(0, dtype=np.int64)
+            else:
+                rows = np.argpartition(dist, k - 1)[:k] if k < self._count else np.arange(self._count)
+                rows = rows[np.argsort(dist[rows], kind="stable")]
+            records = [self._record(int(row)) for row in rows]
+            ids.append([r["id"] for r in records])
+            documents.append([r["document"] for r in records])
+            metadatas.append([r["metadata"] for r in records])
+            distances.append([max(0.0, float(dist[row])) for row in rows])
+        self.total_query_ms += (time.perf_counter() - started) * 1000
+        self.queries += 1
+        return {"ids": ids, "documents": documents, "metadatas": metadatas, "distances": distances}
+
+    def get(self, ids, include=("documents", "metadatas")):
+        row_by_id = self._row_index()
+        rows = [row_by_id[_id] for _id in ids if _id in row_by_id]
+        records = [self._record(row) for row in rows]
+        result: Dict[str, Any] = {"ids": [r["id"] for r in records]}
+        if "documents" in include:
+            result["documents"] = [r["document"] for r in records]
+        if "metadatas" in include:
+            result["metadatas"] = [r["metadata"] for r in records]
+        if "embeddings" in include:
+            result["embeddings"] = [self.vectors[row].tolist() for row in rows]
+        return result
+
+    def count(self) -> int:
+        return self._count
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend,
+            "count": self._count,
+            "dim": self.dim,
+            "generation": self.generation,
+            "queries": self.queries,
+            "avg_query_ms": round(self.total_query_ms / self.queries, 4) if self.queries else None,
+        }
+
+
+def open_vector_store(embedding_fn=None, backend: str = KB_VECTOR_BACKEND) -> VectorStore:
+    """Mở backend theo cấu hình; snapshot numpy chưa có / lỗi → fallback Chroma."""
+    if backend == "numpy":
+        try:
+            store = NumpyVectorStore(KB_NUMPY_SNAPSHOT_DIR)
+            print(f"[RAG] Vector store: numpy snapshot gen={store.generation} ({store.count()} docs, dim={store.dim})")
+            return store
+        except Exception as e:  # noqa: BLE001
+            print(f"[RAG] WARN: cannot open numpy snapshot in {KB_NUMPY_SNAPSHOT_DIR} ({e}), falling back to chroma")
+    elif backend != "chroma":
+        print(f"[RAG] WARN: unknown KB_VECTOR_BACKEND '{backend}', using chroma")
+    return ChromaVectorStore(embedding_fn)
+
+
+def export_numpy_snapshot(
+    pages: Iterable[Dict[str, Any]],
+    collection_metadata: Dict[str, Any],
+    snapshot_dir: str = KB_NUMPY_SNAPSHOT_DIR,
+) -> Dict[str, Any]:
+    """
+    Ghi snapshot cho NumpyVectorStore từ các trang kết quả collection.get
+    (include embeddings + documents + metadatas). Ghi file generation mới rồi mới thay
+    snapshot.json (atomic) → worker đang đọc bản cũ không bị hỏng; file generation cũ bị xoá
+    (Linux giữ inode tới khi worker đóng mmap).
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    gen = f"{int(time.time() * 1000)}"
+
+    def path(name: str, ext: str) -> str:
+        return os.path.join(snapshot_dir, f"{name}-{gen}.{ext}")
+
+    codes: Dict[str, Dict[str, int]] = {field: {} for field in FILTER_FIELDS}
+    offsets = [0]
+    count, dim = 0, None
+
+    with open(path("vectors", "f32"), "wb") as vectors_f, \
+            open(path("sqnorms", "f32"), "wb") as sqnorms_f, \
+            open(path("masks", "u64"), "wb") as masks_f, \
+            open(path("docs", "jsonl"), "wb") as docs_f:
+        for page in pages:
+            ids = page.get("ids") or []
+            if not ids:
+                continue
+            documents = page.get("documents") or []
+            metadatas = page.get("metadatas") or []
+            embeddings = page.get("embeddings")
+            if embeddings is None or not (len(ids) == len(embeddings) == len(documents) == len(metadatas)):
+                # zip bên dưới sẽ âm thầm cắt bớt → vector và docs lệch hàng nhau
+                raise ValueError(
+                    f"Trang collection.get không đồng nhất: ids={len(ids)}, "
+                    f"embeddings={None if embeddings is None else len(embeddings)}, "
+                    f"documents={len(documents)}, metadatas={len(metadatas)}"
+                )
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            if dim is None:
+                dim = vectors.shape[1]
+            elif vectors.shape[1] != dim:
+                raise ValueError(f"Embedding dim không đồng nhất trong collection ({vectors.shape[1]} != {dim})")
+            vectors.tofile(vectors_f)
+            np.einsum("ij,ij->i", vectors, vectors).astype(np.float32).tofile(sqnorms_f)
+
+            masks = np.zeros((len(ids), len(FILTER_FIELDS)), dtype=np.uint64)
+            for i, (_id, document, meta) in enumerate(zip(ids, documents, metadatas)):
+                meta = meta or {}
+                for j, field in enumerate(FILTER_FIELDS):
+                    value = meta.get(field)
+                    if value is None:
+                        continue
+                    field_codes = codes[field]
+                    if str(value) not in field_codes:
+                        if len(field_codes) >= _MAX_VALUES_PER_FIELD:
+                            raise ValueError(
+                                f"Field '{field}' có hơn {_MAX_VALUES_PER_FIELD} giá trị, không biểu diễn được bằng "
+                                "bitmask uint64; dùng KB_VECTOR_BACKEND=chroma."
+                            )
+                        field_codes[str(value)] = len(field_codes)
+                    masks[i, j] = np.uint64(1 << field_codes[str(value)])
+                line = json.dumps({"id": _id, "document": document, "metadata": meta}, ensure_ascii=False).encode("utf-8")
+                docs_f.write(line + b"\n")
+                offsets.append(offsets[-1] + len(line) + 1)
+            masks.tofile(masks_f)
+            count += len(ids)
+
+    np.asarray(offsets, dtype=np.uint64).tofile(path("offsets", "u64"))
+
+    manifest = {
+        "generation": gen,
+        "count": count,
+        "dim": dim or int(collection_metadata.get(META_DIM) or 0),
+        "collection_metadata": collection_metadata,
+        "codes": codes,
+    }
+    manifest_path = os.path.join(snapshot_dir, _SNAPSHOT_MANIFEST)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    for fname in os.listdir(snapshot_dir):
+        if fname != _SNAPSHOT_MANIFEST and "-" in fname and f"-{gen}." not in fname:
+            os.remove(os.path.join(snapshot_dir, fname))
+    return manifest